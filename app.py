@@ -1,11 +1,30 @@
 import os
+from hashlib import blake2b
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Flask, render_template, request, flash, redirect, session,
+                   g, abort, jsonify, make_response, Response, get_flashed_messages,
+                   stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+from assets import assets
+from availability import availability
+from cache import cache
+from compression import init_compression
 from forms import UserAddForm, EditAddForm, LoginForm, MessageForm
-from models import db, connect_db, User, Message, Favorite
+from fragments import (init_fragments, forget_fragments, MESSAGE_FRAGMENTS,
+                       USER_FRAGMENTS)
+from jobs import jobs, on_commit
+from models import (db, connect_db, User, Message, Favorite, Timeline,
+                    FollowersFollowee, NOT_FOLLOWING, load_profile)
+from metrics import init_metrics, metrics_response, timed_render
+from passwords import password_pool, PasswordPoolBusy
+from profiler import profiler
+from pagination import keyset_page, keyset_stream, Page, StreamedPage
+from search import (search_users, username_index, search_messages,
+                    message_index, database_searches)
+from snowflake import snowflake
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,13 +35,387 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgres:///warbler'))
 
+# Read replicas, if any (see models.py): GET requests read from one of
+# these, picked by weight, unless it's more than REPLICA_MAX_LAG seconds
+# behind. DATABASE_REPLICA_WEIGHTS defaults to 1 each.
+replica_urls = os.environ.get('DATABASE_REPLICA_URLS', '').split()
+replica_weights = [
+    float(weight)
+    for weight in os.environ.get('DATABASE_REPLICA_WEIGHTS', '').split()
+] or [1] * len(replica_urls)
+
+app.config['SQLALCHEMY_BINDS'] = {
+    f'replica{n}': url for n, url in enumerate(replica_urls)}
+app.config['SQLALCHEMY_REPLICAS'] = {
+    f'replica{n}': weight for n, weight in enumerate(replica_weights)}
+app.config['REPLICA_MAX_LAG'] = float(os.environ.get('REPLICA_MAX_LAG', 5))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Password hashing runs on a bounded pool (see passwords.py). Each web
+# process serves WEB_THREADS requests at once (see the Procfile); password
+# work may hold at most half of those threads, and logins/signups past
+# that get a 503 so the other routes keep their threads.
+WEB_THREADS = int(os.environ.get('WEB_THREADS', 8))
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['PASSWORD_POOL_WORKERS'] = int(os.environ.get('PASSWORD_POOL_WORKERS', 2))
+app.config['PASSWORD_POOL_QUEUE'] = int(os.environ.get(
+    'PASSWORD_POOL_QUEUE',
+    max(WEB_THREADS // 2 - app.config['PASSWORD_POOL_WORKERS'], 0)))
+
+# Listings are paged; `?limit=` may ask for fewer/more, up to MAX_PAGE_SIZE.
+app.config['PAGE_SIZE'] = 50
+app.config['MAX_PAGE_SIZE'] = 100
+
+# Big listings are rendered as a stream (see stream_template): rows are
+# fetched STREAM_BATCH_SIZE at a time and the HTML is sent in chunks of
+# about STREAM_BUFFER template pieces.
+app.config['STREAM_BATCH_SIZE'] = 25
+app.config['STREAM_BUFFER'] = 40
+
+# Warble search pages by offset (relevance has no natural cursor), so cap
+# how deep it goes.
+app.config['MAX_SEARCH_PAGES'] = 10
+
+# Pages of timelines/profiles/user listings are cached as id lists (see
+# cache.py); CACHE_BACKEND is 'lru', 'shm', 'redis' or 'null'.
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND', 'lru')
+app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL',
+                                               'redis://localhost:6379/0')
+app.config['CACHE_DEFAULT_TTL'] = 300
+
+# HTTP caching of pages with validators (see "Conditional GET" below):
+# 'public' lets shared caches such as a CDN keep pages for anonymous
+# visitors; 'private' keeps them in browsers only.
+app.config['CACHE_POLICY'] = os.environ.get('CACHE_POLICY', 'private')
+app.config['CACHE_MAX_AGE'] = 0
+
+# Message ids are snowflakes (see snowflake.py); each process needs its own
+# worker id, which is leased from Postgres unless set here.
+app.config['SNOWFLAKE_WORKER_ID'] = (
+    int(os.environ['SNOWFLAKE_WORKER_ID'])
+    if os.environ.get('SNOWFLAKE_WORKER_ID') else None)
+
+# A fraction of requests to profile at random (see profiler.py); others are
+# profiled only when they carry a `flask profile-token` token.
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
+# Text responses are gzipped on the way out (see compression.py).
+app.config['GZIP_LEVEL'] = int(os.environ.get('GZIP_LEVEL', 6))
+
+# Slow side effects of writes are queued for `flask jobs-work` (see
+# jobs.py); with JOBS_EAGER=1 they run in the request instead. The worker's
+# cache invalidations only reach web processes through a shared cache, so
+# with the per-process 'lru' backend jobs run eagerly unless JOBS_EAGER=0.
+app.config['JOBS_EAGER'] = os.environ.get(
+    'JOBS_EAGER', '1' if app.config['CACHE_BACKEND'] == 'lru' else '0') == '1'
+
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+snowflake.init_app(app)
+jobs.init_app(app)
+init_metrics(app)
+profiler.init_app(app)
+password_pool.init_app(app)
+availability.init_app(app)
+username_index.init_app(app)
+message_index.init_app(app)
+cache.init_app(app)
+init_fragments(app)
+assets.init_app(app)
+init_compression(app)
+
+
+##############################################################################
+# Pagination
+
+
+def paginate(query, *keys, key_func=None, stream=False):
+    """Get the page of `query` asked for by ?before=/?after=/?limit=.
+
+    Pages are newest-first on `keys` (see pagination.keyset_page). With
+    `stream`, rows are fetched as the page is iterated (a StreamedPage).
+    """
+
+    limit = request.args.get('limit', app.config['PAGE_SIZE'], type=int)
+    limit = max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+    if stream:
+        return keyset_stream(query, keys, limit,
+                             before=request.args.get('before'),
+                             after=request.args.get('after'),
+                             key_func=key_func,
+                             batch_size=app.config['STREAM_BATCH_SIZE'])
+
+    return keyset_page(query, keys, limit,
+                       before=request.args.get('before'),
+                       after=request.args.get('after'),
+                       key_func=key_func)
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but send the page in chunks as it renders.
+
+    Pair with a StreamedPage so rows are fetched as they're rendered.
+    Flashed messages are read up front, so clearing them makes it into
+    the session cookie before the headers go out.
+    """
+
+    get_flashed_messages()
+    app.update_template_context(context)
+
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(app.config['STREAM_BUFFER'])
+
+    return Response(stream_with_context(timed_render(stream)),
+                    mimetype='text/html')
+
+
+##############################################################################
+# Page cache
+#
+# A cached page is [item ids, older cursor, newer cursor] under a key that
+# includes the owner's generation for that namespace; views hydrate the ids
+# with one primary-key query. Write routes call the invalidate_* helpers.
+
+
+def hydrate(model, ids, options=()):
+    """Rows of `model` with `ids`, in that order (skipping any now gone)."""
+
+    if not ids:
+        return []
+
+    found = {item.id: item for item in (model.query
+                                        .options(*options)
+                                        .filter(model.id.in_(ids)))}
+
+    return [found[id] for id in ids if id in found]
+
+
+def cached_page(namespace, owner_id, model, make_page, options=(),
+                stream=False):
+    """The page asked for by this request, from the cache or `make_page()`.
+
+    With `stream`, make_page() should return a StreamedPage, and a cached
+    page comes back as one too, hydrated a batch at a time. Misses are read
+    from the primary.
+    """
+
+    key = ':'.join(['page', namespace, str(owner_id),
+                    str(cache.generation(namespace, owner_id)),
+                    request.args.get('before', ''),
+                    request.args.get('after', ''),
+                    request.args.get('limit', '')])
+    entry = cache.get(key)
+
+    if entry is None:
+        # a lagging replica could cache a page from before the write that
+        # invalidated it, until it expires
+        db.use_primary()
+        page = make_page()
+
+        if isinstance(page, StreamedPage):
+            ids = []
+            page.add_hooks(
+                on_batch=lambda batch: ids.extend(item.id for item in batch),
+                on_done=lambda page: cache.set(key, [ids, page.older,
+                                                     page.newer]))
+        else:
+            cache.set(key, [[item.id for item in page.items],
+                            page.older, page.newer])
+
+        return page
+
+    ids, older, newer = entry
+
+    if not stream:
+        return Page(hydrate(model, ids, options), older, newer)
+
+    size = app.config['STREAM_BATCH_SIZE']
+    batches = (hydrate(model, ids[start:start + size], options)
+               for start in range(0, len(ids), size))
+
+    return StreamedPage((item for batch in batches for item in batch),
+                        lambda page: (older, newer), size)
+
+
+def invalidate_timelines(author):
+    """`author` deleted a message: their page and followers' feeds change."""
+
+    cache.bump('timeline', author.id, *author.follower_ids())
+    cache.bump('user_messages', author.id)
+
+
+def invalidate_user_listing():
+    """A user joined or left, so /users pages shift."""
+
+    cache.bump('users')
+
+
+##############################################################################
+# Background jobs
+#
+# Side effects of writes that can wait (see jobs.py). Cache invalidation
+# runs once a job's writes are committed. Unless JOBS_EAGER, that's in the
+# worker, so it reaches web processes only through a shared CACHE_BACKEND:
+# 'redis', or 'shm' with the worker on the same host (see JOBS_EAGER's
+# default above).
+
+
+@jobs.task('fan_out', batch=100)
+def fan_out(payloads):
+    """Push new messages onto their authors' followers' timelines."""
+
+    msg_ids = [payload['msg_id'] for payload in payloads]
+    Timeline.fan_out(msg_ids)
+
+    followers = [user_id for (user_id,) in (
+        db.session.query(FollowersFollowee.followee_id)
+        .join(Message, Message.user_id == FollowersFollowee.follower_id)
+        .filter(Message.id.in_(msg_ids))
+        .distinct())]
+
+    if followers:
+        on_commit(cache.bump, 'timeline', *followers)
+
+
+@jobs.task('backfill')
+def backfill(follower_id, followee_id):
+    """Add a newly followed user's messages to their follower's timeline."""
+
+    Timeline.backfill(follower_id, followee_id)
+    on_commit(cache.bump, 'timeline', follower_id)
+
+
+@jobs.task('purge')
+def purge(follower_id, followee_id):
+    """Take an unfollowed user's messages off their ex-follower's timeline."""
+
+    Timeline.purge(follower_id, followee_id)
+    on_commit(cache.bump, 'timeline', follower_id)
+
+
+@jobs.task('reconcile_counts', batch=100)
+def reconcile_counts(payloads):
+    """Recompute counters of users affected by a deletion."""
+
+    User.reconcile_counts({user_id for payload in payloads
+                           for user_id in payload['user_ids']})
+
+
+##############################################################################
+# Conditional GET
+#
+# Views for expensive pages call not_modified() with what the page depends
+# on before doing any work. If the client's copy is still current (its
+# If-None-Match has our ETag, or, for anonymous requests without one,
+# If-Modified-Since is no older than `last_modified`), they return the 304
+# it gives them without querying the rest or rendering anything.
+
+
+def viewer_stamp():
+    """What every page depends on about the current user.
+
+    users.updated_at moves with profile edits and with every counter, so
+    it also changes when they follow, unfollow, post or like something.
+    """
+
+    if not g.user:
+        return None
+
+    return (g.user.id, g.user.updated_at)
+
+
+def not_modified(*depends_on, last_modified=None):
+    """Give this response validators; return a 304 if the client is current.
+
+    Returns None if the page should be rendered as usual.
+    """
+
+    if session.get('_flashes'):
+        # a flashed message makes this render one-off
+        return None
+
+    etag = blake2b(repr((request.full_path, viewer_stamp()) + depends_on)
+                   .encode('utf-8'), digest_size=16).hexdigest()
+    g.validators = (etag, last_modified)
+
+    if request.if_none_match:
+        # weak comparison: the gzip middleware weakens ETags it compresses
+        current = request.if_none_match.contains_weak(etag)
+    elif last_modified and request.if_modified_since and not g.user:
+        since = request.if_modified_since.replace(tzinfo=None)
+        current = last_modified.replace(microsecond=0) <= since
+    else:
+        current = False
+
+    return make_response('', 304) if current else None
+
+
+@app.after_request
+def add_cache_headers(response):
+    """Let pages with validators be cached (and revalidated); not the rest."""
+
+    if request.endpoint in ('static', 'assets'):
+        return response
+
+    validators = g.pop('validators', None)
+    response.vary.add('Cookie')
+
+    if validators is None or response.status_code not in (200, 304):
+        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+        return response
+
+    etag, last_modified = validators
+    response.set_etag(etag)
+
+    if last_modified:
+        response.last_modified = last_modified
+
+    if app.config['CACHE_POLICY'] == 'public' and not g.get('user'):
+        response.headers['Cache-Control'] = (
+            f"public, max-age={app.config['CACHE_MAX_AGE']}")
+    else:
+        response.headers['Cache-Control'] = 'private, no-cache'
+
+    return response
+
+
+##############################################################################
+# Follow state
+#
+# Templates ask `follow_state(user)` to draw Follow/Unfollow buttons. Views
+# prime a per-request cache with every user on the page in one query
+# (load_follow_states) so rendering a list doesn't cost a query per card.
+
+
+def load_follow_states(users):
+    """Fetch the current user's follow state toward `users` into the cache."""
+
+    cache = g.setdefault('follow_states', {})
+
+    if g.user:
+        missing = {user.id for user in users} - cache.keys()
+        cache.update(g.user.follow_states(missing))
+
+
+@app.template_global()
+def follow_state(user):
+    """Current user's FollowState toward `user` (see load_follow_states)."""
+
+    if not g.user:
+        return NOT_FOLLOWING
+
+    cache = g.setdefault('follow_states', {})
+
+    if user.id not in cache:
+        load_follow_states([user])
+
+    return cache[user.id]
 
 
 ##############################################################################
@@ -67,12 +460,21 @@ def signup():
     If form not valid, present form.
 
     If the there already is a user with that username: flash message
-    and re-present form.
+    and re-present form. (Checked before hashing the password, so
+    rejected signups are cheap.)
     """
 
     form = UserAddForm()
 
     if form.validate_on_submit():
+        taken = availability.taken_fields(username=form.data['username'],
+                                          email=form.data['email'])
+
+        if taken:
+            for field in taken:
+                flash(f"{field.capitalize()} already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
             user = User.signup(
                 username=form.data['username'],
@@ -86,6 +488,9 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        availability.add(username=user.username, email=user.email)
+        username_index.add(user.id, user.username)
+        invalidate_user_listing()
         do_login(user)
 
         return redirect("/")
@@ -105,6 +510,9 @@ def login():
                                  password=form.data['password'])
 
         if user:
+            # authenticate may have upgraded an old-cost password hash
+            db.session.commit()
+
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -124,6 +532,35 @@ def logout():
 
     return redirect("/login")
 
+@app.route('/api/username-available')
+def username_available():
+    """JSON for live signup validation: {"username": ..., "available": ...}."""
+
+    username = request.args.get('username', '')
+    # shown to the user, so not left to this process's filter alone
+    available = bool(username) and not availability.is_taken(
+        'username', username, confirm=True)
+
+    return jsonify(username=username, available=available)
+
+
+@app.route('/api/users/autocomplete')
+def users_autocomplete():
+    """JSON list of users whose username starts with ?q=, best match first.
+
+    Answered from the in-memory username index, without a query.
+    """
+
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', 10, type=int)
+    limit = max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+
+    matches = username_index.prefix(query, limit) if query else []
+
+    return jsonify([{'id': user_id, 'username': username}
+                    for user_id, username in matches])
+
+
 ##############################################################################
 # General user routes:
 
@@ -131,17 +568,22 @@ def logout():
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search by that username; search
+    results are the best MAX_PAGE_SIZE matches rather than pages.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        page = cached_page('users', '', User,
+                           lambda: paginate(User.query, User.id, stream=True),
+                           stream=True)
+        page.add_hooks(on_batch=load_follow_states)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page = Page(search_users(search, app.config['MAX_PAGE_SIZE']))
+        load_follow_states(page.items)
 
-    return render_template('users/index.html', users=users)
+    return stream_template('users/index.html', users=page.items, page=page)
 
 
 @app.route('/users/<int:user_id>')
@@ -150,9 +592,21 @@ def users_show(user_id):
 
     user = User.query.get_or_404(user_id)
 
+    # the user's row changes whenever they post or delete (messages_count)
+    unchanged = not_modified('users_show', user.id, user.updated_at,
+                             last_modified=user.updated_at)
+    if unchanged:
+        return unchanged
+
+    page = cached_page('user_messages', user.id, Message,
+                       lambda: paginate(user.messages,
+                                        Message.id, stream=True),
+                       stream=True)
+
     num_of_likes = user.num_of_likes()
 
-    return render_template('users/show.html', user=user, num_of_likes=num_of_likes)
+    return stream_template('users/show.html', user=user, messages=page.items,
+                           page=page, num_of_likes=num_of_likes)
 
 
 @app.route('/users/<int:user_id>/favorites')
@@ -160,11 +614,15 @@ def show_users_favorites(user_id):
     """Show favorites from user."""
 
     user = User.query.get_or_404(user_id)
-    favorite_list = user.favorites.all()
+    page = cached_page('favorites', user.id, Favorite,
+                       lambda: paginate(user.favorites.options(
+                                            *load_profile('favorite_message')),
+                                        Favorite.id),
+                       options=load_profile('favorite_message'))
 
     num_of_likes = user.num_of_likes()
 
-    return render_template('users/favorites.html', user=user, favorite_list=favorite_list, num_of_likes=num_of_likes)
+    return render_template('users/favorites.html', user=user, favorite_list=page.items, page=page, num_of_likes=num_of_likes)
 
 
 
@@ -177,7 +635,12 @@ def show_following(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    page = paginate(user.following, User.id, stream=True)
+    page.add_hooks(on_batch=load_follow_states)
+    load_follow_states([user])
+
+    return stream_template('users/following.html', user=user,
+                           following=page.items, page=page)
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -189,7 +652,12 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    page = paginate(user.followers, User.id, stream=True)
+    page.add_hooks(on_batch=load_follow_states)
+    load_follow_states([user])
+
+    return stream_template('users/followers.html', user=user,
+                           followers=page.items, page=page)
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -202,6 +670,10 @@ def add_follow(follow_id):
 
     followee = User.query.get_or_404(follow_id)
     g.user.following.append(followee)
+    User.adjust_counts(g.user.id, following_count=1)
+    User.adjust_counts(followee.id, followers_count=1)
+    jobs.enqueue('backfill', key=f'backfill:{g.user.id}:{followee.id}',
+                 follower_id=g.user.id, followee_id=followee.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -217,6 +689,10 @@ def stop_following(follow_id):
 
     followee = User.query.get(follow_id)
     g.user.following.remove(followee)
+    User.adjust_counts(g.user.id, following_count=-1)
+    User.adjust_counts(followee.id, followers_count=-1)
+    jobs.enqueue('purge', key=f'purge:{g.user.id}:{followee.id}',
+                 follower_id=g.user.id, followee_id=followee.id)
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -237,14 +713,41 @@ def profile():
 
         if user_auth:
 
+            taken = availability.taken_fields(
+                username=request.form.get('username'),
+                email=request.form.get('email'),
+                exclude_user_id=user.id)
+
+            if taken:
+                for field in taken:
+                    flash(f"{field.capitalize()} already taken", 'danger')
+                return render_template('users/edit.html', user=user, form=form)
+
+            old_username, old_email = user.username, user.email
+
             user.username = request.form.get('username')
             user.email = request.form.get('email')
             user.image_url = request.form.get('image_url')
             user.header_image_url = request.form.get('header_image_url')
             user.bio = request.form.get('bio')
+            user.version += 1
 
             db.session.commit()
 
+            availability.remove(
+                username=old_username if old_username != user.username else None,
+                email=old_email if old_email != user.email else None)
+            availability.add(username=user.username, email=user.email)
+
+            if old_username != user.username:
+                username_index.remove(old_username)
+                username_index.add(user.id, user.username)
+
+            # cached pages hold ids only and fragments are keyed on
+            # user.version, so edits show up without this, but anything
+            # else cached per user is now stale
+            cache.bump('user_messages', user.id)
+
             return redirect(f"/users/{user.id}")
 
     return render_template('users/edit.html',user=user, form=form)
@@ -259,9 +762,33 @@ def delete_user():
 
     do_logout()
 
+    user_id, username, email = g.user.id, g.user.username, g.user.email
+    version = g.user.version
+    dependents = g.user.counter_dependents()
+    followers = g.user.follower_ids()
+    likers = g.user.liker_ids()
+    msg_ids = [msg_id for (msg_id,) in g.user.messages.with_entities(Message.id)]
+
+    Timeline.remove_user(g.user)
     db.session.delete(g.user)
+    db.session.flush()
+    jobs.enqueue('reconcile_counts', user_ids=dependents)
     db.session.commit()
 
+    availability.remove(username=username, email=email)
+    username_index.remove(username)
+    message_index.remove(msg_ids)
+
+    cache.bump('timeline', user_id, *followers)
+    cache.bump('favorites', *likers)
+    cache.bump('user_messages', user_id)
+    invalidate_user_listing()
+
+    # ids can be reused, so don't leave fragments around to be picked up
+    forget_fragments(USER_FRAGMENTS, user_id, version)
+    for msg_id in msg_ids:
+        forget_fragments(MESSAGE_FRAGMENTS, msg_id, version)
+
     return redirect("/signup")
 
 
@@ -284,18 +811,63 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.data['text'])
         g.user.messages.append(msg)
+        db.session.flush()
+        # the author sees it at once; followers once it has fanned out
+        db.session.add(Timeline(user_id=g.user.id, msg_id=msg.id))
+        User.adjust_counts(g.user.id, messages_count=1)
+        jobs.enqueue('fan_out', key=f'fan_out:{msg.id}', msg_id=msg.id)
         db.session.commit()
 
+        message_index.add(msg)
+        cache.bump('timeline', g.user.id)
+        cache.bump('user_messages', g.user.id)
+
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
+@app.route('/messages/search')
+def messages_search():
+    """Full-text search over warbles.
+
+    Takes 'q', 'sort' ('relevance' or 'recent') and 'page' params.
+    """
+
+    query = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'relevance')
+    page = request.args.get('page', 1, type=int)
+    page = max(1, min(page, app.config['MAX_SEARCH_PAGES']))
+    limit = app.config['PAGE_SIZE']
+
+    messages, has_more = [], False
+
+    if query:
+        messages, has_more = search_messages(query, sort, limit,
+                                             offset=(page - 1) * limit)
+
+    return render_template('messages/search.html', query=query, sort=sort,
+                           messages=messages, page=page,
+                           has_more=has_more and page < app.config['MAX_SEARCH_PAGES'])
+
+
 @app.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = (Message
+           .query
+           .options(*load_profile('message_author'))
+           .get_or_404(message_id))
+
+    unchanged = not_modified('messages_show', msg.id, msg.user.updated_at,
+                             last_modified=max(msg.timestamp,
+                                               msg.user.updated_at))
+    if unchanged:
+        return unchanged
+
+    load_follow_states([msg.user])
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -307,10 +879,28 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.get_or_404(message_id)
+
+    if msg.user_id != g.user.id:
+        abort(403)
+
+    author = msg.user
+    version = author.version
+    likers = [user_id for (user_id,) in
+              db.session.query(Favorite.user_id).filter_by(msg_id=msg.id)]
+
+    Timeline.remove_message(msg)
+    User.adjust_counts(msg.user_id, messages_count=-1)
     db.session.delete(msg)
+    db.session.flush()
+    jobs.enqueue('reconcile_counts', user_ids=likers)
     db.session.commit()
 
+    message_index.remove([message_id])
+    invalidate_timelines(author)
+    cache.bump('favorites', *likers)
+    forget_fragments(MESSAGE_FRAGMENTS, message_id, version)
+
     return redirect(f"/users/{g.user.id}")
 
 
@@ -323,10 +913,17 @@ def add_favorite_message(message_id):
         return redirect("/login")
 
     user_id = g.user.id
+
+    if Favorite.ids_for(g.user, [message_id]):
+        return redirect(f"/users/{g.user.id}")
+
     favorite = Favorite(user_id=user_id,msg_id=message_id)
     db.session.add(favorite)
+    User.adjust_counts(user_id, likes_count=1)
     db.session.commit()
 
+    cache.bump('favorites', user_id)
+
     return redirect(f"/users/{g.user.id}")
 
 
@@ -339,14 +936,102 @@ def remove_favorite_message(message_id):
         return redirect("/login")
 
     user_id = g.user.id
-    unfavorite = Favorite.query.filter(Favorite.msg_id==message_id).first()
-    # import pdb; pdb.set_trace()
+    unfavorite = (Favorite.query
+                  .filter(Favorite.user_id==user_id, Favorite.msg_id==message_id)
+                  .first_or_404())
     db.session.delete(unfavorite)
+    User.adjust_counts(user_id, likes_count=-1)
     db.session.commit()
 
+    cache.bump('favorites', user_id)
+
     return redirect("/")
 
 
+##############################################################################
+# Maintenance commands (run with `flask <command>`)
+
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    """Recompute every user's denormalized counters and report drift."""
+
+    repaired = User.reconcile_counts()
+    db.session.commit()
+
+    print(f"Repaired counters for {repaired} user(s).")
+
+
+@app.cli.command('search-reindex')
+def search_reindex():
+    """Rebuild the warble full-text index (e.g. after seeding)."""
+
+    if database_searches():
+        db.session.execute('REINDEX INDEX ix_messages_text_fts')
+        db.session.commit()
+        print("Rebuilt ix_messages_text_fts.")
+
+    elif cache.backend.shared:
+        # each web process keeps its own in-memory index; have them all
+        # rebuild it on their next search
+        cache.bump('message_index')
+        print("Web processes will rebuild their warble indexes on their "
+              "next search.")
+
+    else:
+        raise click.ClickException(
+            "The warble index lives in each web process, and with "
+            f"CACHE_BACKEND {app.config['CACHE_BACKEND']!r} they can't be "
+            "told to rebuild it from here. They rebuild every "
+            "SEARCH_INDEX_REBUILD_SECONDS, and pick up new warbles as they "
+            "search.")
+
+
+@app.cli.command('jobs-work')
+@click.option('--once', is_flag=True, help="Stop once no jobs are due.")
+def jobs_work(once):
+    """Run background jobs (see jobs.py) until stopped."""
+
+    if not cache.backend.shared:
+        # web processes run their own jobs then (JOBS_EAGER's default), so
+        # only ones queued before that are left for us
+        app.logger.warning(
+            "CACHE_BACKEND %r is per process: pages cached by web processes "
+            "won't see changes made by jobs run here until they expire; use "
+            "'redis' (or 'shm' on the same host)", app.config['CACHE_BACKEND'])
+
+    print(f"Ran {jobs.work(once=once)} job(s).")
+
+
+@app.cli.command('profile-token')
+def profile_token():
+    """Print a token that turns on profiling for requests carrying it."""
+
+    print(profiler.make_token())
+    print(f"Send it as an X-Warbler-Profile header or a _profile query "
+          f"parameter; it works for {profiler.token_max_age} seconds.")
+
+
+@app.cli.command('assets-build')
+def assets_build():
+    """Fingerprint and precompress static/ into ASSETS_DIR (see assets.py)."""
+
+    manifest = assets.build(app.static_folder)
+
+    print(f"Built {len(manifest)} asset(s) into {assets.directory}.")
+
+
+##############################################################################
+# Metrics
+
+
+@app.route('/metrics')
+def metrics():
+    """Per-endpoint request, SQL and render metrics, for Prometheus."""
+
+    return metrics_response()
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -356,25 +1041,31 @@ def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followees
+    - logged in: most recent messages of followees (read a page at a time
+      from the user's materialized timeline)
     """
 
     if g.user:
 
-        user = User.query.get(session[CURR_USER_KEY])
-
-        following_ids = [f.id for f in user.following] + [g.user.id]
+        # followees' rows change whenever they post or delete, and ours
+        # (in the ETag already) when we follow or unfollow anyone; the
+        # timeline's generation moves when a job changes it
+        unchanged = not_modified('homepage', g.user.following_updated_at(),
+                                 cache.generation('timeline', g.user.id))
+        if unchanged:
+            return unchanged
 
-        messages = (Message
-                    .query
-                    .order_by(Message.timestamp.desc())
-                    .filter(Message.user_id.in_(following_ids))
-                    .limit(100))
+        page = cached_page('timeline', g.user.id, Message,
+                           lambda: paginate(Timeline.messages_for(g.user)
+                                            .options(*load_profile('message_author')),
+                                            Timeline.msg_id,
+                                            key_func=lambda msg: (msg.id,)),
+                           options=load_profile('message_author'))
+        messages = page.items
 
-        favorites = Favorite.query.all()
-        list_of_favorites = [fav.msg_id for fav in favorites if fav.user_id == g.user.id]
+        list_of_favorites = Favorite.ids_for(g.user, [msg.id for msg in messages])
 
-        return render_template('home.html', messages=messages, favorites=list_of_favorites)
+        return render_template('home.html', messages=messages, page=page, favorites=list_of_favorites)
 
     else:
         return render_template('home-anon.html')
@@ -387,19 +1078,8 @@ def page_not_found(e):
     return render_template('404.html'), 404
 
 
-##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+@app.errorhandler(PasswordPoolBusy)
+def password_pool_busy(e):
+    """503 page when too many logins/signups are already being hashed."""
 
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+    return render_template('503.html'), 503, {'Retry-After': '1'}
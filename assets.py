@@ -0,0 +1,214 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask assets-build` copies everything under static/ to static/dist/ with
+a content hash in its name (stylesheets/style.css ->
+stylesheets/style.1f3e5a9c0b2d.css), writes .gz (and .br, if the `brotli`
+package is installed) next to text files that shrink, rewrites
+url(/static/...) references in CSS to the hashed names, and records the
+mapping in static/dist/manifest.json.
+
+Templates link to assets with static_url('stylesheets/style.css'). With a
+manifest, that's /assets/<hashed name>, served with a one-year `immutable`
+Cache-Control (a changed file gets a new name) and the best precompressed
+variant the client accepts. Files go out through send_file, so gunicorn
+uses sendfile(2), or set USE_X_SENDFILE to hand them to the front-end
+server. Without a manifest (e.g. in development), static_url() falls back
+to plain /static/ URLs.
+"""
+
+import gzip
+import json
+import os
+import re
+from hashlib import blake2b
+from mimetypes import guess_type
+
+from flask import request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = 'manifest.json'
+
+# worth compressing; images are compressed already
+COMPRESSIBLE = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.html',
+                '.map', '.xml'}
+
+CSS_URL_RE = re.compile(r'''url\(\s*(["']?)/static/([^"')]+)\1\s*\)''')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def fingerprint(path, data):
+    """`path` with a hash of `data` before its extension."""
+
+    digest = blake2b(data, digest_size=6).hexdigest()
+    root, ext = os.path.splitext(path)
+
+    return f'{root}.{digest}{ext}'
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def build_assets(static_dir, out_dir, url_path='/assets'):
+    """Fingerprint and precompress everything in `static_dir` into `out_dir`.
+
+    Returns the manifest: {original path: hashed path}, relative to the
+    two directories. Earlier builds' files are left alone, so pages still
+    cached with old names keep working.
+    """
+
+    sources = []
+    out_dir = os.path.abspath(out_dir)
+
+    for root, dirs, files in os.walk(static_dir):
+        # don't build earlier builds
+        dirs[:] = [d for d in dirs
+                   if os.path.abspath(os.path.join(root, d)) != out_dir]
+
+        for name in files:
+            full = os.path.join(root, name)
+            sources.append(os.path.relpath(full, static_dir).replace(os.sep, '/'))
+
+    # CSS last, so the files it refers to already have their hashed names
+    sources.sort(key=lambda path: (path.endswith('.css'), path))
+    manifest = {}
+
+    def rewrite_url(match):
+        target = manifest.get(match.group(2))
+
+        if target is None:
+            return match.group(0)
+
+        return f'url("{url_path}/{target}")'
+
+    for path in sources:
+        with open(os.path.join(static_dir, path), 'rb') as f:
+            data = f.read()
+
+        if path.endswith('.css'):
+            data = CSS_URL_RE.sub(rewrite_url, data.decode('utf-8')).encode('utf-8')
+
+        hashed = fingerprint(path, data)
+        manifest[path] = hashed
+        target = os.path.join(out_dir, hashed)
+        _write(target, data)
+
+        if os.path.splitext(path)[1] not in COMPRESSIBLE:
+            continue
+
+        # mtime=0 so rebuilding the same file gives the same bytes
+        variants = [('.gz', gzip.compress(data, 9, mtime=0))]
+
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(data)))
+
+        for suffix, compressed in variants:
+            if len(compressed) < len(data):
+                _write(target + suffix, compressed)
+
+    _write(os.path.join(out_dir, MANIFEST),
+           json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'))
+
+    return manifest
+
+
+class Assets:
+    """Serves built assets and gives templates static_url()."""
+
+    def __init__(self):
+        self.directory = None
+        self.url_path = '/assets'
+        self.manifest = {}
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_DIR',
+                              os.path.join(app.static_folder, 'dist'))
+        app.config.setdefault('ASSETS_URL_PATH', '/assets')
+
+        self.directory = app.config['ASSETS_DIR']
+        self.url_path = app.config['ASSETS_URL_PATH']
+        self.load()
+
+        app.add_template_global(self.static_url, 'static_url')
+        app.add_url_rule(self.url_path + '/<path:filename>', 'assets',
+                         self.serve)
+
+    def load(self):
+        """(Re)read the manifest written by the last build, if any."""
+
+        try:
+            with open(os.path.join(self.directory, MANIFEST)) as f:
+                self.manifest = json.load(f)
+
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def static_url(self, filename):
+        """URL for a static file, fingerprinted if it has been built.
+
+        Takes a path inside static/ ('images/nav-bg.png') or a /static/ URL
+        (as stored in users.header_image_url); other URLs pass through.
+        """
+
+        if filename is None or '://' in filename:
+            return filename
+
+        if filename.startswith('/'):
+            if not filename.startswith('/static/'):
+                return filename
+
+            filename = filename[len('/static/'):]
+
+        hashed = self.manifest.get(filename)
+
+        if hashed is None:
+            return url_for('static', filename=filename)
+
+        return url_for('assets', filename=hashed)
+
+    def serve(self, filename):
+        """Send a built asset, precompressed if the client accepts it."""
+
+        accepted = request.accept_encodings
+        encoding = None
+
+        for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+            if (accepted[name]
+                    and os.path.isfile(os.path.join(self.directory,
+                                                    filename + suffix))):
+                encoding = suffix, name
+                break
+
+        if encoding is None:
+            response = send_from_directory(self.directory, filename)
+        else:
+            suffix, name = encoding
+            response = send_from_directory(self.directory, filename + suffix)
+            # send_file guessed the type from the .gz/.br name
+            response.mimetype = (guess_type(filename)[0]
+                                 or 'application/octet-stream')
+            response.headers['Content-Encoding'] = name
+
+        response.headers['Cache-Control'] = IMMUTABLE
+        response.vary.add('Accept-Encoding')
+
+        return response
+
+    def build(self, static_dir):
+        """Run a build into this app's ASSETS_DIR and start using it."""
+
+        manifest = build_assets(static_dir, self.directory, self.url_path)
+        self.load()
+
+        return manifest
+
+
+assets = Assets()
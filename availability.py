@@ -0,0 +1,164 @@
+"""Cheap "is this username/email free?" checks.
+
+Signup used to hash the password first and only find a duplicate username
+or email from the IntegrityError on commit. This keeps a Bloom filter of
+every username and email so most checks never touch the database:
+
+- filter says "not present": the value is free (as of this process's
+  last rebuild / insert), answered from memory
+- filter says "maybe present": confirmed with one indexed lookup
+
+The filter is built on first use and rebuilt every
+AVAILABILITY_REBUILD_SECONDS, or sooner once enough users were deleted
+(Bloom filters can't forget). Values taken by other workers since the last
+rebuild can look free here. Signup can live with that (the unique
+constraints still catch them), but answers shown to users pass
+`confirm=True` so a "free" is checked against the database too.
+"""
+
+from hashlib import blake2b
+from math import ceil, log
+from threading import Lock
+from time import monotonic
+
+from metrics import REGISTRY, Counter
+from models import db, User
+
+CHECKS = REGISTRY.register(Counter(
+    'warbler_availability_checks',
+    'Username/email availability checks, by how they were answered.',
+    ['result']))
+
+
+class BloomFilter:
+    """Set membership with no false negatives and a tunable false-positive rate."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+
+        self.num_bits = ceil(-capacity * log(error_rate) / (log(2) ** 2))
+        self.num_hashes = max(1, round(self.num_bits / capacity * log(2)))
+        self.bits = bytearray(ceil(self.num_bits / 8))
+        self.count = 0
+
+    def _positions(self, value):
+        digest = blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        # Kirsch-Mitzenmacher: k positions from two hashes
+        return ((h1 + i * h2) % self.num_bits for i in range(self.num_hashes))
+
+    def add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+        self.count += 1
+
+    def __contains__(self, value):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(value))
+
+
+class AvailabilityIndex:
+    """Bloom filter of taken usernames and emails; see the module docstring."""
+
+    FIELDS = ('username', 'email')
+
+    def __init__(self, rebuild_seconds=3600, error_rate=0.01):
+        self.rebuild_seconds = rebuild_seconds
+        self.error_rate = error_rate
+
+        self._bloom = None
+        self._built_at = None
+        self._removed = 0
+        self._lock = Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('AVAILABILITY_REBUILD_SECONDS', 3600)
+        self.rebuild_seconds = app.config['AVAILABILITY_REBUILD_SECONDS']
+        self._bloom = None
+
+    @staticmethod
+    def _key(field, value):
+        return f'{field}:{value}'
+
+    def rebuild(self):
+        """Reload every username and email from the database."""
+
+        # two values per user, with room for the user count to double
+        # before the next rebuild
+        capacity = 2 * 2 * (User.query.count() + 1000)
+        bloom = BloomFilter(capacity, self.error_rate)
+
+        rows = db.session.query(User.username, User.email).yield_per(10000)
+
+        for username, email in rows:
+            bloom.add(self._key('username', username))
+            bloom.add(self._key('email', email))
+
+        with self._lock:
+            self._bloom = bloom
+            self._built_at = monotonic()
+            self._removed = 0
+
+    def _ensure_built(self):
+        stale = (self._bloom is None
+                 or monotonic() - self._built_at > self.rebuild_seconds
+                 or self._removed > self._bloom.count // 10)
+
+        if stale:
+            self.rebuild()
+
+    def add(self, username=None, email=None):
+        """Record a newly taken username and/or email."""
+
+        if self._bloom is None:
+            return
+
+        with self._lock:
+            for field, value in zip(self.FIELDS, (username, email)):
+                if value:
+                    self._bloom.add(self._key(field, value))
+
+    def remove(self, username=None, email=None):
+        """Note a freed username/email (by a deleted user or profile edit).
+
+        It stays in the filter (costing a database check) until the next
+        rebuild, which happens early if many values were freed.
+        """
+
+        self._removed += sum(1 for value in (username, email) if value)
+
+    def is_taken(self, field, value, exclude_user_id=None, confirm=False):
+        """Does some user (other than `exclude_user_id`) have this `field` value?
+
+        With `confirm`, a "no" from the filter is checked against the
+        database as well, in case another process took the value.
+        """
+
+        self._ensure_built()
+
+        if self._key(field, value) not in self._bloom and not confirm:
+            CHECKS.inc(result='bloom_miss')
+            return False
+
+        query = User.query.filter(getattr(User, field) == value)
+
+        if exclude_user_id is not None:
+            query = query.filter(User.id != exclude_user_id)
+
+        taken = db.session.query(query.exists()).scalar()
+        CHECKS.inc(result='db_hit' if taken else 'db_miss')
+
+        return taken
+
+    def taken_fields(self, username=None, email=None, exclude_user_id=None):
+        """Which of the given username/email are taken? Returns a list of fields."""
+
+        return [field
+                for field, value in zip(self.FIELDS, (username, email))
+                if value and self.is_taken(field, value, exclude_user_id)]
+
+
+availability = AvailabilityIndex()
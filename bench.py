@@ -0,0 +1,525 @@
+"""Benchmarks for Warbler's routes.
+
+Seeds a dataset of the size asked for into a local database, drives each
+route with it and reports latency percentiles, requests/sec and (with the
+in-process driver) SQL queries per request:
+
+    createdb warbler-bench
+    python bench.py --messages 100000 --users 5000 --output before.json
+    ... change things ...
+    python bench.py --no-seed --output after.json --baseline before.json
+
+Drivers:
+
+- client (default): the Flask test client, one request at a time, in
+  this process. Measures the app itself, with query counts.
+- gunicorn: real gunicorn workers (--workers) hit over HTTP by
+  --concurrency threads. Measures what a deployment would see; query
+  counts aren't available.
+
+The dataset comes from generator/create_csvs.py (cached under
+bench_data/, keyed by its sizes and seed) and is loaded with seed.py.
+Results are JSON (--output, or stdout) so runs can be kept and compared.
+The database is BENCH_DATABASE_URL, postgresql:///warbler-bench by
+default; DATABASE_URL is ignored. Seeding drops every table, so it's
+refused unless the database's name contains "bench".
+"""
+
+import argparse
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from math import ceil
+from random import Random
+from time import perf_counter, sleep
+from urllib.parse import urlencode
+
+# BEFORE we import our app, point it at the benchmark database (gunicorn
+# workers import this module too, and get the same one). DATABASE_URL is
+# always replaced, so an inherited one (dev, production) is never seeded.
+
+os.environ['DATABASE_URL'] = os.environ.get('BENCH_DATABASE_URL',
+                                            'postgresql:///warbler-bench')
+
+from app import app, CURR_USER_KEY  # noqa: E402
+from cache import cache  # noqa: E402
+from models import db, User, Message, Favorite  # noqa: E402
+from testing import count_queries  # noqa: E402
+
+# benchmark POSTs don't carry CSRF tokens
+app.config['WTF_CSRF_ENABLED'] = False
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'generator', 'create_csvs.py')
+
+# every generated user's password
+PASSWORD = 'password'
+
+# One benchmark request: `user_id` is who's logged in (None: nobody).
+Request = namedtuple('Request', ['method', 'path', 'form', 'user_id'])
+
+Result = namedtuple('Result', ['seconds', 'status', 'queries'])
+
+
+class Dataset:
+    """Ids and names sampled from the seeded database, to build requests from."""
+
+    def __init__(self, rng, size=2000):
+        user_ids = [id for (id,) in db.session.query(User.id)]
+        self.user_ids = rng.sample(user_ids, min(size, len(user_ids)))
+        self.usernames = [name for (name,) in (db.session
+                                               .query(User.username)
+                                               .filter(User.id.in_(self.user_ids[:200])))]
+
+        # newest messages are the likeliest to be looked at
+        self.message_ids = [id for (id,) in (db.session
+                                             .query(Message.id)
+                                             .order_by(Message.id.desc())
+                                             .limit(size))]
+        self.words = [word
+                      for (text,) in (db.session
+                                      .query(Message.text)
+                                      .filter(Message.id.in_(self.message_ids[:50])))
+                      for word in text.lower().strip('.').split()
+                      if len(word) > 4]
+
+
+def follow_pairs(data, rng, n):
+    """(viewer, target) pairs where the viewer doesn't follow the target yet."""
+
+    pairs = []
+
+    # bounded, in case (nearly) everyone already follows everyone
+    for _ in range(n * 10):
+        if len(pairs) >= n:
+            break
+
+        viewer = User.query.get(rng.choice(data.user_ids))
+        targets = set(rng.sample(data.user_ids, min(10, len(data.user_ids))))
+        targets.discard(viewer.id)
+        states = viewer.follow_states(targets)
+        pairs.extend((viewer.id, target) for target in sorted(targets)
+                     if not states[target].following)
+
+    return pairs[:n]
+
+
+def favorite_pairs(data, rng, n):
+    """(user, message) pairs the user hasn't favorited yet."""
+
+    pairs = []
+
+    for _ in range(n * 10):
+        if len(pairs) >= n:
+            break
+
+        user = User.query.get(rng.choice(data.user_ids))
+        msg_ids = set(rng.sample(data.message_ids, min(10, len(data.message_ids))))
+        msg_ids -= Favorite.ids_for(user, msg_ids)
+        pairs.extend((user.id, msg_id) for msg_id in sorted(msg_ids))
+
+    return pairs[:n]
+
+
+def make_requests(route, data, rng, n, state):
+    """`n` requests for `route`. `state` carries follow/favorite pairs from
+    the follow/favorite runs to the unfollow/unfavorite ones after them."""
+
+    def user():
+        return rng.choice(data.user_ids)
+
+    if route == 'homepage':
+        return [Request('GET', '/', None, user()) for _ in range(n)]
+
+    if route == 'list_users':
+        return [Request('GET', '/users', None, user()) for _ in range(n)]
+
+    if route in ('users_show', 'show_users_favorites', 'show_following',
+                 'users_followers'):
+        suffix = {'users_show': '', 'show_users_favorites': '/favorites',
+                  'show_following': '/following',
+                  'users_followers': '/followers'}[route]
+        return [Request('GET', f'/users/{user()}{suffix}', None, user())
+                for _ in range(n)]
+
+    if route == 'messages_show':
+        return [Request('GET', f'/messages/{rng.choice(data.message_ids)}',
+                        None, user())
+                for _ in range(n)]
+
+    if route == 'messages_search':
+        return [Request('GET', '/messages/search?'
+                        + urlencode({'q': rng.choice(data.words)}), None, user())
+                for _ in range(n)]
+
+    if route == 'username_available':
+        return [Request('GET', '/api/username-available?'
+                        + urlencode({'username': rng.choice(data.usernames)}),
+                        None, None)
+                for _ in range(n)]
+
+    if route == 'users_autocomplete':
+        return [Request('GET', '/api/users/autocomplete?'
+                        + urlencode({'q': rng.choice(data.usernames)[:3]}),
+                        None, None)
+                for _ in range(n)]
+
+    if route == 'login':
+        return [Request('POST', '/login', {'username': rng.choice(data.usernames),
+                                           'password': PASSWORD}, None)
+                for _ in range(n)]
+
+    if route == 'messages_add':
+        return [Request('POST', '/messages/new',
+                        {'text': ' '.join(rng.sample(data.words,
+                                                     min(8, len(data.words))))},
+                        user())
+                for _ in range(n)]
+
+    if route == 'add_follow':
+        state['follows'] = follow_pairs(data, rng, n)
+        return [Request('POST', f'/users/follow/{target}', None, viewer)
+                for viewer, target in state['follows']]
+
+    if route == 'stop_following':
+        return [Request('POST', f'/users/stop-following/{target}', None, viewer)
+                for viewer, target in state.pop('follows', [])]
+
+    if route == 'add_favorite_message':
+        state['favorites'] = favorite_pairs(data, rng, n)
+        return [Request('POST', f'/messages/{msg_id}/favorite', None, user_id)
+                for user_id, msg_id in state['favorites']]
+
+    if route == 'remove_favorite_message':
+        return [Request('POST', f'/messages/{msg_id}/unfavorite', None, user_id)
+                for user_id, msg_id in state.pop('favorites', [])]
+
+    raise ValueError(f'No benchmark for route {route!r}')
+
+
+# in run order: follows and favorites are undone after they're made, so
+# repeated runs see the same graph (messages_add's warbles do pile up)
+ROUTES = [
+    'homepage', 'list_users', 'users_show', 'show_users_favorites',
+    'show_following', 'users_followers', 'messages_show', 'messages_search',
+    'username_available', 'users_autocomplete', 'login', 'messages_add',
+    'add_follow', 'stop_following', 'add_favorite_message',
+    'remove_favorite_message',
+]
+
+UNDO = {'add_follow': 'stop_following',
+        'add_favorite_message': 'remove_favorite_message'}
+
+
+def session_cookie(user_id):
+    """A `Cookie:` header value logging in `user_id`, signed like Flask's own."""
+
+    if user_id is None:
+        return None
+
+    signed = (app.session_interface
+              .get_signing_serializer(app)
+              .dumps({CURR_USER_KEY: user_id}))
+
+    return f"{app.config['SESSION_COOKIE_NAME']}={signed}"
+
+
+class ClientDriver:
+    """Runs requests through the test client, counting each one's queries."""
+
+    name = 'client'
+
+    def __init__(self, args):
+        self.client = app.test_client(use_cookies=False)
+
+    def run(self, requests):
+        results = []
+        started = perf_counter()
+
+        for req in requests:
+            cookie = session_cookie(req.user_id)
+            headers = {'Cookie': cookie} if cookie else {}
+
+            with count_queries() as queries:
+                begun = perf_counter()
+                response = self.client.open(req.path, method=req.method,
+                                            data=req.form, headers=headers)
+                # streamed pages do their work as the body is read
+                response.get_data()
+                seconds = perf_counter() - begun
+
+            results.append(Result(seconds, response.status_code, len(queries)))
+
+        return results, perf_counter() - started
+
+    def close(self):
+        pass
+
+
+class GunicornDriver:
+    """Starts gunicorn on this module's app and sends it HTTP requests."""
+
+    name = 'gunicorn'
+
+    def __init__(self, args):
+        self.concurrency = args.concurrency
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+
+        self.process = subprocess.Popen(
+            ['gunicorn', 'bench:app', '--bind', f'127.0.0.1:{self.port}',
+             '--workers', str(args.workers), '--log-level', 'warning'],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+        for _ in range(300):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 1).close()
+                break
+            except OSError:
+                sleep(.1)
+        else:
+            self.close()
+            raise RuntimeError('gunicorn did not start')
+
+    def send(self, req):
+        headers = {}
+        body = None
+        cookie = session_cookie(req.user_id)
+
+        if cookie:
+            headers['Cookie'] = cookie
+
+        if req.form is not None:
+            body = urlencode(req.form)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+
+        try:
+            begun = perf_counter()
+            conn.request(req.method, req.path, body, headers)
+            response = conn.getresponse()
+            response.read()
+
+            return Result(perf_counter() - begun, response.status, None)
+        finally:
+            conn.close()
+
+    def run(self, requests):
+        started = perf_counter()
+
+        with ThreadPoolExecutor(self.concurrency) as pool:
+            results = list(pool.map(self.send, requests))
+
+        return results, perf_counter() - started
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+DRIVERS = {'client': ClientDriver, 'gunicorn': GunicornDriver}
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of sorted `values`."""
+
+    if not values:
+        return None
+
+    return values[max(0, ceil(pct / 100 * len(values)) - 1)]
+
+
+def summarize(results, elapsed):
+    times = sorted(result.seconds * 1000 for result in results)
+    queries = [result.queries for result in results
+               if result.queries is not None]
+
+    return {
+        'requests': len(results),
+        'requests_per_second': round(len(results) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(times, 50), 2) if times else None,
+        'p95_ms': round(percentile(times, 95), 2) if times else None,
+        'p99_ms': round(percentile(times, 99), 2) if times else None,
+        'mean_ms': round(sum(times) / len(times), 2) if times else None,
+        'queries_per_request': (round(sum(queries) / len(queries), 2)
+                                if queries else None),
+        'statuses': dict(Counter(str(result.status) for result in results)),
+    }
+
+
+def prepare_dataset(args):
+    """Generate (or reuse) the CSVs for the sizes asked for and load them."""
+
+    from seed import seed
+
+    database = db.engine.url.database or ''
+
+    if 'bench' not in database:
+        sys.exit(f"Refusing to seed {database!r}: its name doesn't contain "
+                 "'bench' (set BENCH_DATABASE_URL, or use --no-seed)")
+
+    name = (f'u{args.users}-m{args.messages}-f{args.follows}'
+            f'-l{args.favorites}-k{args.skew}-s{args.seed}')
+    data_dir = os.path.join(args.data_dir, name)
+
+    if not os.path.exists(os.path.join(data_dir, 'favorites.csv')):
+        os.makedirs(data_dir, exist_ok=True)
+        subprocess.run([sys.executable, GENERATOR, '--out', data_dir,
+                        '--users', str(args.users),
+                        '--messages', str(args.messages),
+                        '--follows', str(args.follows),
+                        '--favorites', str(args.favorites),
+                        '--skew', str(args.skew),
+                        '--seed', str(args.seed)],
+                       check=True)
+
+    seed(data_dir=data_dir)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(routes, baseline=None):
+    print(f"{'route':<26}{'req/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+          f"{'queries':>9}  vs baseline p50", file=sys.stderr)
+
+    for route, stats in routes.items():
+        change = ''
+        before = (baseline or {}).get(route)
+
+        if before and before.get('p50_ms') and stats['p50_ms'] is not None:
+            change = f"{(stats['p50_ms'] / before['p50_ms'] - 1) * 100:+.0f}%"
+
+        queries = stats['queries_per_request']
+
+        print(f"{route:<26}{stats['requests_per_second'] or 0:>9.1f}"
+              f"{stats['p50_ms'] or 0:>9.2f}{stats['p95_ms'] or 0:>9.2f}"
+              f"{stats['p99_ms'] or 0:>9.2f}"
+              f"{'-' if queries is None else queries:>9}  {change}",
+              file=sys.stderr)
+
+
+def run(args):
+    """Benchmark the routes in args.routes; returns the results as a dict."""
+
+    if args.seed_data:
+        prepare_dataset(args)
+
+    rng = Random(args.seed)
+    data = Dataset(rng)
+    driver = DRIVERS[args.driver](args)
+    state = {}
+    routes = {}
+
+    try:
+        for route in ROUTES:
+            if route not in args.routes:
+                continue
+
+            cache.clear()
+
+            # warm up on requests of the same shape (but not the same
+            # follows/favorites: those are made once each)
+            if args.warmup and route not in UNDO and route not in UNDO.values():
+                driver.run(make_requests(route, data, rng, args.warmup, {}))
+
+            requests = make_requests(route, data, rng, args.requests, state)
+            results, elapsed = driver.run(requests)
+            routes[route] = summarize(results, elapsed)
+
+            # leave the dataset as we found it, even if only "do" was asked for
+            undo = UNDO.get(route)
+            if undo and undo not in args.routes:
+                driver.run(make_requests(undo, data, rng, 0, state))
+
+    finally:
+        driver.close()
+
+    return {
+        'meta': {
+            'commit': git_commit(),
+            'started': datetime.utcnow().isoformat(timespec='seconds'),
+            'driver': driver.name,
+            'workers': args.workers if driver.name == 'gunicorn' else None,
+            'concurrency': args.concurrency if driver.name == 'gunicorn' else 1,
+            'database': db.engine.dialect.name,
+            'users': User.query.count(),
+            'messages': Message.query.count(),
+            'requests_per_route': args.requests,
+        },
+        'routes': routes,
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--driver', choices=list(DRIVERS), default='client')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES,
+                        metavar='ROUTE', help='routes to run (default: all)')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route (default: 200)')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='unmeasured requests per route first (default: 20)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn workers (default: 4)')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='requests in flight at once with gunicorn '
+                             '(default: 8)')
+
+    dataset = parser.add_argument_group('dataset')
+    dataset.add_argument('--no-seed', dest='seed_data', action='store_false',
+                         help='use the data already in the database')
+    dataset.add_argument('--users', type=int, default=1000)
+    dataset.add_argument('--messages', type=int, default=10000)
+    dataset.add_argument('--follows', type=int, default=20000)
+    dataset.add_argument('--favorites', type=int, default=10000)
+    dataset.add_argument('--skew', type=float, default=3.0,
+                         help='follower/like skew (see generator/create_csvs.py)')
+    dataset.add_argument('--seed', type=int, default=0)
+    dataset.add_argument('--data-dir', default='bench_data',
+                         help='where generated CSVs are kept (default: bench_data)')
+
+    output = parser.add_argument_group('output')
+    output.add_argument('--output', help='write the JSON results here '
+                                         '(default: stdout)')
+    output.add_argument('--baseline', help='an earlier --output to compare with')
+
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run(args)
+    baseline = None
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['routes']
+
+    print_table(results['routes'], baseline)
+    text = json.dumps(results, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
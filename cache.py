@@ -0,0 +1,395 @@
+"""Pluggable cache for Warbler.
+
+Configured by `app.config['CACHE_BACKEND']`:
+
+- 'lru': in-process dict with LRU eviction (CACHE_MAX_ENTRIES); each
+  process has its own, so one process's invalidations aren't seen by others
+- 'shm': fixed-size hash table in a shared-memory file, so every worker on
+  a host shares one cache (CACHE_SHM_PATH, CACHE_SHM_SLOTS,
+  CACHE_SHM_SLOT_SIZE); a new entry evicts whatever shared its slot
+- 'redis': a Redis server, or anything speaking its protocol
+  (CACHE_REDIS_URL)
+- 'null': caching off
+
+Every backend supports a TTL (CACHE_DEFAULT_TTL seconds unless given).
+Values are JSON-encoded compactly, so cache plain data such as lists of ids,
+never ORM objects.
+
+Invalidation is by generation: keys for, e.g., one user's timeline include
+that timeline's generation number, and write routes call `bump()` to move
+to a new generation instead of hunting down every cached page.
+"""
+
+import fcntl
+import json
+import mmap
+import os
+import socket
+import struct
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import Lock, local
+from time import time
+from urllib.parse import urlparse
+from zlib import crc32
+
+from metrics import REGISTRY, Counter
+
+LOOKUPS = REGISTRY.register(Counter(
+    'warbler_cache_lookups',
+    'Cache lookups, by backend and result.',
+    ['backend', 'result']))
+
+
+def dumps(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def loads(data):
+    return json.loads(data.decode('utf-8'))
+
+
+class NullCache:
+    """A cache that never has anything."""
+
+    name = 'null'
+
+    # do other processes see what this one stores (and bumps)?
+    shared = True
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def delete(self, *keys):
+        pass
+
+    def clear(self):
+        pass
+
+
+class LRUCache(NullCache):
+    """In-process cache holding at most `max_entries`, least recently used out."""
+
+    name = 'lru'
+
+    shared = False
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+
+            if entry is None:
+                return None
+
+            expires, data = entry
+
+            if expires < time():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return data
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time() + ttl, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class SharedMemoryCache(NullCache):
+    """Direct-mapped hash table in a memory-mapped file shared by processes.
+
+    Each of `slots` slots is `slot_size` bytes:
+    [expires: double][key length: u16][value length: u32][key][value].
+    A key lives in slot crc32(key) % slots; writing it evicts the slot's
+    previous occupant. Entries too big for a slot aren't cached. Access is
+    serialized with flock() across processes.
+    """
+
+    name = 'shm'
+
+    HEADER = struct.Struct('<dHI')
+
+    def __init__(self, path='/dev/shm/warbler-cache', slots=4096,
+                 slot_size=4096):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+
+        size = slots * slot_size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self._lock = Lock()
+        self._fd = None
+        self._fd_pid = None
+
+    def _offset(self, key):
+        return (crc32(key) % self.slots) * self.slot_size
+
+    def _get_fd(self):
+        # opened lazily, and again after a fork (e.g. gunicorn --preload):
+        # flock belongs to the open file, so processes sharing an inherited
+        # fd wouldn't exclude each other
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR)
+            self._fd_pid = os.getpid()
+
+        return self._fd
+
+    @contextmanager
+    def _locked(self, exclusive):
+        # the thread lock keeps our own threads apart (flock is per open
+        # file, so it only excludes other processes)
+        with self._lock:
+            fd = self._get_fd()
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+            try:
+                yield
+
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+    def get(self, key):
+        key = key.encode('utf-8')
+        offset = self._offset(key)
+
+        with self._locked(exclusive=False):
+            expires, key_len, value_len = self.HEADER.unpack_from(self._map, offset)
+            start = offset + self.HEADER.size
+
+            if (key_len != len(key)
+                    or self._map[start:start + key_len] != key
+                    or expires < time()):
+                return None
+
+            start += key_len
+            return self._map[start:start + value_len]
+
+    def set(self, key, value, ttl):
+        key = key.encode('utf-8')
+
+        if self.HEADER.size + len(key) + len(value) > self.slot_size:
+            return
+
+        offset = self._offset(key)
+        entry = self.HEADER.pack(time() + ttl, len(key), len(value)) + key + value
+
+        with self._locked(exclusive=True):
+            self._map[offset:offset + len(entry)] = entry
+
+    def delete(self, *keys):
+        with self._locked(exclusive=True):
+            for key in keys:
+                key = key.encode('utf-8')
+                offset = self._offset(key)
+                _, key_len, _ = self.HEADER.unpack_from(self._map, offset)
+                start = offset + self.HEADER.size
+
+                if self._map[start:start + key_len] == key:
+                    self.HEADER.pack_into(self._map, offset, 0, 0, 0)
+
+    def clear(self):
+        with self._locked(exclusive=True):
+            self._map[:] = bytes(len(self._map))
+
+
+class RedisCache(NullCache):
+    """Minimal Redis client (GET/SET PX/DEL/FLUSHDB over RESP).
+
+    Any server speaking the Redis protocol works. If the server can't be
+    reached, lookups miss and writes are dropped rather than failing the
+    request.
+    """
+
+    name = 'redis'
+
+    def __init__(self, url='redis://localhost:6379/0', timeout=0.25):
+        parsed = urlparse(url)
+
+        self.address = (parsed.hostname or 'localhost', parsed.port or 6379)
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self._local = local()
+
+    def _connect(self):
+        conn = socket.create_connection(self.address, timeout=self.timeout)
+        self._local.conn = conn
+        self._local.reader = conn.makefile('rb')
+
+        if self.db:
+            self._call(b'SELECT', str(self.db).encode())
+
+        return conn
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+
+        if not line:
+            raise ConnectionError("connection closed")
+
+        kind, rest = line[:1], line[1:-2]
+
+        if kind == b'$':
+            length = int(rest)
+
+            if length < 0:
+                return None
+
+            data = self._local.reader.read(length + 2)
+            return data[:-2]
+
+        if kind == b'-':
+            raise ConnectionError(rest.decode())
+
+        if kind == b':':
+            return int(rest)
+
+        return rest
+
+    def _call(self, *args):
+        conn = getattr(self._local, 'conn', None) or self._connect()
+        command = b'*%d\r\n' % len(args) + b''.join(
+            b'$%d\r\n%s\r\n' % (len(arg), arg) for arg in args)
+
+        conn.sendall(command)
+        return self._read_reply()
+
+    def _try(self, *args):
+        try:
+            return self._call(*args)
+
+        except OSError:
+            self._local.conn = None
+            return None
+
+    def get(self, key):
+        return self._try(b'GET', key.encode('utf-8'))
+
+    def set(self, key, value, ttl):
+        self._try(b'SET', key.encode('utf-8'), value,
+                  b'PX', str(int(ttl * 1000)).encode())
+
+    def delete(self, *keys):
+        if keys:
+            self._try(b'DEL', *[key.encode('utf-8') for key in keys])
+
+    def clear(self):
+        self._try(b'FLUSHDB')
+
+
+class AppCache:
+    """The app's cache: picks a backend from config and handles encoding."""
+
+    def __init__(self):
+        self.backend = NullCache()
+        self.default_ttl = 300
+        self.prefix = 'warbler:'
+
+    def init_app(self, app):
+        app.config.setdefault('CACHE_BACKEND', 'lru')
+        app.config.setdefault('CACHE_DEFAULT_TTL', 300)
+        app.config.setdefault('CACHE_KEY_PREFIX', 'warbler:')
+        app.config.setdefault('CACHE_MAX_ENTRIES', 10000)
+        app.config.setdefault('CACHE_SHM_PATH', '/dev/shm/warbler-cache')
+        app.config.setdefault('CACHE_SHM_SLOTS', 4096)
+        app.config.setdefault('CACHE_SHM_SLOT_SIZE', 4096)
+        app.config.setdefault('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        self.prefix = app.config['CACHE_KEY_PREFIX']
+
+        kind = app.config['CACHE_BACKEND']
+
+        if kind == 'lru':
+            self.backend = LRUCache(app.config['CACHE_MAX_ENTRIES'])
+        elif kind == 'shm':
+            self.backend = SharedMemoryCache(app.config['CACHE_SHM_PATH'],
+                                             app.config['CACHE_SHM_SLOTS'],
+                                             app.config['CACHE_SHM_SLOT_SIZE'])
+        elif kind == 'redis':
+            self.backend = RedisCache(app.config['CACHE_REDIS_URL'])
+        elif kind == 'null':
+            self.backend = NullCache()
+        else:
+            raise ValueError(f"Unknown CACHE_BACKEND {kind!r}")
+
+    def get(self, key):
+        """Cached value for `key`, or None."""
+
+        data = self.backend.get(self.prefix + key)
+        LOOKUPS.inc(backend=self.backend.name,
+                    result='miss' if data is None else 'hit')
+
+        return None if data is None else loads(data)
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(self.prefix + key, dumps(value),
+                         self.default_ttl if ttl is None else ttl)
+
+    def delete(self, *keys):
+        self.backend.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        self.backend.clear()
+
+    def get_or_set(self, key, make, ttl=None):
+        """Cached value for `key`; on a miss, store and return `make()`."""
+
+        value = self.get(key)
+
+        if value is None:
+            value = make()
+            self.set(key, value, ttl)
+
+        return value
+
+    # Generations: `generation('timeline', 5)` is part of every key cached
+    # for user 5's timeline; `bump('timeline', 5, 6)` retires those keys.
+
+    def generation(self, namespace, ident=''):
+        # generations outlive the entries that use them
+        return self.get_or_set(f'gen:{namespace}:{ident}',
+                               lambda: int(time() * 1000),
+                               ttl=self.default_ttl * 10)
+
+    def bump(self, namespace, *idents):
+        """Invalidate everything cached under `namespace` for `idents`."""
+
+        stamp = int(time() * 1000)
+
+        for ident in idents or ('',):
+            current = self.get(f'gen:{namespace}:{ident}') or 0
+            self.set(f'gen:{namespace}:{ident}', max(stamp, current + 1),
+                     ttl=self.default_ttl * 10)
+
+
+cache = AppCache()
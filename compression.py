@@ -0,0 +1,209 @@
+"""Gzip compression of responses, as WSGI middleware.
+
+Compresses text responses (HTML, JSON, CSS, ...) for clients whose
+Accept-Encoding allows gzip. Each chunk the app yields is compressed and
+flushed as it goes, so streamed pages still reach the client piece by
+piece.
+
+Left alone:
+- responses with a Content-Encoding already (e.g. precompressed assets)
+- responses whose Content-Length is under GZIP_MIN_SIZE
+- non-text types, bodiless statuses, HEAD requests, and anything marked
+  Cache-Control: no-transform
+
+Untouched responses go back as the app's own iterable, so send_file's
+wsgi.file_wrapper (and sendfile) still works for them. Compressed
+responses get a weak ETag, since their bytes differ from the original's.
+"""
+
+import zlib
+from time import thread_time
+
+from werkzeug.datastructures import Headers
+
+from metrics import REGISTRY, Counter, Histogram
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml',
+    'text/javascript', 'application/javascript', 'application/json',
+    'application/xml', 'image/svg+xml',
+}
+
+RATIO_BUCKETS = (.05, .1, .2, .3, .4, .5, .6, .7, .8, .9, 1)
+
+CPU_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1)
+
+COMPRESSION_RATIO = REGISTRY.register(Histogram(
+    'warbler_gzip_ratio',
+    'Compressed size / original size of gzipped responses.',
+    buckets=RATIO_BUCKETS))
+
+COMPRESSION_CPU = REGISTRY.register(Histogram(
+    'warbler_gzip_cpu_seconds',
+    'CPU time spent gzipping a response.',
+    buckets=CPU_BUCKETS))
+
+COMPRESSION_BYTES = REGISTRY.register(Counter(
+    'warbler_gzip_bytes',
+    'Bytes through the gzip middleware, before ("in") and after ("out").',
+    ['direction']))
+
+
+def accepts_gzip(accept_encoding):
+    """Does an Accept-Encoding header value allow gzip?"""
+
+    for part in accept_encoding.split(','):
+        coding, _, params = part.strip().partition(';')
+
+        if coding.strip().lower() in ('gzip', '*'):
+            q = params.strip()
+
+            if q.startswith('q='):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+
+            return True
+
+    return False
+
+
+def weaken(etag):
+    """Weak form of an ETag ('"abc"' -> 'W/"abc"')."""
+
+    return etag if etag.startswith('W/') else 'W/' + etag
+
+
+class GzipMiddleware:
+    """Wrap a WSGI app so it gzips its text responses; see the module docstring.
+
+    Expects start_response to be called before the body is iterated, as
+    Flask/Werkzeug do. Data passed to start_response's write() callable
+    (before the app returns) is held and sent ahead of the body, compressed
+    along with it where the response is compressed.
+    """
+
+    def __init__(self, app, level=6, min_size=500):
+        self.app = app
+        self.level = level
+        self.min_size = min_size
+
+    def _should_compress(self, environ, status, headers, mimetype):
+        length = headers.get('Content-Length')
+
+        return (environ.get('REQUEST_METHOD') != 'HEAD'
+                and not status.startswith(('204', '304'))
+                and 'Content-Encoding' not in headers
+                and 'no-transform' not in headers.get('Cache-Control', '')
+                and mimetype in COMPRESSIBLE_TYPES
+                and (length is None or int(length) >= self.min_size))
+
+    def __call__(self, environ, start_response):
+        captured = []
+        written = []
+
+        def capture(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+
+            # the real start_response hasn't been called yet, so hold on
+            # to the data until the body goes out
+            return written.append
+
+        app_iter = self.app(environ, capture)
+        status, headers, exc_info = captured
+
+        if written:
+            app_iter = _prepend(written, app_iter)
+        headers = Headers(headers)
+
+        mimetype = headers.get('Content-Type', '').split(';')[0].strip()
+        vary = ','.join(headers.get_all('Vary')).lower()
+
+        if mimetype in COMPRESSIBLE_TYPES and 'accept-encoding' not in vary:
+            headers.add('Vary', 'Accept-Encoding')
+
+        wants_gzip = accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = headers.get('ETag')
+
+        # a 304 carries the ETag the full (compressed) response would have
+        if wants_gzip and etag and status.startswith('304'):
+            headers['ETag'] = weaken(etag)
+
+        if not (wants_gzip
+                and self._should_compress(environ, status, headers, mimetype)):
+            start_response(status, headers.to_wsgi_list(), exc_info)
+            return app_iter
+
+        headers.remove('Content-Length')
+        headers['Content-Encoding'] = 'gzip'
+
+        if etag:
+            headers['ETag'] = weaken(etag)
+
+        start_response(status, headers.to_wsgi_list(), exc_info)
+
+        return self._compress(app_iter)
+
+    def _compress(self, app_iter):
+        # wbits 16+: gzip header and trailer rather than a bare zlib stream
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        size_in = size_out = 0
+        cpu = 0.0
+
+        try:
+            for chunk in app_iter:
+                if not chunk:
+                    continue
+
+                started = thread_time()
+                # sync-flush so each chunk goes out now, not when the
+                # compressor's buffer fills
+                data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                cpu += thread_time() - started
+
+                size_in += len(chunk)
+                size_out += len(data)
+                yield data
+
+            started = thread_time()
+            data = compressor.flush()
+            cpu += thread_time() - started
+
+            size_out += len(data)
+            yield data
+
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        COMPRESSION_CPU.observe(cpu)
+        COMPRESSION_BYTES.inc(size_in, direction='in')
+        COMPRESSION_BYTES.inc(size_out, direction='out')
+
+        if size_in:
+            COMPRESSION_RATIO.observe(size_out / size_in)
+
+
+def _prepend(chunks, app_iter):
+    try:
+        yield from chunks
+        yield from app_iter
+
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+def init_compression(app):
+    """Gzip `app`'s responses, configured by GZIP_ENABLED/LEVEL/MIN_SIZE."""
+
+    app.config.setdefault('GZIP_ENABLED', True)
+    app.config.setdefault('GZIP_LEVEL', 6)
+    app.config.setdefault('GZIP_MIN_SIZE', 500)
+
+    if app.config['GZIP_ENABLED']:
+        app.wsgi_app = GzipMiddleware(app.wsgi_app,
+                                      level=app.config['GZIP_LEVEL'],
+                                      min_size=app.config['GZIP_MIN_SIZE'])
@@ -0,0 +1,74 @@
+"""Fragment caching for templates.
+
+Wrap markup that looks the same for every viewer in a call block, keyed by
+the thing it shows and that thing's version:
+
+    {% set star %}...this viewer's favorite button...{% endset %}
+    {% call fragment('message-card', msg.id, msg.user.version, star=star) %}
+      ...<a>@{{ msg.user.username }}</a> {{ slot('star') }} <p>{{ msg.text }}</p>...
+    {% endcall %}
+
+On a hit the body isn't rendered at all. Viewer-specific markup is never
+cached: the body marks where it goes with slot(name), and each request's
+value is stitched in on the way out.
+
+Keys include a version (e.g. User.version, bumped on profile edits), so
+edits never need to find old fragments; deleted things are forgotten
+explicitly, since their ids can be reused.
+"""
+
+from markupsafe import Markup
+
+from cache import cache
+
+# fragment kinds that show a single message
+MESSAGE_FRAGMENTS = ('message-card', 'profile-message')
+
+# fragment kinds that show a single user
+USER_FRAGMENTS = ('user-card',)
+
+_ttl = 3600
+
+
+def fragment_key(kind, ident, version):
+    return f'fragment:{kind}:{ident}:{version}'
+
+
+def slot(name):
+    """Mark where viewer-specific markup `name` goes in a fragment."""
+
+    return Markup(f'<!--slot:{name}-->')
+
+
+def fragment(kind, ident, version, caller, **slots):
+    """Cached render of the call block's body, with `slots` filled in."""
+
+    key = fragment_key(kind, ident, version)
+    html = cache.get(key)
+
+    if html is None:
+        html = str(caller())
+        cache.set(key, html, _ttl)
+
+    for name, value in slots.items():
+        html = html.replace(f'<!--slot:{name}-->', str(value))
+
+    return Markup(html)
+
+
+def forget_fragments(kinds, ident, version):
+    """Drop cached fragments of `kinds` for a deleted message/user."""
+
+    cache.delete(*[fragment_key(kind, ident, version) for kind in kinds])
+
+
+def init_fragments(app):
+    """Make fragment() and slot() available to `app`'s templates."""
+
+    global _ttl
+
+    app.config.setdefault('FRAGMENT_CACHE_TTL', 3600)
+    _ttl = app.config['FRAGMENT_CACHE_TTL']
+
+    app.add_template_global(fragment)
+    app.add_template_global(slot)
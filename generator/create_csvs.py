@@ -2,76 +2,243 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for load tests:
+
+    python generator/create_csvs.py --users 100000 --messages 10000000 \\
+        --follows 5000000 --favorites 2000000 --workers 8
+    python seed.py
+
+Rows are made in chunks, in parallel with --workers, and written out as
+they arrive, so memory use doesn't grow with the sizes asked for. Every
+chunk has its own random generator, seeded from --seed and the chunk's
+position, so the same arguments always give the same files, whatever
+the number of workers. Nothing is fetched from the network.
+
+Follows and favorites follow a power law (--skew): a few users have most
+of the followers and a few messages most of the likes. Messages are
+spread evenly over the --days before --until and written oldest first,
+with snowflake ids, so favorites.csv can refer to them.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import io
+import os
+import sys
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
-from helpers import get_random_datetime
+from faker.providers.lorem.en_US import Provider as Lorem
 
-MAX_WARBLER_LENGTH = 140
+from helpers import Shuffle, jitter, pick_distinct, power_law
 
-USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
-MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
-FOLLOWS_CSV_HEADERS = ['followee_id', 'follower_id']
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-NUM_USERS = 300
-NUM_MESSAGES = 1000
-NUM_FOLLWERS = 5000
+from snowflake import id_for, TIME_SHIFT  # noqa: E402
 
-fake = Faker()
+MAX_WARBLER_LENGTH = 140
 
-# Generate random profile image URLs to use for users
+HEADERS = {
+    'users': ['email', 'username', 'image_url', 'password', 'bio',
+              'header_image_url', 'location'],
+    'messages': ['id', 'text', 'timestamp', 'user_id'],
+    'follows': ['followee_id', 'follower_id'],
+    'favorites': ['user_id', 'msg_id'],
+}
 
-image_urls = [
+# every user's password is "password"
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+# profile images are linked to, not downloaded
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    '/static/images/warbler-hero.jpg',
+    '/static/images/signed-out-home.jpg',
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followee, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(followee_id=followee, follower_id=follower))
+# the row number fills the message id's worker and sequence bits, as in seed.py
+ID_SPREAD = (1 << TIME_SHIFT) - 1
+
+
+def message_time(config, n):
+    """When message `n` was posted: evenly spread, jittered, oldest first."""
+
+    step = config.days * 86400 / max(config.messages, 1)
+    start = config.until - timedelta(days=config.days)
+
+    return start + timedelta(seconds=(n + jitter(n)) * step)
+
+
+def message_id(config, n):
+    return id_for(message_time(config, n)) | (n & ID_SPREAD)
+
+
+def make_users(config, start, stop, rng):
+    fake = Faker()
+    fake.seed_instance(rng.getrandbits(32))
+
+    for n in range(start, stop):
+        # the row number keeps usernames (and so emails) unique
+        username = f'{fake.user_name()}{n}'
+
+        yield [f'{username}@{fake.free_email_domain()}',
+               username,
+               rng.choice(IMAGE_URLS),
+               PASSWORD,
+               fake.sentence(),
+               rng.choice(HEADER_IMAGE_URLS),
+               fake.city()]
+
+
+def make_messages(config, start, stop, rng):
+    authors = Shuffle(config.users, config.seed)
+
+    for n in range(start, stop):
+        words = rng.choices(Lorem.word_list, k=rng.randint(4, 24))
+        text = ' '.join(words).capitalize()[:MAX_WARBLER_LENGTH - 1] + '.'
+        author = authors[power_law(rng, config.users, config.skew)] + 1
+
+        yield [message_id(config, n), text, message_time(config, n), author]
+
+
+def make_follows(config, start, stop, rng):
+    """Rows for users start+1..stop; each user's follows are made together,
+    so no pair comes up twice."""
+
+    popular = Shuffle(config.users, config.seed + 1)
+    mean = config.follows / max(config.users, 1)
+
+    for n in range(start, stop):
+        user_id = n + 1
+        k = min(round(rng.expovariate(1 / mean)) if mean else 0,
+                config.users - 1)
+        followed = pick_distinct(
+            rng, k,
+            lambda: popular[power_law(rng, config.users, config.skew)] + 1,
+            exclude=user_id)
+
+        # "A follows B" is stored as followee_id=A, follower_id=B (see
+        # models.Timeline)
+        for other_id in sorted(followed):
+            yield [user_id, other_id]
+
+
+def make_favorites(config, start, stop, rng):
+    """Rows for users start+1..stop, as for follows."""
+
+    liked = Shuffle(config.messages, config.seed + 2)
+    mean = config.favorites / max(config.users, 1)
+
+    for n in range(start, stop):
+        k = min(round(rng.expovariate(1 / mean)) if mean else 0,
+                config.messages)
+        msgs = pick_distinct(
+            rng, k,
+            lambda: liked[power_law(rng, config.messages, config.skew)])
+
+        for msg in sorted(msgs):
+            yield [n + 1, message_id(config, msg)]
+
+
+MAKERS = {
+    'users': make_users,
+    'messages': make_messages,
+    'follows': make_follows,
+    'favorites': make_favorites,
+}
+
+
+def make_chunk(spec):
+    """CSV text for rows start..stop of one file; runs in a worker."""
+
+    config, name, start, stop = spec
+    rng = Random(f'{config.seed}:{name}:{start}')
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    rows = 0
+
+    for row in MAKERS[name](config, start, stop, rng):
+        writer.writerow(row)
+        rows += 1
+
+    return name, buffer.getvalue(), rows
+
+
+def chunk_specs(config):
+    # follows and favorites are made per user
+    totals = {
+        'users': config.users,
+        'messages': config.messages,
+        'follows': config.users if config.follows else 0,
+        'favorites': config.users if config.favorites and config.messages else 0,
+    }
+
+    for name, total in totals.items():
+        for start in range(0, total, config.chunk_size):
+            yield config, name, start, min(start + config.chunk_size, total)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=300)
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--follows', type=int, default=5000,
+                        help='about how many follows to make')
+    parser.add_argument('--favorites', type=int, default=2000,
+                        help='about how many favorites to make')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed (default: 0)')
+    parser.add_argument('--skew', type=float, default=3.0,
+                        help='how lopsided follows/likes are; 1 is uniform '
+                             '(default: 3)')
+    parser.add_argument('--days', type=int, default=730,
+                        help='days of messages (default: 730)')
+    parser.add_argument('--until', type=datetime.fromisoformat,
+                        default=datetime(2019, 1, 1),
+                        help='when the last message was posted '
+                             '(default: 2019-01-01)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes to generate with (default: one per CPU)')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='rows (or users, for follows/favorites) per chunk')
+    parser.add_argument('--out', default='generator',
+                        help='directory to write the CSVs to (default: generator)')
+    config = parser.parse_args(argv)
+
+    files = {name: open(os.path.join(config.out, f'{name}.csv'), 'w',
+                        newline='')
+             for name in HEADERS}
+    counts = dict.fromkeys(HEADERS, 0)
+
+    try:
+        for name, f in files.items():
+            csv.writer(f).writerow(HEADERS[name])
+
+        with Pool(config.workers) as pool:
+            # imap keeps the chunks in order, so output doesn't depend on
+            # which worker finishes first
+            for name, text, rows in pool.imap(make_chunk, chunk_specs(config)):
+                files[name].write(text)
+                counts[name] += rows
+
+                print(f'{name}: {counts[name]:,} rows', end='\r',
+                      file=sys.stderr, flush=True)
+
+    finally:
+        for f in files.values():
+            f.close()
+
+    print(', '.join(f'{name}: {rows:,}' for name, rows in counts.items()),
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,65 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+from math import gcd
 
+# the golden ratio's fractional part: multiples of it are spread evenly
+# over [0, 1), which makes a cheap, repeatable per-row jitter
+GOLDEN = 0.6180339887498949
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
 
-    now = datetime.now()
-    then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+def power_law(rng, n, skew):
+    """A random rank in [0, n), with low ranks far likelier than high ones.
 
-    return datetime.fromtimestamp(random_timestamp)
+    The chance of rank r falls off roughly as r ** (1 / skew - 1), so a few
+    ranks get most of the picks, like followers or likes on a real site.
+    skew=1 is uniform.
+    """
+
+    return int(n * rng.random() ** skew)
+
+
+class Shuffle:
+    """A fixed shuffle of range(n), without storing it.
+
+    shuffle[rank] maps ranks onto ids with an affine bijection, so the
+    "popular" ranks from power_law() land on scattered ids rather than
+    the first ones.
+    """
+
+    def __init__(self, n, seed):
+        self.n = max(n, 1)
+        self.offset = seed % self.n
+        self.step = int(self.n * GOLDEN) | 1
+
+        while gcd(self.step, self.n) != 1:
+            self.step += 2
+
+    def __getitem__(self, rank):
+        return (rank * self.step + self.offset) % self.n
+
+
+def jitter(n):
+    """A repeatable fraction in [0, 1) for row `n`."""
+
+    return (n * GOLDEN) % 1
+
+
+def pick_distinct(rng, k, pick, exclude=None, tries=10):
+    """Up to `k` distinct values from calling `pick()`, never `exclude`.
+
+    Gives up after k * tries picks, so asking for nearly every value of a
+    skewed distribution returns fewer rather than running forever.
+    """
+
+    picked = set()
+
+    for _ in range(k * tries):
+        if len(picked) == k:
+            break
+
+        value = pick()
+
+        if value != exclude:
+            picked.add(value)
+
+    return picked
@@ -0,0 +1,241 @@
+"""A database-backed queue for the slow side effects of writes.
+
+A view enqueues jobs in the same transaction as its write, so a job exists
+only if the write committed:
+
+    jobs.enqueue('fan_out', key=f'fan_out:{msg.id}', msg_id=msg.id)
+    db.session.commit()
+
+and `flask jobs-work` processes (the Procfile's worker) run them. Tasks are
+registered with @jobs.task(name). A task with `batch` gets up to that many
+jobs' payloads in one call, so e.g. many new messages fan out in one query.
+Otherwise each job's payload is passed as keyword arguments.
+
+- A key makes enqueueing idempotent: while a job with that key is waiting
+  or running, enqueueing it again does nothing.
+- Each run commits the task's writes and the jobs' removal together. A task
+  that raises is tried up to JOBS_MAX_ATTEMPTS times, JOBS_RETRY_DELAY
+  seconds apart and doubling each time, then kept as 'failed'. If a batch fails,
+  its jobs are retried one at a time, so one bad job can't hold up the rest.
+- Jobs left 'running' for JOBS_TIMEOUT seconds (their worker died) are
+  picked up again. Tasks should be safe to run twice.
+- Work to do once the task's writes are in (e.g. cache invalidation) goes
+  in on_commit().
+
+With JOBS_EAGER, jobs run inside enqueue() instead. app.py turns it on
+by default when the cache is per process, where the worker's cache
+invalidations couldn't reach the web processes.
+The warbler_jobs_queued and warbler_jobs_failed gauges count the jobs in
+the table when /metrics is scraped.
+"""
+
+import signal
+import traceback
+from datetime import datetime, timedelta
+from itertools import groupby
+from time import sleep
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import IntegrityError
+
+from metrics import REGISTRY, Gauge
+from models import db, Job, RoutingSession
+
+JOBS_QUEUED = REGISTRY.register(Gauge(
+    'warbler_jobs_queued',
+    'Background jobs waiting or running.',
+    func=lambda: Job.query.filter(Job.status != 'failed').count()))
+
+JOBS_FAILED = REGISTRY.register(Gauge(
+    'warbler_jobs_failed',
+    'Background jobs that ran out of attempts.',
+    func=lambda: Job.query.filter_by(status='failed').count()))
+
+
+def on_commit(func, *args):
+    """Call `func(*args)` once the session's transaction commits.
+
+    Dropped if it rolls back instead.
+    """
+
+    db.session.info.setdefault('on_commit', []).append((func, args))
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _run_on_commit(session):
+    for func, args in session.info.pop('on_commit', ()):
+        func(*args)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _drop_on_commit(session):
+    session.info.pop('on_commit', None)
+
+
+class JobQueue:
+    """Registered tasks, and the workers' loop that runs their jobs."""
+
+    def __init__(self):
+        self.tasks = {}
+        self._stopping = False
+
+    def init_app(self, app):
+        app.config.setdefault('JOBS_EAGER', False)
+        app.config.setdefault('JOBS_BATCH_SIZE', 100)
+        app.config.setdefault('JOBS_MAX_ATTEMPTS', 5)
+        app.config.setdefault('JOBS_RETRY_DELAY', 10)
+        app.config.setdefault('JOBS_TIMEOUT', 300)
+        app.config.setdefault('JOBS_POLL_INTERVAL', 1)
+
+    def task(self, name, batch=None):
+        """Register the decorated function as the task called `name`."""
+
+        def register(func):
+            self.tasks[name] = (func, batch)
+            return func
+
+        return register
+
+    def enqueue(self, name, key=None, **payload):
+        """Queue a `name` job, unless one with `key` is already queued."""
+
+        if name not in self.tasks:
+            raise ValueError(f"No task called {name!r}")
+
+        if current_app.config['JOBS_EAGER']:
+            self._call(name, [payload])
+            return
+
+        job = Job(kind=name, key=key, payload=payload)
+
+        if key is None:
+            db.session.add(job)
+            return
+
+        try:
+            # a savepoint, so a duplicate key doesn't undo the caller's work
+            with db.session.begin_nested():
+                db.session.add(job)
+        except IntegrityError:
+            pass
+
+    def _call(self, name, payloads):
+        func, batch = self.tasks[name]
+
+        if batch:
+            func(payloads)
+        else:
+            for payload in payloads:
+                func(**payload)
+
+    def claim(self, limit):
+        """Mark up to `limit` due jobs as running, oldest first; returns them."""
+
+        config = current_app.config
+        now = datetime.utcnow()
+        stale = now - timedelta(seconds=config['JOBS_TIMEOUT'])
+
+        jobs = (Job.query
+                .filter(db.or_(db.and_(Job.status == 'pending',
+                                       Job.run_at <= now),
+                               db.and_(Job.status == 'running',
+                                       Job.locked_at < stale)))
+                .order_by(Job.id)
+                .limit(limit)
+                # other workers skip these rather than wait for them
+                .with_for_update(skip_locked=True)
+                .all())
+
+        for job in jobs:
+            job.status = 'running'
+            job.locked_at = now
+            job.attempts += 1
+
+        db.session.commit()
+
+        return jobs
+
+    def run(self, jobs):
+        """Run claimed `jobs`, a batch per task where the task allows."""
+
+        jobs = sorted(jobs, key=lambda job: (job.kind, job.id))
+
+        for name, group in groupby(jobs, key=lambda job: job.kind):
+            group = list(group)
+            size = self.tasks[name][1] or 1
+
+            for start in range(0, len(group), size):
+                self._run_batch(name, group[start:start + size])
+
+    def _run_batch(self, name, jobs):
+        ids = [job.id for job in jobs]
+        payloads = [job.payload for job in jobs]
+
+        try:
+            self._call(name, payloads)
+            Job.query.filter(Job.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+
+            if len(jobs) > 1:
+                for job in jobs:
+                    self._run_batch(name, [job])
+                return
+
+            current_app.logger.exception("Job %s (%s) failed", ids[0], name)
+            self._retry_later(jobs[0], traceback.format_exc())
+
+    def _retry_later(self, job, error):
+        config = current_app.config
+        job.error = error
+
+        if job.attempts >= config['JOBS_MAX_ATTEMPTS']:
+            job.status = 'failed'
+            # so the same work can be queued again
+            job.key = None
+        else:
+            job.status = 'pending'
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=config['JOBS_RETRY_DELAY'] * 2 ** (job.attempts - 1))
+
+        db.session.commit()
+
+    def work(self, once=False):
+        """Run jobs as they come; with `once`, until there are none due.
+
+        Returns how many jobs were claimed. SIGTERM/SIGINT stop it between
+        batches.
+        """
+
+        config = current_app.config
+        self._stopping = False
+
+        def stop(signum, frame):
+            self._stopping = True
+
+        handlers = {signum: signal.signal(signum, stop)
+                    for signum in (signal.SIGTERM, signal.SIGINT)}
+        claimed = 0
+
+        try:
+            while not self._stopping:
+                jobs = self.claim(config['JOBS_BATCH_SIZE'])
+
+                if jobs:
+                    self.run(jobs)
+                    claimed += len(jobs)
+                elif once:
+                    break
+                else:
+                    sleep(config['JOBS_POLL_INTERVAL'])
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+        return claimed
+
+
+jobs = JobQueue()
@@ -0,0 +1,359 @@
+"""Always-on request metrics for Warbler, exposed in Prometheus text format.
+
+For every request we record total latency, time spent in SQL, number of SQL
+statements and template render time, per endpoint. A request that runs the
+same SQL statement many times is counted (and logged) as an N+1 suspect.
+
+Metrics live in this process only; with several gunicorn workers, each
+worker's /metrics shows its own numbers (scrape each, or sum them).
+"""
+
+from collections import Counter as _Tally
+from threading import Lock
+from time import perf_counter
+
+from flask import Response, has_request_context, request
+from flask.signals import before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# seconds
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+# SQL statements per request
+QUERY_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# where a request's RequestStats are kept: the environ (unlike `g`) is still
+# there while a streamed response's body is generated
+ENVIRON_KEY = 'warbler.request_stats'
+
+
+def _escape(value):
+    return (str(value)
+            .replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in labels) + '}'
+
+
+class Metric:
+    """Base class: a named family of values, one per set of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def _labels(self, key, **extra):
+        return list(zip(self.labelnames, key)) + list(extra.items())
+
+    def samples(self):
+        """Yield (suffix, labels, value) for every sample of this metric."""
+
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}',
+                 f'# TYPE {self.name} {self.kind}']
+
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(labels)} {value}')
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self._values.items()):
+            yield '_total', self._labels(key), value
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    Pass `func` to read the value at scrape time instead of calling set().
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.func is not None:
+            yield '', [], self.func()
+            return
+
+        for key, value in sorted(self._values.items()):
+            yield '', self._labels(key), value
+
+
+class Histogram(Metric):
+    """Counts of observations falling into cumulative `le` buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            counts, total, observed = self._values.get(key) or (
+                [0] * len(self.buckets), 0, 0)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            self._values[key] = (counts, total + value, observed + 1)
+
+    def count(self, **labels):
+        return self._values.get(self._key(labels), (None, 0, 0))[2]
+
+    def total(self, **labels):
+        return self._values.get(self._key(labels), (None, 0, 0))[1]
+
+    def samples(self):
+        for key, (counts, total, observed) in sorted(self._values.items()):
+            for bound, count in zip(self.buckets, counts):
+                yield '_bucket', self._labels(key, le=bound), count
+
+            yield '_bucket', self._labels(key, le='+Inf'), observed
+            yield '_sum', self._labels(key), total
+            yield '_count', self._labels(key), observed
+
+
+class Registry:
+    """The set of metrics served by /metrics."""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Add `metric`, or return the one already registered under its name."""
+
+        return self._metrics.setdefault(metric.name, metric)
+
+    def get(self, name):
+        return self._metrics[name]
+
+    def render(self):
+        return '\n'.join(metric.render()
+                         for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_LATENCY = REGISTRY.register(Histogram(
+    'warbler_request_duration_seconds',
+    'Total time to handle a request.',
+    ['endpoint']))
+
+REQUEST_DB_TIME = REGISTRY.register(Histogram(
+    'warbler_request_db_seconds',
+    'Time spent executing SQL while handling a request.',
+    ['endpoint']))
+
+REQUEST_RENDER_TIME = REGISTRY.register(Histogram(
+    'warbler_request_render_seconds',
+    'Time spent rendering templates while handling a request.',
+    ['endpoint']))
+
+REQUEST_QUERIES = REGISTRY.register(Histogram(
+    'warbler_request_queries',
+    'Number of SQL statements run while handling a request.',
+    ['endpoint'],
+    buckets=QUERY_BUCKETS))
+
+REQUESTS = REGISTRY.register(Counter(
+    'warbler_requests',
+    'Requests handled.',
+    ['endpoint', 'method', 'status']))
+
+N_PLUS_ONE_SUSPECTS = REGISTRY.register(Counter(
+    'warbler_n_plus_one_suspects',
+    'Requests that ran one SQL statement at least METRICS_N_PLUS_ONE_THRESHOLD times.',
+    ['endpoint']))
+
+
+class RequestStats:
+    """What one request has spent so far; lives in the WSGI environ."""
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.render_time = 0.0
+        self.statements = _Tally()
+        self._render_started = None
+
+
+def _current_stats():
+    if has_request_context():
+        return request.environ.get(ENVIRON_KEY)
+
+    return None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    if _current_stats() is not None:
+        conn.info.setdefault('query_started', []).append(perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    stats = _current_stats()
+
+    if stats is not None and conn.info.get('query_started'):
+        stats.db_time += perf_counter() - conn.info['query_started'].pop()
+        stats.queries += 1
+        stats.statements[statement] += 1
+
+
+def _before_render(app, template, context, **extra):
+    stats = _current_stats()
+
+    if stats is not None:
+        stats._render_started = perf_counter()
+
+
+def _after_render(app, template, context, **extra):
+    stats = _current_stats()
+
+    if stats is not None and stats._render_started is not None:
+        stats.render_time += perf_counter() - stats._render_started
+        stats._render_started = None
+
+
+def timed_render(chunks):
+    """Wrap a streamed template's `chunks`, timing them as render time.
+
+    Template.stream() doesn't send Flask's render signals, so streamed
+    pages are timed here instead.
+    """
+
+    stats = _current_stats()
+
+    def timed(chunks):
+        chunks = iter(chunks)
+
+        while True:
+            started = perf_counter()
+            chunk = next(chunks, None)
+
+            if stats is not None:
+                stats.render_time += perf_counter() - started
+
+            if chunk is None:
+                return
+
+            yield chunk
+
+    return timed(chunks)
+
+
+def init_metrics(app):
+    """Start recording request metrics for `app`.
+
+    SQL is timed for every engine (so extra binds are covered too), but only
+    inside a request.
+    """
+
+    app.config.setdefault('METRICS_N_PLUS_ONE_THRESHOLD', 5)
+
+    if not event.contains(Engine, 'before_cursor_execute',
+                          _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+
+    @app.before_request
+    def start_request_stats():
+        request.environ[ENVIRON_KEY] = RequestStats()
+
+    def record(stats, endpoint, method, status):
+        REQUEST_LATENCY.observe(perf_counter() - stats.started,
+                                endpoint=endpoint)
+        REQUEST_DB_TIME.observe(stats.db_time, endpoint=endpoint)
+        REQUEST_RENDER_TIME.observe(stats.render_time, endpoint=endpoint)
+        REQUEST_QUERIES.observe(stats.queries, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, method=method, status=status)
+
+        threshold = app.config['METRICS_N_PLUS_ONE_THRESHOLD']
+        repeated = [(statement, times)
+                    for statement, times in stats.statements.items()
+                    if times >= threshold]
+
+        if repeated:
+            N_PLUS_ONE_SUSPECTS.inc(endpoint=endpoint)
+
+            for statement, times in repeated:
+                app.logger.warning("Possible N+1 in %s: ran %d times: %s",
+                                   endpoint, times, statement)
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = request.environ.get(ENVIRON_KEY)
+
+        if stats is None:
+            return response
+
+        args = (stats, request.endpoint or 'unknown', request.method,
+                response.status_code)
+
+        if response.is_streamed:
+            # the body (and its queries) is still to come: leave the stats
+            # in place to collect them, and record once it's all sent
+            response.call_on_close(lambda: record(*args))
+        else:
+            del request.environ[ENVIRON_KEY]
+            record(*args)
+
+        return response
+
+
+def metrics_response():
+    """The body of /metrics."""
+
+    return Response(REGISTRY.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
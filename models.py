@@ -1,12 +1,205 @@
 """SQLAlchemy models for Warbler."""
 
+import random
+from collections import namedtuple
 from datetime import datetime
+from threading import Lock
+from time import monotonic, time
 
+from flask import request, session
 from flask_bcrypt import Bcrypt
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import DDL, event, orm
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.sql.elements import TextClause
+
+from metrics import REGISTRY, Counter
+from passwords import password_pool
+from snowflake import snowflake
+
+
+##############################################################################
+# Read replicas
+#
+# Replicas are binds in SQLALCHEMY_BINDS, named with their weights in
+# SQLALCHEMY_REPLICAS ({bind: weight}). Each GET/HEAD request picks one
+# (weighted at random, among those less than REPLICA_MAX_LAG seconds
+# behind) and the session reads from it; everything else uses the primary:
+#
+# - other requests, CLI commands and anything outside a request;
+# - writes, and every read after one in the same request or session;
+# - the browser that made a write, for REPLICA_STICKY_SECONDS afterwards
+#   (a marker in its session cookie), so it sees its own changes;
+# - a request that called db.use_primary().
+
+# Flask session key: read from the primary until this time
+PRIMARY_UNTIL_KEY = '_primary_until'
+
+# replicas' lag, measured on the replica itself; 0 when it has replayed
+# everything it has received
+REPLICA_LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery()
+             OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+"""
+
+REPLICA_READS = REGISTRY.register(Counter(
+    'warbler_replica_reads',
+    'Read-only requests, by the bind they read from ("primary" if no '
+    'replica was fit).',
+    ['bind']))
+
+
+class Replicas:
+    """An app's replica binds: their weights and how far behind they are."""
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self.weights = app.config['SQLALCHEMY_REPLICAS']
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.check_interval = app.config['REPLICA_LAG_CHECK_INTERVAL']
+
+        self._lags = {}
+        self._lock = Lock()
+
+    def measure_lag(self, bind):
+        """Seconds `bind` is behind the primary; infinite if it's down."""
+
+        engine = self.db.get_engine(self.app, bind=bind)
+
+        if engine.dialect.name != 'postgresql':
+            return 0.0
+
+        try:
+            with engine.connect() as conn:
+                return float(conn.scalar(REPLICA_LAG_SQL) or 0)
+        except DBAPIError:
+            self.app.logger.warning("Replica %s is unreachable", bind,
+                                    exc_info=True)
+            return float('inf')
+
+    def lag(self, bind):
+        """`bind`'s lag, measured at most every REPLICA_LAG_CHECK_INTERVAL."""
+
+        with self._lock:
+            checked, lag = self._lags.get(bind, (None, 0.0))
+            due = checked is None or monotonic() - checked >= self.check_interval
+
+            if due:
+                # claim the check, so concurrent requests use the old value
+                self._lags[bind] = (monotonic(), lag)
+
+        if due:
+            lag = self.measure_lag(bind)
+            self._lags[bind] = (monotonic(), lag)
+
+        return lag
+
+    def choose(self):
+        """A replica to read from, or None if none is fit."""
+
+        fit = [(bind, weight) for bind, weight in self.weights.items()
+               if weight > 0 and self.lag(bind) <= self.max_lag]
+
+        if not fit:
+            return None
+
+        binds, weights = zip(*fit)
+
+        return random.choices(binds, weights)[0]
+
+
+class RoutingSession(SignallingSession):
+    """A session that reads from the replica in info['replica'], if any.
+
+    Anything that writes (a flush, INSERT/UPDATE/DELETE, raw SQL) goes to
+    the primary, and so does every read after it.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        writing = (self._flushing
+                   or isinstance(clause, (UpdateBase, TextClause)))
+
+        if writing:
+            self.info['wrote'] = True
+            self.info.pop('replica', None)
+
+        replica = self.info.get('replica')
+        table = getattr(mapper, 'local_table', None)
+
+        # models with their own __bind_key__ aren't replicated
+        if replica is None or getattr(table, 'info', {}).get('bind_key'):
+            return super().get_bind(mapper, clause)
+
+        return self.db.get_engine(self.app, bind=replica)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions send read-only requests to replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def init_app(self, app):
+        app.config.setdefault('SQLALCHEMY_REPLICAS', {})
+        app.config.setdefault('REPLICA_MAX_LAG', 5)
+        app.config.setdefault('REPLICA_LAG_CHECK_INTERVAL', 1)
+        app.config.setdefault('REPLICA_STICKY_SECONDS',
+                              app.config['REPLICA_MAX_LAG'])
+
+        super().init_app(app)
+
+        app.extensions['replicas'] = Replicas(self, app)
+        app.before_request(self._route_reads)
+        app.after_request(self._stick_to_primary)
+
+    def use_primary(self):
+        """Read from the primary for the rest of this request."""
+
+        self.session.info.pop('replica', None)
+
+    def _route_reads(self):
+        info = self.session.info
+        info.pop('replica', None)
+        info.pop('wrote', None)
+
+        replicas = self.get_app().extensions['replicas']
+
+        if (not replicas.weights or request.method not in ('GET', 'HEAD')
+                or session.get(PRIMARY_UNTIL_KEY, 0) > time()):
+            return
+
+        replica = replicas.choose()
+        REPLICA_READS.inc(bind=replica or 'primary')
+
+        if replica:
+            info['replica'] = replica
+
+    def _stick_to_primary(self, response):
+        app = self.get_app()
+
+        if app.config['SQLALCHEMY_REPLICAS'] and self.session.info.get('wrote'):
+            session[PRIMARY_UNTIL_KEY] = (time()
+                                          + app.config['REPLICA_STICKY_SECONDS'])
+
+        return response
+
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
+
+# How one user relates to another: does the viewer follow them, and do
+# they follow the viewer back?
+FollowState = namedtuple('FollowState', ['following', 'followed_by'])
+NOT_FOLLOWING = FollowState(False, False)
 
 
 class FollowersFollowee(db.Model):
@@ -26,6 +219,13 @@ class FollowersFollowee(db.Model):
         primary_key=True,
     )
 
+    # the primary key covers one direction of the relationship; this covers
+    # the other, so both followers and following pages are index scans
+    __table_args__ = (
+        db.Index('ix_follows_follower_id_followee_id',
+                 'follower_id', 'followee_id'),
+    )
+
 
 class User(db.Model):
     """User in the system."""
@@ -75,9 +275,63 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', backref='user', lazy='dynamic')
+    # Denormalized counters, kept in step by the write routes (see
+    # adjust_counts) so profile pages don't run four COUNT(*)s. If they
+    # ever drift, `flask reconcile-counters` recomputes them.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
 
-    favorites = db.relationship('Favorite', backref='user', lazy='dynamic')
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever the profile is edited; cached template fragments
+    # showing this user are keyed on it (see fragments.py).
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # When this row last changed (profile edits and counter updates alike);
+    # the Last-Modified of pages that show the user.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+    )
+
+    # passive_deletes: let the database's ON DELETE CASCADE remove a deleted
+    # user's rows instead of the ORM trying to null out their user_id
+    messages = db.relationship('Message', backref='user', lazy='dynamic',
+                               passive_deletes=True)
+
+    favorites = db.relationship('Favorite', backref='user', lazy='dynamic',
+                                passive_deletes=True)
 
 
     followers = db.relationship(
@@ -101,14 +355,45 @@ class User(db.Model):
 
         return bool(self.following.filter_by(id=other_user.id).first())
 
+    def follow_states(self, user_ids):
+        """Get this user's FollowState toward each of `user_ids`, in one query.
+
+        Returns {user_id: FollowState}; every requested id has an entry.
+        """
+
+        user_ids = set(user_ids)
+        states = {user_id: NOT_FOLLOWING for user_id in user_ids}
+
+        if not user_ids:
+            return states
+
+        # "A follows B" is stored as follows(followee_id=A, follower_id=B);
+        # see the note on Timeline.
+        rows = FollowersFollowee.query.filter(db.or_(
+            db.and_(FollowersFollowee.followee_id == self.id,
+                    FollowersFollowee.follower_id.in_(user_ids)),
+            db.and_(FollowersFollowee.follower_id == self.id,
+                    FollowersFollowee.followee_id.in_(user_ids)),
+        ))
+
+        for row in rows:
+            if row.followee_id == self.id:
+                other, field = row.follower_id, 'following'
+            else:
+                other, field = row.followee_id, 'followed_by'
+
+            states[other] = states[other]._replace(**{field: True})
+
+        return states
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
 
-        Hashes password and adds user to system.
+        Hashes password (on the password pool) and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = password_pool.hash(password)
 
         user = User(
             username=username,
@@ -129,15 +414,20 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        If the stored hash was made with an old cost factor, it is replaced
+        with a fresh one (the caller commits).
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
-            # import pdb; pdb.set_trace()   
+            is_auth = password_pool.check(user.password, password)
 
             if is_auth:
+                if password_pool.needs_rehash(user.password):
+                    user.password = password_pool.hash(password)
+
                 return user
 
         return False
@@ -145,9 +435,99 @@ class User(db.Model):
     def num_of_likes(self):
         """Get num of likes for specific user"""
 
-        num_of_likes = self.favorites.count()
-        
-        return num_of_likes
+        return self.likes_count
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Add `deltas` to a user's counters, e.g. adjust_counts(1, likes_count=1).
+
+        Done as `SET col = col + delta` in the current transaction, so
+        concurrent writes can't lose an update.
+        """
+
+        (cls.query
+            .filter_by(id=user_id)
+            .update({getattr(cls, name): getattr(cls, name) + delta
+                     for name, delta in deltas.items()},
+                    synchronize_session=False))
+
+    @classmethod
+    def counter_queries(cls):
+        """Map each counter column to a correlated subquery that recomputes it."""
+
+        def count(*criteria):
+            return db.select([db.func.count()]).where(db.and_(*criteria)).as_scalar()
+
+        # "A follows B" is stored as follows(followee_id=A, follower_id=B);
+        # see the note on Timeline.
+        return {
+            cls.messages_count: count(Message.user_id == cls.id),
+            cls.following_count: count(FollowersFollowee.followee_id == cls.id),
+            cls.followers_count: count(FollowersFollowee.follower_id == cls.id),
+            cls.likes_count: count(Favorite.user_id == cls.id),
+        }
+
+    def counter_dependents(self):
+        """Ids of other users whose counters would change if this user went.
+
+        That is: everyone they follow, everyone following them, and everyone
+        who liked one of their messages.
+        """
+
+        following = (db.session.query(FollowersFollowee.follower_id)
+                     .filter(FollowersFollowee.followee_id == self.id))
+        followers = (db.session.query(FollowersFollowee.followee_id)
+                     .filter(FollowersFollowee.follower_id == self.id))
+        likers = (db.session.query(Favorite.user_id)
+                  .join(Message, Message.id == Favorite.msg_id)
+                  .filter(Message.user_id == self.id))
+
+        return [user_id for (user_id,) in following.union(followers, likers)
+                if user_id != self.id]
+
+    def follower_ids(self):
+        """Ids of everyone following this user (see the note on Timeline)."""
+
+        return [user_id for (user_id,) in (db.session
+                                           .query(FollowersFollowee.followee_id)
+                                           .filter(FollowersFollowee.follower_id
+                                                   == self.id))]
+
+    def following_updated_at(self):
+        """Latest updated_at among the users this user follows (or None)."""
+
+        return (db.session
+                .query(db.func.max(User.updated_at))
+                .join(FollowersFollowee, FollowersFollowee.follower_id == User.id)
+                .filter(FollowersFollowee.followee_id == self.id)
+                .scalar())
+
+    def liker_ids(self):
+        """Ids of everyone who liked one of this user's messages."""
+
+        return [user_id for (user_id,) in (db.session
+                                           .query(Favorite.user_id)
+                                           .join(Message,
+                                                 Message.id == Favorite.msg_id)
+                                           .filter(Message.user_id == self.id)
+                                           .distinct())]
+
+    @classmethod
+    def reconcile_counts(cls, user_ids=None):
+        """Recompute counters that have drifted, for `user_ids` (or everyone).
+
+        Returns the number of users that were repaired.
+        """
+
+        counts = cls.counter_queries()
+
+        query = cls.query.filter(db.or_(*[col != subquery
+                                          for col, subquery in counts.items()]))
+
+        if user_ids is not None:
+            query = query.filter(cls.id.in_(user_ids))
+
+        return query.update(counts, synchronize_session=False)
 
 
 class Message(db.Model):
@@ -155,9 +535,13 @@ class Message(db.Model):
 
     __tablename__ = 'messages'
 
+    # a snowflake (see snowflake.py): made without asking the database,
+    # and newer messages always have bigger ids
     id = db.Column(
-        db.Integer,
+        db.BigInteger,
         primary_key=True,
+        autoincrement=False,
+        default=snowflake.next_id,
     )
 
     text = db.Column(
@@ -168,7 +552,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -177,6 +561,159 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # a user's messages, newest first: profile pages read this in order
+    __table_args__ = (
+        db.Index('ix_messages_user_id_id', user_id, id.desc()),
+    )
+
+
+class Timeline(db.Model):
+    """Materialized home timeline: one row per message in a user's feed.
+
+    Rows are fanned out when a message is written (and backfilled/purged on
+    follow/unfollow), so the homepage reads an already-sorted slice of this
+    table instead of scanning `messages` for everyone the user follows.
+    """
+
+    __tablename__ = 'timelines'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='CASCADE'),
+        primary_key=True,
+    )
+
+    # message ids are time-ordered, so the primary key (user_id, msg_id)
+    # is also the feed's newest-first index
+    msg_id = db.Column(
+        db.BigInteger,
+        db.ForeignKey('messages.id', ondelete='CASCADE'),
+        primary_key=True,
+        index=True,
+    )
+
+    # NOTE: the User.followers relationship stores "A follows B" as
+    # follows(followee_id=A, follower_id=B), so the columns read backwards.
+
+    # Fan-out, backfill and purge run as background jobs (see jobs.py), so
+    # they may run late, twice or out of order: each skips rows already
+    # there and checks that the follow it acts on still holds (or doesn't).
+
+    @classmethod
+    def _missing(cls, user_id):
+        return ~db.exists().where(db.and_(cls.user_id == user_id,
+                                          cls.msg_id == Message.id))
+
+    @classmethod
+    def fan_out(cls, msg_ids):
+        """Push the messages `msg_ids` onto their authors' followers' timelines.
+
+        Authors' own timelines get their messages when they're posted.
+        """
+
+        followers = (db.session
+                     .query(FollowersFollowee.followee_id, Message.id)
+                     .join(Message,
+                           Message.user_id == FollowersFollowee.follower_id)
+                     .filter(Message.id.in_(msg_ids),
+                             FollowersFollowee.followee_id
+                             != FollowersFollowee.follower_id,
+                             cls._missing(FollowersFollowee.followee_id)))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(['user_id', 'msg_id'],
+                                               followers))
+
+    @classmethod
+    def backfill(cls, follower_id, followee_id):
+        """Add all of `followee_id`'s messages to `follower_id`'s timeline,
+        if they still follow them."""
+
+        if follower_id == followee_id:
+            return
+
+        following = db.exists().where(db.and_(
+            FollowersFollowee.followee_id == follower_id,
+            FollowersFollowee.follower_id == followee_id))
+
+        messages = (db.session
+                    .query(db.literal(follower_id), Message.id)
+                    .filter(Message.user_id == followee_id,
+                            following,
+                            cls._missing(follower_id)))
+
+        db.session.execute(
+            cls.__table__.insert().from_select(['user_id', 'msg_id'],
+                                               messages))
+
+    @classmethod
+    def purge(cls, follower_id, followee_id):
+        """Remove all of `followee_id`'s messages from `follower_id`'s
+        timeline, unless they've followed them again."""
+
+        if follower_id == followee_id:
+            return
+
+        if (FollowersFollowee.query
+                .filter_by(followee_id=follower_id, follower_id=followee_id)
+                .first()):
+            return
+
+        msg_ids = db.session.query(Message.id).filter(
+            Message.user_id == followee_id)
+
+        (cls.query
+            .filter(cls.user_id == follower_id, cls.msg_id.in_(msg_ids))
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def remove_message(cls, message):
+        """Remove `message` from every timeline it was fanned out to."""
+
+        cls.query.filter_by(msg_id=message.id).delete(synchronize_session=False)
+
+    @classmethod
+    def remove_user(cls, user):
+        """Remove `user`'s own timeline and their messages from all others."""
+
+        msg_ids = db.session.query(Message.id).filter(Message.user_id == user.id)
+
+        (cls.query
+            .filter(db.or_(cls.user_id == user.id, cls.msg_id.in_(msg_ids)))
+            .delete(synchronize_session=False))
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every timeline from `messages` and `follows` (for seeding)."""
+
+        cls.query.delete()
+
+        own = db.session.query(Message.user_id, Message.id)
+        followed = (db.session
+                    .query(FollowersFollowee.followee_id, Message.id)
+                    .join(Message,
+                          Message.user_id == FollowersFollowee.follower_id)
+                    .filter(FollowersFollowee.followee_id
+                            != FollowersFollowee.follower_id))
+
+        for rows in (own, followed):
+            db.session.execute(
+                cls.__table__.insert().from_select(['user_id', 'msg_id'],
+                                                   rows))
+
+    @classmethod
+    def messages_for(cls, user):
+        """Messages on `user`'s home timeline.
+
+        Unordered: page through it newest-first on msg_id.
+        """
+
+        return (Message
+                .query
+                .join(cls, cls.msg_id == Message.id)
+                .filter(cls.user_id == user.id))
+
+
 class Favorite(db.Model):
     """Maps a users id to their favorite message (id) """
 
@@ -195,16 +732,110 @@ class Favorite(db.Model):
     )
 
     msg_id = db.Column(
-        db.Integer,
+        db.BigInteger,
         db.ForeignKey('messages.id', ondelete='CASCADE'),
         nullable=False,
         # primary_key=True
     )
 
-    # FIXME: learn how to have a "multi-column unique constraint"
+    __table_args__ = (
+        # a user can favorite a message once; this index also answers
+        # "which of these messages has this user favorited?"
+        db.UniqueConstraint('user_id', 'msg_id',
+                            name='uq_favorites_user_id_msg_id'),
+        db.Index('ix_favorites_user_id_id', 'user_id', 'id'),
+    )
 
     # FIXME: "message"
-    messages = db.relationship('Message', backref='favorites')
+    messages = db.relationship(
+        'Message', backref=db.backref('favorites', passive_deletes=True))
+
+    @classmethod
+    def ids_for(cls, user, msg_ids):
+        """Which of `msg_ids` has `user` favorited? Returns a set of ids.
+
+        Only looks at this user's favorites among the given messages, so
+        it's one index lookup no matter how big the favorites table gets.
+        """
+
+        msg_ids = list(msg_ids)
+
+        if user is None or not msg_ids:
+            return set()
+
+        rows = (db.session
+                .query(cls.msg_id)
+                .filter(cls.user_id == user.id, cls.msg_id.in_(msg_ids)))
+
+        return {msg_id for (msg_id,) in rows}
+
+
+class Job(db.Model):
+    """A background job waiting to run, running or failed (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # the task's name
+    kind = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    payload = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # while a job with a key is queued, queueing the same key does nothing
+    key = db.Column(
+        db.Text,
+        unique=True,
+    )
+
+    # 'pending', 'running' or 'failed' (done jobs are deleted)
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default='pending',
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    # the traceback of the last failed attempt
+    error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    # workers look for due pending jobs, and stale running ones
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
 
 
 # might need to change name below to do conflict from table name
@@ -225,6 +856,75 @@ class Favorite(db.Model):
 #         )
 
 
+# On Postgres, index usernames by trigram so case-insensitive substring
+# search (search.search_users) doesn't scan the whole users table. Skipped
+# (search still works, unindexed) where the pg_trgm extension isn't
+# available, or isn't installed and our role may not install it. Then a
+# superuser runs `CREATE EXTENSION pg_trgm`, and the index is made the next
+# time this runs (create_all on a fresh database, or seed.py).
+
+USERNAME_TRGM_INDEX = DDL("""
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM pg_available_extensions
+                   WHERE name = 'pg_trgm') THEN
+            BEGIN
+                CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            EXCEPTION WHEN insufficient_privilege THEN
+                RAISE NOTICE 'pg_trgm not installed; skipping '
+                             'ix_users_username_trgm';
+            END;
+        END IF;
+
+        IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+            CREATE INDEX ix_users_username_trgm ON users
+                USING gin (username gin_trgm_ops);
+        END IF;
+    END $$
+""").execute_if(dialect='postgresql')
+
+event.listen(User.__table__, 'after_create', USERNAME_TRGM_INDEX)
+
+# On Postgres, index message text for full-text search (search.search_messages
+# must use the same to_tsvector() expression for the index to apply).
+
+MESSAGE_FTS_INDEX = DDL(
+    "CREATE INDEX ix_messages_text_fts ON messages "
+    "USING gin (to_tsvector('english', text))").execute_if(dialect='postgresql')
+
+event.listen(Message.__table__, 'after_create', MESSAGE_FTS_INDEX)
+
+# Indexes made by raw DDL above, by table: {table name: [(index name, DDL)]}.
+# seed.py drops and rebuilds these around bulk loads, like table.indexes.
+DDL_INDEXES = {
+    'users': [('ix_users_username_trgm', USERNAME_TRGM_INDEX)],
+    'messages': [('ix_messages_text_fts', MESSAGE_FTS_INDEX)],
+}
+
+
+# Named eager-loading profiles. Each view applies the one matching what its
+# template touches, e.g. `query.options(*load_profile('message_author'))`,
+# so rendering a list never falls back to a lazy-load query per row.
+
+def load_profile(name):
+    """Get the loader options for the loading profile called `name`."""
+
+    # built on call: backrefs like Message.user don't exist until the
+    # mappers are configured
+    profiles = {
+        # message cards that show the author's name/avatar
+        'message_author': [
+            db.joinedload(Message.user),
+        ],
+        # a user's favorites list: favorite -> message -> author
+        'favorite_message': [
+            db.joinedload(Favorite.messages).joinedload(Message.user),
+        ],
+    }
+
+    return profiles[name]
+
+
 def connect_db(app):
     """Connect this database to provided Flask app.
 
@@ -0,0 +1,266 @@
+"""Keyset ("cursor") pagination for Warbler listings.
+
+Instead of OFFSET, each page remembers the sort key of its first and last
+rows; the next page asks for rows strictly before/after that key, so every
+page is a bounded range scan of an index no matter how deep you go.
+
+StreamedPage is the same page fetched lazily, a batch at a time, for
+templates that are streamed (see stream_template in app.py).
+"""
+
+from collections import deque
+from datetime import datetime
+from itertools import islice
+
+from models import db
+
+CURSOR_SEP = '_'
+
+
+class Page:
+    """One page of results plus the cursors to get to its neighbours.
+
+    `older` / `newer` are cursor strings (or None if there is no such page).
+    """
+
+    def __init__(self, items, older=None, newer=None):
+        self.items = items
+        self.older = older
+        self.newer = newer
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def encode_cursor(values):
+    """Turn a tuple of sort-key values into a URL-safe cursor string."""
+
+    return CURSOR_SEP.join(
+        v.isoformat() if isinstance(v, datetime) else str(v) for v in values)
+
+
+def decode_cursor(cursor, keys):
+    """Turn a cursor string back into sort-key values for `keys`.
+
+    Returns None for a malformed cursor, so a bad link just shows page one.
+    """
+
+    parts = cursor.split(CURSOR_SEP)
+
+    if len(parts) != len(keys):
+        return None
+
+    try:
+        return tuple(
+            datetime.fromisoformat(part)
+            if key.type.python_type is datetime else key.type.python_type(part)
+            for part, key in zip(parts, keys))
+
+    except (ValueError, NotImplementedError):
+        return None
+
+
+def _seek(keys, values, older):
+    """Build `(k1, k2, ...) < (v1, v2, ...)` (or `>`), expanded so any
+    database can use a composite index for it."""
+
+    clauses = []
+
+    for i, (key, value) in enumerate(zip(keys, values)):
+        bound = key < value if older else key > value
+        clauses.append(db.and_(*[k == v for k, v in zip(keys[:i], values)],
+                               bound))
+
+    return db.or_(*clauses)
+
+
+class StreamedPage:
+    """A Page whose items are fetched as they're iterated, `batch_size` at a time.
+
+    `older` / `newer` are only known once every item has been fetched;
+    reading them early fetches (and holds on to) the rest. Templates draw
+    the pager after the list, so normally nothing is held.
+
+    `cursors` is a callable(page) -> (older, newer), run once the items
+    run out; `page.first` / `page.last` are the first and last items.
+    """
+
+    def __init__(self, items, cursors, batch_size=100):
+        self.batch_size = batch_size
+        self.first = self.last = None
+
+        self._items = iter(items)
+        self._cursors = cursors
+        self._on_batch = []
+        self._on_done = []
+        self._buffer = deque()
+        self._done = False
+        self._older = self._newer = None
+
+    def add_hooks(self, on_batch=None, on_done=None):
+        """Call on_batch(items) with each batch before it's iterated (e.g.
+        to load follow states for it in one query) and on_done(page) once
+        the items run out."""
+
+        if on_batch:
+            self._on_batch.append(on_batch)
+        if on_done:
+            self._on_done.append(on_done)
+
+    def _fill(self):
+        batch = list(islice(self._items, self.batch_size))
+
+        if batch:
+            if self.first is None:
+                self.first = batch[0]
+            self.last = batch[-1]
+
+            for hook in self._on_batch:
+                hook(batch)
+
+            self._buffer.extend(batch)
+
+        if len(batch) < self.batch_size:
+            self._done = True
+            self._older, self._newer = self._cursors(self)
+
+            for hook in self._on_done:
+                hook(self)
+
+    @property
+    def items(self):
+        return self
+
+    def __iter__(self):
+        while True:
+            if not self._buffer:
+                if self._done:
+                    return
+                self._fill()
+                continue
+
+            yield self._buffer.popleft()
+
+    def __bool__(self):
+        if not self._buffer and not self._done:
+            self._fill()
+
+        return bool(self._buffer) or self.first is not None
+
+    def _drain(self):
+        while not self._done:
+            self._fill()
+
+    @property
+    def older(self):
+        self._drain()
+        return self._older
+
+    @property
+    def newer(self):
+        self._drain()
+        return self._newer
+
+
+def _keyset_query(query, keys, before, after):
+    """`query` narrowed and ordered for the page asked for.
+
+    Returns (query, cursor values or None, whether we're going newer).
+    """
+
+    cursor = after or before
+    values = decode_cursor(cursor, keys) if cursor else None
+    going_newer = values is not None and after is not None
+
+    if values is not None:
+        query = query.filter(_seek(keys, values, older=not going_newer))
+
+    if going_newer:
+        query = query.order_by(*[k.asc() for k in keys])
+    else:
+        query = query.order_by(*[k.desc() for k in keys])
+
+    return query, values, going_newer
+
+
+def _cursors(first, last, has_more, values, going_newer, key_func):
+    if first is None:
+        return None, None
+
+    more_older = has_more if not going_newer else True
+    more_newer = has_more if going_newer else values is not None
+
+    return (encode_cursor(key_func(last)) if more_older else None,
+            encode_cursor(key_func(first)) if more_newer else None)
+
+
+def _default_key_func(keys):
+    def key_func(item):
+        return tuple(getattr(item, k.key) for k in keys)
+
+    return key_func
+
+
+def keyset_page(query, keys, limit, before=None, after=None, key_func=None):
+    """Fetch one newest-first page of `query`, ordered by `keys` descending.
+
+    - keys: columns that uniquely order the rows, e.g. (timestamp, id)
+    - before: cursor; return rows older than it
+    - after: cursor; return rows newer than it (used by "newer" links)
+    - key_func: item -> tuple of key values; defaults to reading each
+      key's attribute name off the item
+    """
+
+    key_func = key_func or _default_key_func(keys)
+    query, values, going_newer = _keyset_query(query, keys, before, after)
+
+    items = query.limit(limit + 1).all()
+    has_more = len(items) > limit
+    items = items[:limit]
+
+    if going_newer:
+        items.reverse()
+
+    if not items:
+        return Page(items)
+
+    older, newer = _cursors(items[0], items[-1], has_more, values,
+                            going_newer, key_func)
+
+    return Page(items, older=older, newer=newer)
+
+
+def keyset_stream(query, keys, limit, before=None, after=None, key_func=None,
+                  batch_size=100):
+    """Like keyset_page, but returns a StreamedPage read with yield_per.
+
+    Pages going newer come back in ascending order and have to be
+    reversed, so those are read all at once.
+    """
+
+    key_func = key_func or _default_key_func(keys)
+    query, values, going_newer = _keyset_query(query, keys, before, after)
+    query = query.limit(limit + 1)
+    state = {'has_more': False}
+
+    def rows():
+        if going_newer:
+            items = query.all()
+            state['has_more'] = len(items) > limit
+            yield from reversed(items[:limit])
+            return
+
+        for i, item in enumerate(query.yield_per(batch_size)):
+            if i == limit:
+                state['has_more'] = True
+                return
+            yield item
+
+    def cursors(page):
+        return _cursors(page.first, page.last, state['has_more'], values,
+                        going_newer, key_func)
+
+    return StreamedPage(rows(), cursors, batch_size)
@@ -0,0 +1,167 @@
+"""Bcrypt hashing/checking on a bounded worker pool.
+
+Hashing a password takes a large, deliberate amount of CPU. Doing it on the
+request thread lets a burst of logins starve every other route, so password
+work goes to a small pool instead:
+
+- at most PASSWORD_POOL_WORKERS hashes run at once (0 = run inline)
+- at most PASSWORD_POOL_QUEUE more may wait for a worker; past that, or
+  after waiting PASSWORD_POOL_TIMEOUT seconds for a slot, PasswordPoolBusy
+  is raised (app.py turns it into a 503)
+- PASSWORD_POOL_KIND picks 'thread' (bcrypt releases the GIL) or 'process'
+- BCRYPT_LOG_ROUNDS sets the cost; hashes made with another cost report
+  needs_rehash() so login can upgrade them
+
+The bound is per process, and the request waits for its job. It only
+protects other routes if each process serves more requests at once than
+the pool admits: the Procfile runs gunicorn's gthread workers with
+WEB_THREADS threads, and app.py sizes the pool to half of them. Under
+sync workers (one request per process) the pool can never fill.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from time import perf_counter
+
+from flask_bcrypt import check_password_hash, generate_password_hash
+
+from metrics import REGISTRY, Counter, Gauge, Histogram
+
+DEFAULT_ROUNDS = 12
+
+
+class PasswordPoolBusy(Exception):
+    """Raised when the password pool is saturated; try again later."""
+
+
+def _hash(password, rounds):
+    return generate_password_hash(password, rounds).decode('UTF-8')
+
+
+def _check(pw_hash, password):
+    return check_password_hash(pw_hash, password)
+
+
+def hash_rounds(pw_hash):
+    """Read the cost factor out of a bcrypt hash ("$2b$12$...") or None."""
+
+    try:
+        return int(pw_hash.split('$')[2])
+
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+
+class PasswordPool:
+    """Runs bcrypt on a bounded pool of workers; see the module docstring."""
+
+    def __init__(self):
+        self.workers = 2
+        self.queue_size = 2
+        self.timeout = 0.5
+        self.kind = 'thread'
+        self.rounds = DEFAULT_ROUNDS
+
+        self._executor = None
+        self._executor_pid = None
+        self._slots = BoundedSemaphore(self.workers + self.queue_size)
+        self._lock = Lock()
+        self._in_flight = 0
+
+        self.wait_time = REGISTRY.register(Histogram(
+            'warbler_password_pool_wait_seconds',
+            'Time password jobs waited for a free slot in the pool.'))
+        self.work_time = REGISTRY.register(Histogram(
+            'warbler_password_pool_job_seconds',
+            'Time to run a password hash/check, including queueing.',
+            ['op']))
+        self.rejected = REGISTRY.register(Counter(
+            'warbler_password_pool_rejected',
+            'Password jobs refused because the pool was saturated.'))
+        REGISTRY.register(Gauge(
+            'warbler_password_pool_in_flight',
+            'Password jobs running or queued right now.',
+            func=lambda: self._in_flight))
+
+    def init_app(self, app):
+        """Configure the pool from `app.config`."""
+
+        app.config.setdefault('PASSWORD_POOL_WORKERS', 2)
+        app.config.setdefault('PASSWORD_POOL_QUEUE', 2)
+        app.config.setdefault('PASSWORD_POOL_TIMEOUT', 0.5)
+        app.config.setdefault('PASSWORD_POOL_KIND', 'thread')
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', DEFAULT_ROUNDS)
+
+        self.workers = app.config['PASSWORD_POOL_WORKERS']
+        self.queue_size = app.config['PASSWORD_POOL_QUEUE']
+        self.timeout = app.config['PASSWORD_POOL_TIMEOUT']
+        self.kind = app.config['PASSWORD_POOL_KIND']
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+        self.shutdown()
+        self._slots = BoundedSemaphore(self.workers + self.queue_size)
+
+    def shutdown(self):
+        """Stop the workers (they're restarted on next use)."""
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self):
+        # created lazily, and again after a fork (e.g. gunicorn --preload),
+        # since worker threads/processes don't survive fork
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                pool = (ProcessPoolExecutor if self.kind == 'process'
+                        else ThreadPoolExecutor)
+                self._executor = pool(max_workers=self.workers)
+                self._executor_pid = os.getpid()
+
+            return self._executor
+
+    def _run(self, op, fn, *args):
+        started = perf_counter()
+
+        if not self.workers:
+            result = fn(*args)
+            self.work_time.observe(perf_counter() - started, op=op)
+            return result
+
+        if not self._slots.acquire(timeout=self.timeout):
+            self.rejected.inc()
+            raise PasswordPoolBusy()
+
+        self.wait_time.observe(perf_counter() - started)
+
+        with self._lock:
+            self._in_flight += 1
+
+        try:
+            return self._get_executor().submit(fn, *args).result()
+
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+            self._slots.release()
+            self.work_time.observe(perf_counter() - started, op=op)
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        return self._run('hash', _hash, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        """Does `password` match `pw_hash`?"""
+
+        return self._run('check', _check, pw_hash, password)
+
+    def needs_rehash(self, pw_hash):
+        """Was `pw_hash` made with a different cost than we use now?"""
+
+        return hash_rounds(pw_hash) != self.rounds
+
+
+password_pool = PasswordPool()
@@ -0,0 +1,333 @@
+"""On-demand sampling profiler for requests.
+
+A request is profiled when it carries a valid token, in the
+X-Warbler-Profile header or the _profile query parameter (make one with
+`flask profile-token`), or when it's picked at random: PROFILE_SAMPLE_RATE
+of requests (default 0).
+
+While a profiled request runs, from before_request until its response
+has been sent (so template streaming counts), a background thread looks
+at the request thread's stack every PROFILE_INTERVAL seconds. Other
+requests pay nothing beyond checking for the token. Each capture is
+written to PROFILE_DIR/<endpoint>/ as:
+
+- <name>.folded: collapsed stacks ("frame;frame;frame count" lines), for
+  flamegraph.pl or https://www.speedscope.app
+- <name>.pstats: the same samples as pstats data, for
+  `python -m pstats` or snakeviz (times are sample counts x interval)
+
+Only the newest PROFILE_KEEP captures per endpoint are kept. /admin/profiles
+(also behind a token) lists the slowest recent ones across all workers.
+
+Password hashing runs on the password pool's threads (see passwords.py),
+so in a login's profile it shows up as time spent waiting on the pool.
+"""
+
+import marshal
+import os
+import sys
+from collections import Counter
+from datetime import datetime
+from random import random
+from threading import Event, Thread, get_ident
+from time import perf_counter
+from uuid import uuid4
+
+from flask import (abort, current_app, render_template, request,
+                   send_from_directory)
+from itsdangerous import BadSignature, TimestampSigner
+
+from metrics import REGISTRY, Counter as MetricCounter
+
+TOKEN_HEADER = 'X-Warbler-Profile'
+TOKEN_ARG = '_profile'
+ID_HEADER = 'X-Warbler-Profile-Id'
+
+# where a profiled request keeps its capture: the WSGI environ lasts as
+# long as the request, however its response is streamed
+ENVIRON_KEY = 'warbler.profile'
+
+PROFILES_CAPTURED = REGISTRY.register(MetricCounter(
+    'warbler_profiles_captured',
+    'Requests profiled, by endpoint and what asked for it ("token"/"sample").',
+    ['endpoint', 'trigger']))
+
+
+class Sampler:
+    """Samples one thread's stack from a background thread.
+
+    `samples` counts each distinct stack seen, as a tuple of code
+    locations (filename, first line, function), outermost first.
+    """
+
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+
+        self._stop = Event()
+        self._thread = Thread(target=self._run, name='warbler-profiler',
+                              daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is None:
+                return
+
+            stack = []
+
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno,
+                              code.co_name))
+                frame = frame.f_back
+
+            stack.reverse()
+            self.samples[tuple(stack)] += 1
+
+
+def _short_path(filename, prefixes):
+    # trim sys.path entries, so frames read like module paths
+    for prefix in prefixes:
+        if filename.startswith(prefix + os.sep):
+            return filename[len(prefix) + 1:]
+
+    return filename
+
+
+def collapsed(samples):
+    """Samples in collapsed-stack format, one "a;b;c count" line per stack."""
+
+    names = {}
+    prefixes = sorted((p for p in sys.path if p), key=len, reverse=True)
+
+    def name(location):
+        if location not in names:
+            filename, line, function = location
+            names[location] = f'{function} ({_short_path(filename, prefixes)}:{line})'
+
+        return names[location]
+
+    return ''.join(f"{';'.join(name(loc) for loc in stack)} {count}\n"
+                   for stack, count in samples.most_common())
+
+
+def pstats_data(samples, interval):
+    """Samples as the dict pstats.Stats loads from a marshalled file.
+
+    {location: (primitive calls, calls, own time, cumulative time, callers)},
+    where "calls" are samples the function was on the stack for.
+    """
+
+    stats = {}
+
+    def entry(location):
+        if location not in stats:
+            stats[location] = [0, 0, 0.0, 0.0, {}]
+
+        return stats[location]
+
+    for stack, count in samples.items():
+        seconds = count * interval
+
+        # recursion: count a function's cumulative time once per sample
+        for location in set(stack):
+            item = entry(location)
+            item[0] += count
+            item[1] += count
+            item[3] += seconds
+
+        entry(stack[-1])[2] += seconds
+
+        for caller, callee in set(zip(stack, stack[1:])):
+            callers = entry(callee)[4]
+            previous = callers.get(caller, (0, 0, 0.0, 0.0))
+            callers[caller] = (previous[0] + count, previous[1] + count,
+                               previous[2] + (seconds if callee == stack[-1] else 0),
+                               previous[3] + seconds)
+
+    return {location: tuple(item) for location, item in stats.items()}
+
+
+class Profiler:
+    """Decides which requests to profile and keeps their captures."""
+
+    def __init__(self):
+        self.directory = None
+        self.sample_rate = 0.0
+        self.interval = 0.005
+        self.keep = 50
+        self.token_max_age = 3600
+        self._signer = None
+
+    def init_app(self, app):
+        app.config.setdefault('PROFILE_DIR',
+                              os.path.join(app.instance_path, 'profiles'))
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)
+        app.config.setdefault('PROFILE_INTERVAL', 0.005)
+        app.config.setdefault('PROFILE_KEEP', 50)
+        app.config.setdefault('PROFILE_TOKEN_MAX_AGE', 3600)
+
+        self.directory = app.config['PROFILE_DIR']
+        self.sample_rate = app.config['PROFILE_SAMPLE_RATE']
+        self.interval = app.config['PROFILE_INTERVAL']
+        self.keep = app.config['PROFILE_KEEP']
+        self.token_max_age = app.config['PROFILE_TOKEN_MAX_AGE']
+        self._signer = TimestampSigner(app.secret_key, salt='warbler-profile')
+
+        app.before_request(self._start)
+        app.after_request(self._tag)
+        app.teardown_request(self._finish)
+
+        app.add_url_rule('/admin/profiles', 'profiles', self.index)
+        app.add_url_rule('/admin/profiles/<path:filename>', 'profile_file',
+                         self.download)
+
+    def make_token(self):
+        """A token that turns profiling on, valid for PROFILE_TOKEN_MAX_AGE."""
+
+        return self._signer.sign('profile').decode('ascii')
+
+    def valid_token(self, token):
+        if not token:
+            return False
+
+        try:
+            self._signer.unsign(token, max_age=self.token_max_age)
+        except BadSignature:
+            return False
+
+        return True
+
+    def _request_token(self):
+        return (request.headers.get(TOKEN_HEADER)
+                or request.args.get(TOKEN_ARG))
+
+    def _start(self):
+        if self.valid_token(self._request_token()):
+            trigger = 'token'
+        elif self.sample_rate and random() < self.sample_rate:
+            trigger = 'sample'
+        else:
+            return
+
+        sampler = Sampler(get_ident(), self.interval)
+        request.environ[ENVIRON_KEY] = (sampler, trigger, uuid4().hex[:12],
+                                        perf_counter())
+        sampler.start()
+
+    def _tag(self, response):
+        profile = request.environ.get(ENVIRON_KEY)
+
+        if profile:
+            response.headers[ID_HEADER] = profile[2]
+
+        return response
+
+    def _finish(self, exc):
+        profile = request.environ.pop(ENVIRON_KEY, None)
+
+        if profile is None:
+            return
+
+        sampler, trigger, capture_id, started = profile
+        sampler.stop()
+        duration = perf_counter() - started
+        endpoint = request.endpoint or 'unknown'
+
+        PROFILES_CAPTURED.inc(endpoint=endpoint, trigger=trigger)
+
+        try:
+            self.save(endpoint, capture_id, duration, sampler.samples)
+        except OSError:
+            current_app.logger.exception("Couldn't save profile %s", capture_id)
+
+    def save(self, endpoint, capture_id, duration, samples):
+        """Write a capture's .folded and .pstats files, then prune old ones."""
+
+        directory = os.path.join(self.directory, endpoint)
+        os.makedirs(directory, exist_ok=True)
+
+        # sortable by time; the duration is read back by captures()
+        stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
+        name = f'{stamp}-{round(duration * 1000)}ms-{capture_id}'
+
+        with open(os.path.join(directory, name + '.folded'), 'w') as f:
+            f.write(collapsed(samples))
+
+        with open(os.path.join(directory, name + '.pstats'), 'wb') as f:
+            marshal.dump(pstats_data(samples, self.interval), f)
+
+        folded = sorted(f for f in os.listdir(directory) if f.endswith('.folded'))
+
+        for old in folded[:-self.keep]:
+            for suffix in ('.folded', '.pstats'):
+                try:
+                    os.remove(os.path.join(directory, old[:-len('.folded')] + suffix))
+                except FileNotFoundError:
+                    pass
+
+    def captures(self):
+        """Every capture on disk, as dicts, slowest first."""
+
+        found = []
+
+        if not os.path.isdir(self.directory):
+            return found
+
+        for endpoint in os.listdir(self.directory):
+            directory = os.path.join(self.directory, endpoint)
+
+            if not os.path.isdir(directory):
+                continue
+
+            for filename in os.listdir(directory):
+                if not filename.endswith('.folded'):
+                    continue
+
+                name = filename[:-len('.folded')]
+                stamp, duration, capture_id = name.split('-')
+
+                found.append({
+                    'endpoint': endpoint,
+                    'id': capture_id,
+                    'when': datetime.strptime(stamp, '%Y%m%dT%H%M%S'),
+                    'duration_ms': int(duration[:-len('ms')]),
+                    'folded': f'{endpoint}/{name}.folded',
+                    'pstats': f'{endpoint}/{name}.pstats',
+                })
+
+        found.sort(key=lambda capture: capture['duration_ms'], reverse=True)
+
+        return found
+
+    def _require_token(self):
+        if not self.valid_token(self._request_token()):
+            abort(404)
+
+    def index(self):
+        """The slowest recent captures."""
+
+        self._require_token()
+
+        return render_template('admin/profiles.html',
+                               captures=self.captures()[:100],
+                               token=self._request_token())
+
+    def download(self, filename):
+        self._require_token()
+
+        return send_from_directory(self.directory, filename,
+                                   as_attachment=True)
+
+
+profiler = Profiler()
@@ -0,0 +1,426 @@
+"""Search for Warbler: usernames (ranked search, autocomplete) and warbles.
+
+/users?q= used to run `username LIKE '%q%'`, a sequential scan of users on
+every keystroke. Now:
+
+- on Postgres, a pg_trgm GIN index on users.username (see models.py)
+  serves case-insensitive substring matches
+- everywhere else, and for /api/users/autocomplete always, an in-memory
+  UsernameIndex answers: a sorted array for prefix matches (a binary
+  search, however many users there are), plus trigram postings for
+  substring matches when there's no Postgres to do them
+
+Results are ranked exact match, then prefix, then other substring matches;
+shorter names first within each.
+
+Warble (message text) search is full-text: a GIN index over
+to_tsvector('english', text) on Postgres, or an in-memory inverted index
+(MessageIndex) elsewhere. Either way, every query term must match, and
+results come back by relevance or newest first. Each process keeps its own
+MessageIndex: before searching, it indexes the warbles other processes
+have posted since it last looked, and `flask search-reindex` (with a
+shared cache) has every process rebuild on its next search.
+"""
+
+import re
+from bisect import bisect_left, insort
+from datetime import timedelta
+from heapq import nsmallest
+from math import log
+from threading import Lock
+from time import monotonic
+
+from cache import cache
+from models import db, User, Message, load_profile
+from snowflake import id_for, time_of
+
+##############################################################################
+# Username search
+
+SEP = '\x00'
+
+# sorts after any character a username can have
+LAST_CHAR = '\U0010ffff'
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def rank_key(username, query):
+    """Sort key: exact match, then prefix, then substring; shortest first."""
+
+    name = username.lower()
+    tier = 0 if name == query else 1 if name.startswith(query) else 2
+
+    return (tier, len(name), name)
+
+
+def database_searches(app=None):
+    """Does the database (Postgres) do the searching, not our in-memory indexes?"""
+
+    return db.get_engine(app).dialect.name == 'postgresql'
+
+
+def like_escape(text):
+    """Escape LIKE wildcards so `text` matches literally (ESCAPE '\\')."""
+
+    return (text.replace('\\', '\\\\')
+                .replace('%', '\\%')
+                .replace('_', '\\_'))
+
+
+class UsernameIndex:
+    """In-memory username index for prefix (and optionally substring) search.
+
+    `_keys` is a sorted list of "lowercased\\0Username" strings, so every
+    name starting with a prefix is one contiguous run found by bisect.
+    """
+
+    def __init__(self, rebuild_seconds=3600, trigrams=False):
+        self.rebuild_seconds = rebuild_seconds
+        self.trigrams = trigrams
+
+        self._keys = []
+        self._ids = {}
+        self._postings = {}
+        self._built_at = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_INDEX_REBUILD_SECONDS', 3600)
+        self.rebuild_seconds = app.config['SEARCH_INDEX_REBUILD_SECONDS']
+
+        # Postgres does substring search itself; only keep trigram
+        # postings in memory when it isn't there to do it
+        self.trigrams = not database_searches(app)
+        self._built_at = None
+
+    def rebuild(self):
+        """Reload every username from the database."""
+
+        keys, ids, postings = [], {}, {}
+
+        for user_id, username in (db.session
+                                  .query(User.id, User.username)
+                                  .yield_per(10000)):
+            keys.append(username.lower() + SEP + username)
+            ids[username] = user_id
+
+            if self.trigrams:
+                for gram in _trigrams(username.lower()):
+                    postings.setdefault(gram, set()).add(username)
+
+        keys.sort()
+
+        with self._lock:
+            self._keys, self._ids, self._postings = keys, ids, postings
+            self._built_at = monotonic()
+
+    def _ensure_built(self):
+        if (self._built_at is None
+                or monotonic() - self._built_at > self.rebuild_seconds):
+            self.rebuild()
+
+    def add(self, user_id, username):
+        """Index a new (or renamed) user."""
+
+        if self._built_at is None:
+            return
+
+        with self._lock:
+            insort(self._keys, username.lower() + SEP + username)
+            self._ids[username] = user_id
+
+            if self.trigrams:
+                for gram in _trigrams(username.lower()):
+                    self._postings.setdefault(gram, set()).add(username)
+
+    def remove(self, username):
+        """Drop a deleted (or renamed) user's old username."""
+
+        if self._built_at is None:
+            return
+
+        with self._lock:
+            key = username.lower() + SEP + username
+            i = bisect_left(self._keys, key)
+
+            if i < len(self._keys) and self._keys[i] == key:
+                del self._keys[i]
+
+            self._ids.pop(username, None)
+
+            for gram in _trigrams(username.lower()):
+                self._postings.get(gram, set()).discard(username)
+
+    def prefix(self, query, limit=10):
+        """Up to `limit` (id, username) pairs starting with `query`, ranked."""
+
+        self._ensure_built()
+
+        query = query.lower()
+        keys = self._keys
+        # every name starting with `query` sorts between these two
+        start = bisect_left(keys, query)
+        end = bisect_left(keys, query + LAST_CHAR, start)
+
+        # rank the whole run: a shorter name can sort after many longer ones
+        # ("alz" after every "ala...")
+        names = (key.split(SEP, 1)[1] for key in keys[start:end])
+        best = nsmallest(limit, names, key=lambda name: rank_key(name, query))
+
+        return [(self._ids[name], name) for name in best]
+
+    def substring(self, query, limit=10):
+        """Up to `limit` (id, username) pairs containing `query`, ranked."""
+
+        self._ensure_built()
+
+        query = query.lower()
+        grams = _trigrams(query)
+
+        if self.trigrams and grams:
+            postings = sorted((self._postings.get(gram, set()) for gram in grams),
+                              key=len)
+            names = set.intersection(*postings)
+        else:
+            # too short to have trigrams (or we aren't keeping them): check
+            # every name, as LIKE '%q%' would
+            names = (key.split(SEP, 1)[1] for key in self._keys)
+
+        matches = sorted((name for name in names if query in name.lower()),
+                         key=lambda name: rank_key(name, query))
+
+        return [(self._ids[name], name) for name in matches[:limit]]
+
+
+username_index = UsernameIndex()
+
+
+def search_users(query, limit):
+    """Users whose username contains `query` (case-insensitive), ranked."""
+
+    query = query.lower()
+
+    if database_searches():
+        # served by the pg_trgm index on users.username
+        users = (User.query
+                 .filter(User.username.ilike(f'%{like_escape(query)}%',
+                                             escape='\\'))
+                 .order_by(db.case([(db.func.lower(User.username) == query, 0),
+                                    (User.username.ilike(
+                                        f'{like_escape(query)}%',
+                                        escape='\\'), 1)],
+                                   else_=2),
+                           db.func.length(User.username),
+                           User.username)
+                 .limit(limit)
+                 .all())
+        return users
+
+    ids = [user_id for user_id, _ in username_index.substring(query, limit)]
+    users = {user.id: user for user in User.query.filter(User.id.in_(ids))}
+
+    return [users[user_id] for user_id in ids if user_id in users]
+
+
+##############################################################################
+# Warble search
+
+TS_CONFIG = 'english'
+
+WORD_RE = re.compile(r"[a-z0-9']+")
+
+# roughly Postgres' english stopwords, so both backends agree on the basics
+STOPWORDS = frozenset("""
+    a an and are as at be but by for from has have i in is it its of on or
+    so that the their there these they this to was we were will with you
+""".split())
+
+
+def tokenize(text):
+    """Lowercased words of `text`, minus stopwords."""
+
+    return [word for word in WORD_RE.findall(text.lower())
+            if word not in STOPWORDS]
+
+
+class MessageIndex:
+    """In-memory inverted index of message text, for non-Postgres runs.
+
+    `_postings` maps each term to {message id: times it appears};
+    `_terms` maps each message id to its terms. Message ids are
+    time-ordered, so they double as the "recent" sort key, and say which
+    messages are new since we last caught up.
+    """
+
+    # how far back catching up looks before the newest id we've seen, for
+    # messages committed late or by a process whose clock is behind
+    CATCH_UP_OVERLAP = timedelta(seconds=10)
+
+    def __init__(self, rebuild_seconds=3600):
+        self.rebuild_seconds = rebuild_seconds
+        self.enabled = True
+
+        self._postings = {}
+        self._terms = {}
+        self._removed = set()
+        self._newest = None
+        self._built_at = None
+        self._generation = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_INDEX_REBUILD_SECONDS', 3600)
+        self.rebuild_seconds = app.config['SEARCH_INDEX_REBUILD_SECONDS']
+
+        self.enabled = not database_searches(app)
+        self._built_at = None
+
+    @staticmethod
+    def _add(postings, terms, msg_id, text):
+        words = tokenize(text)
+
+        for term in words:
+            docs = postings.setdefault(term, {})
+            docs[msg_id] = docs.get(msg_id, 0) + 1
+
+        terms[msg_id] = frozenset(words)
+
+    def rebuild(self):
+        """Re-index every message from the database."""
+
+        generation = cache.generation('message_index')
+        postings, terms = {}, {}
+        newest = None
+
+        for msg_id, text in (db.session
+                             .query(Message.id, Message.text)
+                             .yield_per(10000)):
+            self._add(postings, terms, msg_id, text)
+            newest = max(msg_id, newest or msg_id)
+
+        with self._lock:
+            self._postings, self._terms = postings, terms
+            self._removed = set()
+            self._newest = newest
+            self._built_at = monotonic()
+            self._generation = generation
+
+        return len(terms)
+
+    def _ensure_built(self):
+        if (self._built_at is None
+                or monotonic() - self._built_at > self.rebuild_seconds
+                or cache.generation('message_index') != self._generation):
+            self.rebuild()
+        else:
+            self._catch_up()
+
+    def _catch_up(self):
+        """Index messages posted (by any process) since we last looked."""
+
+        if self._newest is None:
+            since = 0
+        else:
+            since = id_for(time_of(self._newest) - self.CATCH_UP_OVERLAP)
+
+        rows = (db.session
+                .query(Message.id, Message.text)
+                .filter(Message.id >= since)
+                .all())
+
+        with self._lock:
+            for msg_id, text in rows:
+                if msg_id not in self._terms and msg_id not in self._removed:
+                    self._add(self._postings, self._terms, msg_id, text)
+                    self._newest = max(msg_id, self._newest or msg_id)
+
+    def add(self, message):
+        """Index a new message."""
+
+        if not self.enabled or self._built_at is None:
+            return
+
+        with self._lock:
+            self._add(self._postings, self._terms, message.id, message.text)
+            self._newest = max(message.id, self._newest or message.id)
+
+    def remove(self, msg_ids):
+        """Drop deleted messages from the index."""
+
+        if not self.enabled or self._built_at is None:
+            return
+
+        with self._lock:
+            for msg_id in msg_ids:
+                # so catching up doesn't index it again
+                self._removed.add(msg_id)
+
+                for term in self._terms.pop(msg_id, ()):
+                    self._postings[term].pop(msg_id, None)
+
+    def search(self, query, sort='relevance'):
+        """Ids of messages containing every term of `query`, best first."""
+
+        self._ensure_built()
+
+        terms = set(tokenize(query))
+        postings = [self._postings.get(term, {}) for term in terms]
+
+        if not postings:
+            return []
+
+        matches = set.intersection(*(set(docs) for docs in postings))
+
+        if sort == 'recent':
+            return sorted(matches, reverse=True)
+
+        total = len(self._terms)
+
+        def score(msg_id):
+            # tf-idf: rarer terms count for more
+            return sum(docs[msg_id] * log(1 + total / len(docs))
+                       for docs in postings)
+
+        return sorted(matches, key=lambda msg_id: (score(msg_id), msg_id),
+                      reverse=True)
+
+
+message_index = MessageIndex()
+
+
+def search_messages(query, sort, limit, offset=0):
+    """One page of messages matching `query` ('relevance' or 'recent' order).
+
+    Returns (messages, has_more).
+    """
+
+    if database_searches():
+        # served by the GIN index on to_tsvector(TS_CONFIG, text); see models.py
+        document = db.func.to_tsvector(TS_CONFIG, Message.text)
+        tsquery = db.func.plainto_tsquery(TS_CONFIG, query)
+
+        results = (Message.query
+                   .options(*load_profile('message_author'))
+                   .filter(document.op('@@')(tsquery)))
+
+        if sort == 'recent':
+            results = results.order_by(Message.id.desc())
+        else:
+            results = results.order_by(db.func.ts_rank(document, tsquery).desc(),
+                                       Message.id.desc())
+
+        messages = results.offset(offset).limit(limit + 1).all()
+
+        return messages[:limit], len(messages) > limit
+
+    ids = message_index.search(query, sort)
+    page_ids = ids[offset:offset + limit]
+    messages = {msg.id: msg for msg in (Message.query
+                                        .options(*load_profile('message_author'))
+                                        .filter(Message.id.in_(page_ids)))}
+
+    return ([messages[msg_id] for msg_id in page_ids if msg_id in messages],
+            len(ids) > offset + limit)
@@ -1,20 +1,284 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
+
+    python seed.py                          # recreate tables, load everything
+    python seed.py --keep --tables follows  # add rows to what's there
+
+Each CSV (generator/users.csv, messages.csv, follows.csv and, if present,
+favorites.csv) is read in batches and streamed into Postgres with
+COPY FROM STDIN, or inserted with executemany on other databases, so
+memory stays flat however big the files are. The indexes of the tables
+being loaded are dropped first and rebuilt once the rows are in, which is
+much faster than keeping them up to date row by row.
+
+Timelines and the users' counters are rebuilt afterwards, unless
+--no-rebuild is given.
+"""
+
+import argparse
+import csv
+import io
+import os
+import sys
+from datetime import datetime
+from itertools import islice
+from time import monotonic
 
-from csv import DictReader
 from app import db
-from models import User, Message, FollowersFollowee, Favorite
+from models import (User, Message, FollowersFollowee, Favorite, Timeline,
+                    DDL_INDEXES)
+from snowflake import id_for, TIME_SHIFT
+
+# in load order, so foreign keys are satisfied
+TABLES = {
+    'users': (User, 'users.csv'),
+    'messages': (Message, 'messages.csv'),
+    'follows': (FollowersFollowee, 'follows.csv'),
+    'favorites': (Favorite, 'favorites.csv'),
+}
+
+# loaded when their CSV exists, skipped otherwise
+OPTIONAL = {'favorites'}
+
+BATCH_SIZE = 50000
+
+
+def user_rows(header, rows, start):
+    """Users get an updated_at (the counters and version default to 0)."""
+
+    if 'updated_at' in header:
+        return header, rows
+
+    now = datetime.utcnow()
+
+    return header + ['updated_at'], [row + [now] for row in rows]
+
+
+def message_rows(header, rows, start):
+    """Messages get snowflake ids from their timestamps, unless they have ids.
+
+    The row number fills the id's worker and sequence bits, so messages
+    sharing a millisecond still get distinct ids.
+    """
+
+    stamp = header.index('timestamp')
+
+    for row in rows:
+        row[stamp] = datetime.fromisoformat(row[stamp])
+
+    if 'id' in header:
+        return header, rows
+
+    spread = (1 << TIME_SHIFT) - 1
+
+    return header + ['id'], [row + [id_for(row[stamp]) | (n & spread)]
+                             for n, row in enumerate(rows, start)]
+
+
+def plain_rows(header, rows, start):
+    return header, rows
+
+
+PREPARE = {
+    'users': user_rows,
+    'messages': message_rows,
+}
+
+
+def read_batches(path, batch_size):
+    """Yield (header, rows, row number of the first) from the CSV at `path`."""
+
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        start = 0
+
+        while True:
+            rows = list(islice(reader, batch_size))
+
+            if not rows:
+                return
+
+            yield header, rows, start
+            start += len(rows)
+
+
+def copy_rows(conn, table, columns, rows):
+    """Stream `rows` into `table` with Postgres' COPY."""
+
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+
+    cursor = conn.connection.cursor()
+    cursor.copy_expert(f'COPY {table.name} ({", ".join(columns)}) '
+                       'FROM STDIN WITH (FORMAT csv)', buffer)
+
+
+def insert_rows(conn, table, columns, rows):
+    """Insert `rows` into `table` with one executemany."""
+
+    conn.execute(table.insert(), [dict(zip(columns, row)) for row in rows])
+
+
+def drop_indexes(conn, tables):
+    for table in tables:
+        if conn.dialect.name == 'postgresql':
+            for name, _ in DDL_INDEXES.get(table.name, ()):
+                conn.execute(f'DROP INDEX IF EXISTS {name}')
+
+        for index in table.indexes:
+            index.drop(bind=conn)
+
+
+def create_indexes(conn, tables):
+    for table in tables:
+        for index in table.indexes:
+            index.create(bind=conn)
+
+        for name, ddl in DDL_INDEXES.get(table.name, ()):
+            ddl.execute(bind=conn, target=table)
+
+
+def report(name, rows, started, end='\r'):
+    elapsed = monotonic() - started
+    rate = rows / elapsed if elapsed else 0
+
+    print(f'{name}: {rows:,} rows in {elapsed:.1f}s ({rate:,.0f} rows/s)',
+          end=end, file=sys.stderr, flush=True)
+
+
+def load_table(conn, name, path, batch_size):
+    """Load one CSV into its table; returns the number of rows."""
+
+    model, _ = TABLES[name]
+    table = model.__table__
+    prepare = PREPARE.get(name, plain_rows)
+    write = copy_rows if conn.dialect.name == 'postgresql' else insert_rows
+
+    started = monotonic()
+    loaded = 0
+
+    with conn.begin():
+        for header, rows, start in read_batches(path, batch_size):
+            columns, rows = prepare(header, rows, start)
+            write(conn, table, columns, rows)
+
+            loaded += len(rows)
+            report(name, loaded, started)
+
+    report(name, loaded, started, end='\n')
+
+    return loaded
+
+
+def reset_sequences(conn, tables):
+    """Move serial counters past ids loaded from CSVs (Postgres only)."""
+
+    if conn.dialect.name != 'postgresql':
+        return
+
+    for table in tables:
+        id_column = table.c.get('id')
+
+        if id_column is not None and id_column.autoincrement is not False:
+            conn.execute(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                         f"COALESCE(MAX(id), 0) + 1, false) FROM {table.name}")
+
+
+def rebuild_derived():
+    """Recompute timelines and counters from the loaded rows."""
+
+    started = monotonic()
+
+    Timeline.rebuild()
+    User.reconcile_counts()
+    db.session.commit()
+
+    print(f'timelines and counters rebuilt in {monotonic() - started:.1f}s',
+          file=sys.stderr)
+
+
+def seed(tables=tuple(TABLES), data_dir='generator', keep=False,
+         batch_size=BATCH_SIZE, rebuild=True):
+    """Load the CSVs for `tables` from `data_dir`; returns {table: rows}."""
+
+    if not keep:
+        db.drop_all()
+        db.create_all()
+
+    sources = []
+
+    for name in TABLES:
+        if name not in tables:
+            continue
+
+        path = os.path.join(data_dir, TABLES[name][1])
+
+        if not os.path.exists(path):
+            if name in OPTIONAL:
+                print(f'{name}: no {path}, skipping', file=sys.stderr)
+                continue
+
+            raise FileNotFoundError(f'No such file: {path}')
+
+        sources.append((name, path))
+
+    deferred = [TABLES[name][0].__table__ for name, path in sources]
+    started = monotonic()
+    counts = {}
+
+    with db.engine.connect() as conn:
+        with conn.begin():
+            drop_indexes(conn, deferred)
+
+        try:
+            for name, path in sources:
+                counts[name] = load_table(conn, name, path, batch_size)
+
+            with conn.begin():
+                reset_sequences(conn, deferred)
+
+        finally:
+            index_started = monotonic()
+
+            with conn.begin():
+                create_indexes(conn, deferred)
+
+            print(f'indexes rebuilt in {monotonic() - index_started:.1f}s',
+                  file=sys.stderr)
+
+        if conn.dialect.name == 'postgresql':
+            with conn.begin():
+                conn.execute('ANALYZE')
+
+    report('total', sum(counts.values()), started, end='\n')
+
+    # once the indexes are back: rebuilding joins and counts on them
+    if rebuild:
+        rebuild_derived()
 
+    return counts
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tables', nargs='+', choices=list(TABLES),
+                        default=list(TABLES),
+                        help='tables to load (default: all)')
+    parser.add_argument('--data-dir', default='generator',
+                        help='directory holding the CSVs (default: generator)')
+    parser.add_argument('--keep', action='store_true',
+                        help="add to the existing tables instead of "
+                             "recreating them")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE,
+                        help=f'rows per COPY/insert (default: {BATCH_SIZE})')
+    parser.add_argument('--no-rebuild', dest='rebuild', action='store_false',
+                        help="don't rebuild timelines and counters")
+    args = parser.parse_args(argv)
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    seed(tuple(args.tables), args.data_dir, args.keep, args.batch_size,
+         args.rebuild)
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(FollowersFollowee, DictReader(follows))
 
-db.session.commit()
+if __name__ == '__main__':
+    main()
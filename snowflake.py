@@ -0,0 +1,159 @@
+"""Time-ordered 64-bit ids for messages ("snowflakes").
+
+An id packs, from the high bits down:
+
+- 41 bits: milliseconds since EPOCH (good for ~69 years)
+- 10 bits: worker id, so processes never hand out the same id
+- 12 bits: a per-millisecond sequence number
+
+so ids are made in-process, with no database round trip, and sorting by
+id sorts by creation time. Pages can then order and seek on the primary
+key alone.
+
+Each process needs a worker id no other live process is using. By
+default it's leased from the database on first use: the process takes
+the first free Postgres advisory lock among the 1024 worker ids and
+holds it, on a connection of its own, until it exits (so a forked child
+leases its own). That works across hosts sharing the database. Elsewhere
+(e.g. SQLite), set SNOWFLAKE_WORKER_ID, and run one process per id.
+"""
+
+import os
+from datetime import datetime, timedelta
+from threading import Lock
+from time import sleep, time
+
+from sqlalchemy import text
+
+EPOCH = datetime(2010, 1, 1)
+
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+MAX_WORKER = (1 << WORKER_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+TIME_SHIFT = WORKER_BITS + SEQUENCE_BITS
+
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+# the first key of our advisory locks, keeping them apart from any others
+LOCK_SPACE = 0x536e6f77  # "Snow"
+
+
+def id_for(when, worker=0, sequence=0):
+    """The id made at datetime `when` (naive UTC) by `worker`.
+
+    With the defaults, the smallest id of that millisecond: handy for
+    seeking ("messages since ...") and for giving old rows ids.
+    """
+
+    ms = (when - EPOCH) // timedelta(milliseconds=1)
+
+    return (ms << TIME_SHIFT) | (worker << SEQUENCE_BITS) | sequence
+
+
+def time_of(snowflake):
+    """When (naive UTC, to the millisecond) `snowflake` was made."""
+
+    return EPOCH + timedelta(milliseconds=snowflake >> TIME_SHIFT)
+
+
+class Snowflake:
+    """Hands out ids for one worker; safe to share between threads."""
+
+    def __init__(self, worker=None):
+        self.worker = worker
+        self._app = None
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = Lock()
+
+        self._leased = None
+        self._lease_pid = None
+        self._lease_conn = None
+        self._inherited = []
+
+    def init_app(self, app):
+        app.config.setdefault('SNOWFLAKE_WORKER_ID', None)
+        self.worker = app.config['SNOWFLAKE_WORKER_ID']
+        self._app = app
+
+    def _lease(self):
+        """A worker id held (via an advisory lock) by this process alone."""
+
+        if self._lease_pid == os.getpid():
+            return self._leased
+
+        with self._lock:
+            if self._lease_pid == os.getpid():
+                return self._leased
+
+            if self._lease_conn is not None:
+                # inherited over fork: the lock is our parent's. Keep the
+                # object alive, since closing it here would close the
+                # parent's connection (and release its lock) too
+                self._inherited.append(self._lease_conn)
+                self._lease_conn = None
+
+            if self._app is None:
+                raise RuntimeError('Set SNOWFLAKE_WORKER_ID, or init_app() '
+                                   'to lease one from the database')
+
+            engine = self._app.extensions['sqlalchemy'].db.get_engine(self._app)
+
+            if engine.dialect.name != 'postgresql':
+                raise RuntimeError('SNOWFLAKE_WORKER_ID must be set unless '
+                                   'the database is Postgres')
+
+            conn = engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT')
+            # ours for as long as the process runs, not the pool's
+            conn.detach()
+
+            start = os.getpid() & MAX_WORKER
+
+            for n in range(MAX_WORKER + 1):
+                worker = (start + n) & MAX_WORKER
+
+                if conn.scalar(text('SELECT pg_try_advisory_lock(:space, :worker)'),
+                               space=LOCK_SPACE, worker=worker):
+                    self._leased = worker
+                    self._lease_pid = os.getpid()
+                    self._lease_conn = conn
+                    return worker
+
+            conn.close()
+            raise RuntimeError('Every snowflake worker id is in use')
+
+    def next_id(self):
+        worker = self.worker
+
+        if worker is None:
+            worker = self._lease()
+        elif not 0 <= worker <= MAX_WORKER:
+            raise ValueError(f'Snowflake worker id must be 0-{MAX_WORKER}, '
+                             f'not {worker}')
+
+        with self._lock:
+            now = int(time() * 1000) - _EPOCH_MS
+
+            # if the clock steps back, keep counting from where we were
+            # rather than risk repeating ids
+            if now <= self._last_ms:
+                now = self._last_ms
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+
+                if self._sequence == 0:
+                    # 4096 ids this millisecond: wait for the next one
+                    now += 1
+                    sleep(max(0, now + _EPOCH_MS - time() * 1000) / 1000)
+            else:
+                self._sequence = 0
+
+            self._last_ms = now
+
+            return (now << TIME_SHIFT) | (worker << SEQUENCE_BITS) | self._sequence
+
+
+snowflake = Snowflake()
@@ -0,0 +1,94 @@
+"""Static asset build/serving tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_assets.py
+
+
+import gzip
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from assets import assets, build_assets
+
+
+class AssetsTestCase(TestCase):
+    """Test fingerprinting, precompression and serving."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.static = os.path.join(self.tmp.name, 'static')
+        os.makedirs(os.path.join(self.static, 'images'))
+        os.makedirs(os.path.join(self.static, 'stylesheets'))
+
+        with open(os.path.join(self.static, 'images', 'bg.png'), 'wb') as f:
+            f.write(b'\x89PNG not really')
+
+        with open(os.path.join(self.static, 'stylesheets', 'style.css'), 'w') as f:
+            f.write('body { background: url("/static/images/bg.png"); }\n' * 20)
+
+        self.old_directory = assets.directory
+        assets.directory = os.path.join(self.static, 'dist')
+
+    def tearDown(self):
+        assets.directory = self.old_directory
+        assets.load()
+        self.tmp.cleanup()
+
+    def test_build(self):
+        """Are files hashed, CSS urls rewritten and text precompressed?"""
+
+        manifest = build_assets(self.static, assets.directory)
+        css = manifest['stylesheets/style.css']
+        image = manifest['images/bg.png']
+
+        self.assertRegex(css, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(assets.directory, css)) as f:
+            self.assertIn(f'url("/assets/{image}")', f.read())
+
+        self.assertTrue(os.path.exists(os.path.join(assets.directory, css + '.gz')))
+        self.assertFalse(os.path.exists(os.path.join(assets.directory, image + '.gz')))
+
+        # a rebuild doesn't pick up its own output
+        self.assertEqual(build_assets(self.static, assets.directory), manifest)
+
+    def test_serve(self):
+        """Are built assets served immutable, and gzipped when accepted?"""
+
+        manifest = assets.build(self.static)
+        css = manifest['stylesheets/style.css']
+        client = app.test_client()
+
+        with app.test_request_context():
+            url = assets.static_url('stylesheets/style.css')
+            self.assertEqual(url, f'/assets/{css}')
+            self.assertEqual(assets.static_url('/static/images/bg.png'),
+                             f"/assets/{manifest['images/bg.png']}")
+            self.assertEqual(assets.static_url('https://example.com/a.png'),
+                             'https://example.com/a.png')
+
+        resp = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.mimetype, 'text/css')
+        self.assertIn('immutable', resp.headers['Cache-Control'])
+        self.assertIn(b'background', gzip.decompress(resp.data))
+        resp.close()
+
+        resp = client.get(url)
+        self.assertNotIn('Content-Encoding', resp.headers)
+        resp.close()
+
+    def test_fallback_without_manifest(self):
+        """Without a build, does static_url() give plain /static/ URLs?"""
+
+        assets.load()
+
+        with app.test_request_context():
+            self.assertEqual(assets.static_url('favicon.ico'),
+                             '/static/favicon.ico')
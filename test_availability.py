@@ -0,0 +1,33 @@
+"""Bloom filter tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_availability.py
+
+
+from unittest import TestCase
+
+from availability import BloomFilter
+
+
+class BloomFilterTestCase(TestCase):
+    """Test the Bloom filter behind availability checks."""
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        names = [f'user{i}' for i in range(1000)]
+
+        for name in names:
+            bloom.add(name)
+
+        self.assertTrue(all(name in bloom for name in names))
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(1000, error_rate=0.01)
+
+        for i in range(1000):
+            bloom.add(f'user{i}')
+
+        false_positives = sum(f'other{i}' in bloom for i in range(10000))
+
+        self.assertLess(false_positives, 300)
@@ -0,0 +1,72 @@
+"""Benchmark suite tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_bench.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+os.environ['BENCH_DATABASE_URL'] = "postgresql:///warbler-test"
+
+from bench import run, parse_args, percentile
+
+db.create_all()
+
+
+class BenchTestCase(TestCase):
+    """Test the benchmark runner on a tiny dataset."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+        for i in range(4):
+            user = User(email=f"user{i}@test.com", username=f"user{i}",
+                        password="HASHED_PASSWORD")
+            user.messages.append(Message(text=f"Warblers singing {i}"))
+            db.session.add(user)
+        db.session.commit()
+
+    def tearDown(self):
+        User.query.delete()
+        db.session.commit()
+
+    def test_percentile(self):
+        """Are percentiles nearest-rank?"""
+
+        values = list(range(1, 101))
+
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([7], 95), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_run(self):
+        """Are routes measured, and follows undone afterwards?"""
+
+        results = run(parse_args(['--no-seed', '--requests', '3',
+                                  '--warmup', '1', '--routes', 'homepage',
+                                  'users_show', 'add_follow']))
+        routes = results['routes']
+
+        self.assertEqual(set(routes), {'homepage', 'users_show', 'add_follow'})
+        self.assertEqual(routes['homepage']['statuses'], {'200': 3})
+        self.assertEqual(routes['add_follow']['statuses'], {'302': 3})
+        self.assertGreater(routes['homepage']['queries_per_request'], 0)
+        self.assertLessEqual(routes['homepage']['p50_ms'],
+                             routes['homepage']['p99_ms'])
+        self.assertEqual(results['meta']['users'], 4)
+        self.assertEqual(FollowersFollowee.query.count(), 0)
+
+    def test_refuses_to_seed_other_databases(self):
+        """Is seeding (which drops every table) refused outside a bench database?"""
+
+        with self.assertRaises(SystemExit):
+            run(parse_args(['--requests', '1', '--routes', 'homepage']))
+
+        self.assertEqual(User.query.count(), 4)
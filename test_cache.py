@@ -0,0 +1,191 @@
+"""Cache backend tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_cache.py
+
+
+import os
+import socketserver
+import tempfile
+from threading import Thread
+from time import sleep
+from unittest import TestCase
+
+from cache import (LRUCache, SharedMemoryCache, RedisCache, AppCache,
+                   dumps, loads)
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """Just enough of the Redis protocol for RedisCache."""
+
+    def read_command(self):
+        line = self.rfile.readline()
+
+        if not line:
+            return None
+
+        args = []
+
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+
+        return args
+
+    def handle(self):
+        data = self.server.data
+
+        while True:
+            args = self.read_command()
+
+            if args is None:
+                return
+
+            command = args[0].upper()
+
+            if command == b'GET':
+                value = data.get(args[1])
+                self.wfile.write(b'$-1\r\n' if value is None
+                                 else b'$%d\r\n%s\r\n' % (len(value), value))
+            elif command == b'SET':
+                data[args[1]] = args[2]
+                self.wfile.write(b'+OK\r\n')
+            elif command == b'DEL':
+                removed = sum(data.pop(key, None) is not None for key in args[1:])
+                self.wfile.write(b':%d\r\n' % removed)
+            elif command == b'FLUSHDB':
+                data.clear()
+                self.wfile.write(b'+OK\r\n')
+            else:
+                self.wfile.write(b'-ERR unknown command\r\n')
+
+
+class BackendTests:
+    """Behaviour every backend shares; mixed into a TestCase per backend."""
+
+    def test_get_set_delete(self):
+        self.backend.set('a', b'[1,2,3]', 60)
+
+        self.assertEqual(self.backend.get('a'), b'[1,2,3]')
+        self.assertIsNone(self.backend.get('b'))
+
+        self.backend.delete('a')
+        self.assertIsNone(self.backend.get('a'))
+
+    def test_clear(self):
+        self.backend.set('a', b'1', 60)
+        self.backend.clear()
+
+        self.assertIsNone(self.backend.get('a'))
+
+
+class LRUCacheTestCase(BackendTests, TestCase):
+    """Test the in-process LRU backend."""
+
+    def setUp(self):
+        self.backend = LRUCache(max_entries=2)
+
+    def test_evicts_least_recently_used(self):
+        self.backend.set('a', b'1', 60)
+        self.backend.set('b', b'2', 60)
+        self.backend.get('a')
+        self.backend.set('c', b'3', 60)
+
+        self.assertEqual(self.backend.get('a'), b'1')
+        self.assertIsNone(self.backend.get('b'))
+        self.assertEqual(self.backend.get('c'), b'3')
+
+    def test_ttl(self):
+        self.backend.set('a', b'1', 0.01)
+        sleep(0.02)
+
+        self.assertIsNone(self.backend.get('a'))
+
+
+class SharedMemoryCacheTestCase(BackendTests, TestCase):
+    """Test the shared-memory backend."""
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.backend = SharedMemoryCache(self.path, slots=16, slot_size=64)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_shared_between_instances(self):
+        """Does a second mapping (as in another worker) see the entries?"""
+
+        self.backend.set('a', b'1', 60)
+        other = SharedMemoryCache(self.path, slots=16, slot_size=64)
+
+        self.assertEqual(other.get('a'), b'1')
+
+    def test_lock_file_reopened_after_fork(self):
+        """Does a forked child flock its own open file, not the parent's?"""
+
+        self.backend.set('a', b'1', 60)
+        parent_fd = self.backend._fd
+        pid = os.fork()
+
+        if pid == 0:
+            # exit status 0 only if the child got its own fd and the data
+            ok = (self.backend.get('a') == b'1'
+                  and self.backend._fd != parent_fd)
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(self.backend._fd, parent_fd)
+
+    def test_skips_oversized_entries(self):
+        self.backend.set('a', b'x' * 64, 60)
+
+        self.assertIsNone(self.backend.get('a'))
+
+
+class RedisCacheTestCase(BackendTests, TestCase):
+    """Test the Redis backend against a stand-in server."""
+
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      FakeRedisHandler)
+        self.server.daemon_threads = True
+        self.server.data = {}
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+        host, port = self.server.server_address
+        self.backend = RedisCache(f'redis://{host}:{port}/0')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_unreachable_server_misses(self):
+        backend = RedisCache('redis://127.0.0.1:1/0')
+        backend.set('a', b'1', 60)
+
+        self.assertIsNone(backend.get('a'))
+
+
+class AppCacheTestCase(TestCase):
+    """Test encoding and generations."""
+
+    def setUp(self):
+        self.cache = AppCache()
+        self.cache.backend = LRUCache()
+
+    def test_round_trip(self):
+        self.assertEqual(dumps([[1, 2], 'x', None]), b'[[1,2],"x",null]')
+        self.assertEqual(loads(dumps([[1, 2], None])), [[1, 2], None])
+
+    def test_bump_changes_generation(self):
+        before = self.cache.generation('timeline', 1)
+        other = self.cache.generation('timeline', 2)
+
+        self.cache.bump('timeline', 1)
+
+        self.assertNotEqual(self.cache.generation('timeline', 1), before)
+        self.assertEqual(self.cache.generation('timeline', 2), other)
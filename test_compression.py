@@ -0,0 +1,85 @@
+"""Gzip middleware tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_compression.py
+
+
+import gzip
+from unittest import TestCase
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from compression import GzipMiddleware, accepts_gzip, COMPRESSION_RATIO
+
+
+def make_app(body, **headers):
+    def app(environ, start_response):
+        response = Response(body, mimetype=headers.pop('mimetype', 'text/html'),
+                            headers=headers)
+        return response(environ, start_response)
+
+    return app
+
+
+class GzipMiddlewareTestCase(TestCase):
+    """Test response compression."""
+
+    def get(self, app, accept='gzip, deflate'):
+        client = Client(GzipMiddleware(app, min_size=100), Response)
+        return client.get('/', headers={'Accept-Encoding': accept})
+
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip('gzip, deflate, br'))
+        self.assertTrue(accepts_gzip('*'))
+        self.assertFalse(accepts_gzip('gzip;q=0, deflate'))
+        self.assertFalse(accepts_gzip('identity'))
+
+    def test_compresses_html(self):
+        body = '<li>warble</li>' * 100
+        observed = COMPRESSION_RATIO.count()
+
+        resp = self.get(make_app(body, ETag='"abc"'))
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(resp.headers['ETag'], 'W/"abc"')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(gzip.decompress(resp.data).decode(), body)
+        self.assertEqual(COMPRESSION_RATIO.count(), observed + 1)
+
+    def test_compresses_streams(self):
+        chunks = ['<li>warble %d</li>' % i for i in range(50)]
+
+        resp = self.get(make_app(iter(chunks)))
+
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data).decode(), ''.join(chunks))
+
+    def test_write_callable(self):
+        """Is data sent through start_response's write() kept, first?"""
+
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/html')])
+            write(b'<p>written</p>' * 20)
+            return [b'<p>returned</p>']
+
+        resp = self.get(app)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(resp.data),
+                         b'<p>written</p>' * 20 + b'<p>returned</p>')
+
+        resp = self.get(app, 'identity')
+        self.assertEqual(resp.data, b'<p>written</p>' * 20 + b'<p>returned</p>')
+
+    def test_skips(self):
+        """Are small, binary, already-encoded or unwanted responses left alone?"""
+
+        big = 'x' * 1000
+
+        for app, accept in ((make_app('<p>hi</p>'), 'gzip'),
+                            (make_app(big, mimetype='image/png'), 'gzip'),
+                            (make_app(big, **{'Content-Encoding': 'br'}), 'gzip'),
+                            (make_app(big), 'identity')):
+            resp = self.get(app, accept)
+            self.assertNotEqual(resp.headers.get('Content-Encoding'), 'gzip')
@@ -0,0 +1,228 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+from unittest import TestCase
+
+from models import db, User, Message, Timeline, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from jobs import jobs, JOBS_QUEUED, JOBS_FAILED
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+# payloads each test task was called with, one list per call
+CALLS = []
+
+
+@jobs.task('test_batch', batch=10)
+def record_batch(payloads):
+    if any(payload.get('fail') for payload in payloads):
+        raise ValueError("Bad payload")
+
+    CALLS.append(payloads)
+
+
+@jobs.task('test_single')
+def record_single(n):
+    CALLS.append([{'n': n}])
+
+
+class JobQueueTestCase(TestCase):
+    """Test queueing and running jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+        db.session.commit()
+        CALLS.clear()
+
+        self.saved = {name: app.config[name]
+                      for name in ('JOBS_EAGER', 'JOBS_MAX_ATTEMPTS')}
+        app.config['JOBS_EAGER'] = False
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config.update(self.saved)
+
+    def work(self):
+        with app.app_context():
+            return jobs.work(once=True)
+
+    def test_idempotency_and_batching(self):
+        """Are keyed duplicates dropped, and similar jobs run together?"""
+
+        with app.test_request_context():
+            for n in range(3):
+                jobs.enqueue('test_batch', key='same', n=n)
+
+            jobs.enqueue('test_batch', n=3)
+            jobs.enqueue('test_single', n=4)
+            jobs.enqueue('test_single', n=5)
+            db.session.commit()
+
+        self.assertEqual(Job.query.count(), 4)
+        self.assertEqual(JOBS_QUEUED.func(), 4)
+
+        self.assertEqual(self.work(), 4)
+        self.assertEqual(CALLS, [[{'n': 0}, {'n': 3}], [{'n': 4}], [{'n': 5}]])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_retries(self):
+        """Is a failing job retried later, then kept as failed?"""
+
+        app.config['JOBS_MAX_ATTEMPTS'] = 2
+
+        with app.test_request_context():
+            jobs.enqueue('test_batch', key='bad', fail=True)
+            jobs.enqueue('test_batch', n=1)
+            db.session.commit()
+
+        self.work()
+
+        # the good job in the failed batch still ran
+        self.assertEqual(CALLS, [[{'n': 1}]])
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts), ('pending', 1))
+        self.assertGreater(job.run_at, datetime.utcnow())
+        self.assertIn('Bad payload', job.error)
+
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+        self.work()
+
+        job = Job.query.one()
+        self.assertEqual((job.status, job.attempts, job.key), ('failed', 2, None))
+        self.assertEqual((JOBS_QUEUED.func(), JOBS_FAILED.func()), (0, 1))
+
+    def test_fan_out(self):
+        """Does a new message reach followers once its job has run?"""
+
+        author = User(email="author@test.com", username="author",
+                      password="HASHED_PASSWORD")
+        follower = User(email="follower@test.com", username="follower",
+                        password="HASHED_PASSWORD")
+        db.session.add_all([author, follower])
+        db.session.commit()
+        follower.following.append(author)
+        db.session.commit()
+        author_id, follower_id = author.id, follower.id
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = author_id
+
+            client.post('/messages/new', data={'text': 'Hello'})
+
+        msg_id = Message.query.filter_by(user_id=author_id).one().id
+
+        def timeline(user_id):
+            return [row.msg_id for row in Timeline.query.filter_by(user_id=user_id)]
+
+        self.assertEqual(timeline(author_id), [msg_id])
+        self.assertEqual(timeline(follower_id), [])
+
+        self.work()
+        self.assertEqual(timeline(follower_id), [msg_id])
+
+        # running it again (e.g. after a crash) changes nothing
+        with app.test_request_context():
+            jobs.enqueue('fan_out', msg_id=msg_id)
+            db.session.commit()
+
+        self.work()
+        self.assertEqual(timeline(follower_id), [msg_id])
+
+    def test_homepage_etag_follows_jobs(self):
+        """Does the homepage stop matching its ETag once a job changes the feed?"""
+
+        author = User(email="author@test.com", username="author",
+                      password="HASHED_PASSWORD")
+        follower = User(email="follower@test.com", username="follower",
+                        password="HASHED_PASSWORD")
+        db.session.add_all([author, follower])
+        db.session.commit()
+        follower.following.append(author)
+        db.session.commit()
+        author_id, follower_id = author.id, follower.id
+
+        def homepage(user_id, **headers):
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session[CURR_USER_KEY] = user_id
+
+                resp = client.get('/', headers=headers)
+                resp.get_data()
+                resp.close()
+
+                return resp
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session[CURR_USER_KEY] = author_id
+
+            client.post('/messages/new', data={'text': 'Fresh warble'})
+
+        # loaded before the warble has been fanned out to the follower
+        resp = homepage(follower_id)
+        self.assertNotIn(b'Fresh warble', resp.data)
+        etag = resp.headers['ETag']
+
+        self.work()
+
+        resp = homepage(follower_id, **{'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'Fresh warble', resp.data)
+
+    def test_defaults(self):
+        """With no JOBS_EAGER or CACHE_BACKEND set, do jobs still get run?"""
+
+        env = {name: value for name, value in os.environ.items()
+               if name not in ('JOBS_EAGER', 'CACHE_BACKEND')}
+        env.update(FLASK_APP='app.py', DATABASE_URL="postgresql:///warbler-test")
+        here = os.path.dirname(os.path.abspath(__file__))
+
+        def run(*args):
+            return subprocess.run(args, env=env, cwd=here, capture_output=True,
+                                  text=True, timeout=120)
+
+        # the default cache is per process, so web processes run jobs inline
+        result = run(sys.executable, '-c',
+                     "from app import app; print(app.config['JOBS_EAGER'])")
+        self.assertEqual(result.stdout.strip(), 'True', result.stderr)
+
+        # and a worker still starts, draining anything queued before
+        author = User(email="author@test.com", username="author",
+                      password="HASHED_PASSWORD")
+        follower = User(email="follower@test.com", username="follower",
+                        password="HASHED_PASSWORD")
+        db.session.add_all([author, follower])
+        db.session.commit()
+        follower.following.append(author)
+        msg = Message(text="Queued earlier", user_id=author.id)
+        db.session.add(msg)
+        db.session.commit()
+        follower_id, msg_id = follower.id, msg.id
+        db.session.add(Job(kind='fan_out', payload={'msg_id': msg_id}))
+        db.session.commit()
+
+        result = run(sys.executable, '-m', 'flask', 'jobs-work', '--once')
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn('Ran 1 job(s)', result.stdout)
+
+        db.session.remove()
+        self.assertEqual(Job.query.count(), 0)
+        self.assertEqual([row.msg_id for row in
+                          Timeline.query.filter_by(user_id=follower_id)], [msg_id])
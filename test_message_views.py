@@ -7,8 +7,9 @@
 
 import os
 from unittest import TestCase
+from unittest.mock import patch
 
-from models import db, connect_db, Message, User
+from models import db, connect_db, Message, User, Timeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -21,6 +22,9 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from testing import QueryBudgetMixin
+from search import message_index
+from cache import cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -32,8 +36,11 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs (fan-out etc.) in the request, so tests see them
+app.config['JOBS_EAGER'] = True
 
-class MessageViewTestCase(TestCase):
+
+class MessageViewTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
@@ -42,6 +49,9 @@ class MessageViewTestCase(TestCase):
         User.query.delete()
         Message.query.delete()
 
+        # the data is new, so pages cached by earlier tests are meaningless
+        cache.clear()
+
         self.client = app.test_client()
 
         self.testuser = User.signup(username="testuser",
@@ -71,3 +81,219 @@ class MessageViewTestCase(TestCase):
 
             msg = Message.query.one()
             self.assertEqual(msg.text, "Hello")
+
+    def test_message_fans_out_to_followers(self):
+        """Do new messages land on followers' timelines (and leave on delete)?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.following.append(self.testuser)
+        db.session.commit()
+        testuser_id, follower_id = self.testuser.id, follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Hello followers"})
+
+            msg = Message.query.one()
+            timeline_users = {t.user_id for t in
+                              Timeline.query.filter_by(msg_id=msg.id)}
+            self.assertEqual(timeline_users, {testuser_id, follower_id})
+
+            c.post(f"/messages/{msg.id}/delete")
+
+            self.assertEqual(Timeline.query.count(), 0)
+
+    def test_delete_someone_elses_message(self):
+        """Are other users' warbles (and unknown ids) refused, counts intact?"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="other",
+                            image_url=None)
+        other.messages.append(Message(text="Not yours"))
+        db.session.commit()
+        other_id, msg_id = other.id, other.messages[0].id
+        User.query.get(other_id).messages_count = 1
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            self.assertEqual(c.post(f"/messages/{msg_id}/delete").status_code, 403)
+            self.assertEqual(c.post(f"/messages/{msg_id + 1}/delete").status_code,
+                             404)
+
+        self.assertIsNotNone(Message.query.get(msg_id))
+        self.assertEqual(User.query.get(other_id).messages_count, 1)
+
+    def test_follow_backfills_timeline(self):
+        """Does following/unfollowing add/remove the followee's messages?"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        other.messages.append(Message(text="Old news"))
+        db.session.commit()
+        other_id = other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post(f"/users/follow/{other_id}")
+            resp = c.get("/")
+            self.assertIn(b"Old news", resp.data)
+
+            c.post(f"/users/stop-following/{other_id}")
+            resp = c.get("/")
+            self.assertNotIn(b"Old news", resp.data)
+
+    def test_new_message_invalidates_cached_timelines(self):
+        """Does a follower's cached homepage pick up a new message?"""
+
+        follower = User.signup(username="follower",
+                               email="follower@test.com",
+                               password="follower",
+                               image_url=None)
+        follower.following.append(self.testuser)
+        db.session.commit()
+        testuser_id, follower_id = self.testuser.id, follower.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            self.assertNotIn(b"Fresh news", c.get("/").data)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            c.post("/messages/new", data={"text": "Fresh news"})
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = follower_id
+
+            self.assertIn(b"Fresh news", c.get("/").data)
+
+    def test_homepage_query_budget(self):
+        """Does the homepage cost the same few queries however many authors?"""
+
+        for i in range(5):
+            author = User.signup(username=f"author{i}",
+                                 email=f"author{i}@test.com",
+                                 password="authoruser",
+                                 image_url=None)
+            author.messages.append(Message(text=f"Hello from {i}"))
+            self.testuser.following.append(author)
+        db.session.commit()
+
+        Timeline.rebuild()
+        db.session.commit()
+        testuser_id = self.testuser.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            with self.assertMaxQueries(4):
+                resp = c.get("/")
+
+            self.assertIn(b"@author4", resp.data)
+
+    def test_message_search(self):
+        """Does warble search find every-term matches, in either order?"""
+
+        for text in ("Warblers sing at dawn",
+                     "dawn dawn dawn, then warblers",
+                     "Nothing to see here"):
+            self.testuser.messages.append(Message(text=text))
+        db.session.commit()
+
+        resp = self.client.get("/messages/search?q=warblers+dawn")
+        html = resp.data.decode()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("Warblers sing at dawn", html)
+        self.assertIn("dawn dawn dawn", html)
+        self.assertNotIn("Nothing to see here", html)
+
+        # the in-memory index used when there's no Postgres
+        message_index.enabled = True
+        try:
+            message_index.rebuild()
+            best = Message.query.get(message_index.search("dawn")[0])
+
+            self.assertEqual(best.text, "dawn dawn dawn, then warblers")
+            self.assertEqual(message_index.search("dawn", "recent"),
+                             sorted(message_index.search("dawn"), reverse=True))
+            self.assertEqual(len(message_index.search("warblers dawn")), 2)
+            self.assertEqual(message_index.search("sing see"), [])
+
+            message_index.remove([best.id])
+            self.assertNotIn(best.id, message_index.search("dawn"))
+
+            # posted by another process: found on the next search
+            db.session.add(Message(text="Dawn chorus", user_id=best.user_id))
+            db.session.commit()
+            self.assertEqual(len(message_index.search("chorus")), 1)
+            self.assertNotIn(best.id, message_index.search("dawn"))
+
+            # `flask search-reindex` (with a shared cache) rebuilds it
+            cache.bump('message_index')
+            self.assertIn(best.id, message_index.search("dawn"))
+        finally:
+            message_index.enabled = False
+
+        # a per-process cache can't carry that to the web processes
+        with patch('app.database_searches', return_value=False):
+            result = app.test_cli_runner().invoke(args=['search-reindex'])
+
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn("can't be told to rebuild", result.output)
+
+    def test_conditional_get(self):
+        """Do permalinks and the homepage answer 304 until something changes?"""
+
+        other = User.signup(username="other",
+                            email="other@test.com",
+                            password="otheruser",
+                            image_url=None)
+        msg = Message(text="Permanent")
+        other.messages.append(msg)
+        self.testuser.following.append(other)
+        db.session.commit()
+        msg_id, other_id, testuser_id = msg.id, other.id, self.testuser.id
+
+        resp = self.client.get(f"/messages/{msg_id}")
+        etag = resp.headers['ETag']
+        self.assertIn('Last-Modified', resp.headers)
+
+        resp = self.client.get(f"/messages/{msg_id}",
+                               headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(resp.data, b'')
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = testuser_id
+
+            resp = c.get("/")
+            etag = resp.headers['ETag']
+            self.assertIn('private', resp.headers['Cache-Control'])
+
+            resp = c.get("/", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+
+            # a followee posting changes the homepage
+            User.adjust_counts(other_id, messages_count=1)
+            db.session.commit()
+
+            resp = c.get("/", headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
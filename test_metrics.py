@@ -0,0 +1,126 @@
+"""Request metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message
+from testing import count_queries
+from metrics import (Registry, Counter, Histogram, REQUEST_QUERIES,
+                     REQUEST_RENDER_TIME, N_PLUS_ONE_SUSPECTS)
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+db.create_all()
+
+
+@app.route('/test-n-plus-one')
+def n_plus_one():
+    """A route that runs the same query over and over."""
+
+    for _ in range(app.config['METRICS_N_PLUS_ONE_THRESHOLD']):
+        User.query.filter_by(username='nobody').first()
+
+    return 'ok'
+
+
+class MetricTypesTestCase(TestCase):
+    """Test the metric types and Prometheus rendering."""
+
+    def test_histogram_render(self):
+        registry = Registry()
+        latency = registry.register(Histogram(
+            'test_seconds', 'Test latency.', ['endpoint'], buckets=(.1, 1)))
+
+        latency.observe(.05, endpoint='home')
+        latency.observe(.5, endpoint='home')
+        latency.observe(5, endpoint='home')
+
+        text = registry.render()
+
+        self.assertIn('# TYPE test_seconds histogram', text)
+        self.assertIn('test_seconds_bucket{endpoint="home",le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{endpoint="home",le="1"} 2', text)
+        self.assertIn('test_seconds_bucket{endpoint="home",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{endpoint="home"} 3', text)
+
+    def test_counter_escapes_labels(self):
+        registry = Registry()
+        hits = registry.register(Counter('test_hits', 'Hits.', ['path']))
+
+        hits.inc(path='say "hi"')
+        hits.inc(2, path='say "hi"')
+
+        self.assertIn('test_hits_total{path="say \\"hi\\""} 3', registry.render())
+
+
+class RequestMetricsTestCase(TestCase):
+    """Test that requests are measured and exposed at /metrics."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_metrics_endpoint(self):
+        before = REQUEST_QUERIES.count(endpoint='list_users')
+
+        # a streamed page: recorded once it's been sent
+        resp = self.client.get('/users')
+        resp.get_data()
+        resp.close()
+
+        self.assertEqual(REQUEST_QUERIES.count(endpoint='list_users'), before + 1)
+
+        resp = self.client.get('/metrics')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn(b'warbler_request_duration_seconds_count{endpoint="list_users"}',
+                      resp.data)
+
+    def test_n_plus_one_suspect(self):
+        """Does running one statement over and over get flagged?"""
+
+        before = N_PLUS_ONE_SUSPECTS.value(endpoint='n_plus_one')
+
+        self.client.get('/test-n-plus-one')
+
+        self.assertEqual(N_PLUS_ONE_SUSPECTS.value(endpoint='n_plus_one'), before + 1)
+
+    def test_streamed_page(self):
+        """Are a streamed page's queries and render time counted once it's sent?"""
+
+        user = User(email="user@test.com", username="user",
+                    password="HASHED_PASSWORD")
+        user.messages.extend(Message(text=f"Warble {n}") for n in range(3))
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        db.session.remove()
+
+        count = REQUEST_QUERIES.count(endpoint='users_show')
+        recorded = REQUEST_QUERIES.total(endpoint='users_show')
+        render_time = REQUEST_RENDER_TIME.total(endpoint='users_show')
+
+        with app.app_context(), count_queries() as queries:
+            resp = self.client.get(f'/users/{user_id}')
+            self.assertTrue(resp.is_streamed)
+            resp.get_data()
+
+            # not until the body has been sent
+            self.assertEqual(REQUEST_QUERIES.count(endpoint='users_show'), count)
+            resp.close()
+
+        self.assertEqual(REQUEST_QUERIES.count(endpoint='users_show'), count + 1)
+        self.assertEqual(REQUEST_QUERIES.total(endpoint='users_show') - recorded,
+                         len(queries))
+        self.assertGreater(REQUEST_RENDER_TIME.total(endpoint='users_show'),
+                           render_time)
@@ -0,0 +1,59 @@
+"""Password pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+from unittest import TestCase
+
+from flask import Flask
+
+from passwords import PasswordPool, PasswordPoolBusy, hash_rounds
+
+
+class PasswordPoolTestCase(TestCase):
+    """Test hashing on the bounded password pool."""
+
+    def setUp(self):
+        app = Flask(__name__)
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['PASSWORD_POOL_WORKERS'] = 1
+        app.config['PASSWORD_POOL_QUEUE'] = 0
+        app.config['PASSWORD_POOL_TIMEOUT'] = 0.01
+
+        self.pool = PasswordPool()
+        self.pool.init_app(app)
+
+    def tearDown(self):
+        self.pool.shutdown()
+
+    def test_hash_and_check(self):
+        pw_hash = self.pool.hash('secret')
+
+        self.assertEqual(hash_rounds(pw_hash), 4)
+        self.assertTrue(self.pool.check(pw_hash, 'secret'))
+        self.assertFalse(self.pool.check(pw_hash, 'not secret'))
+
+    def test_needs_rehash(self):
+        pw_hash = self.pool.hash('secret')
+
+        self.assertFalse(self.pool.needs_rehash(pw_hash))
+
+        self.pool.rounds = 5
+        self.assertTrue(self.pool.needs_rehash(pw_hash))
+
+    def test_busy_when_saturated(self):
+        """With every slot taken, new work is refused rather than queued."""
+
+        before = self.pool.rejected.value()
+        self.pool._slots.acquire()
+
+        try:
+            with self.assertRaises(PasswordPoolBusy):
+                self.pool.hash('secret')
+        finally:
+            self.pool._slots.release()
+
+        self.assertEqual(self.pool.rejected.value(), before + 1)
+        self.assertTrue(self.pool.hash('secret'))
@@ -0,0 +1,98 @@
+"""Request profiler tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_profiler.py
+
+
+import os
+import pstats
+from collections import Counter
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from cache import cache
+from profiler import profiler, collapsed, pstats_data, ID_HEADER, TOKEN_HEADER
+
+db.create_all()
+
+STACK = (('app.py', 10, 'wsgi_app'), ('app.py', 20, 'view'),
+         ('jinja2/environment.py', 30, 'render'))
+
+
+class ProfilerTestCase(TestCase):
+    """Test request profiling."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.add(User(email="user@test.com", username="user",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+        cache.clear()
+
+        self.client = app.test_client()
+        self.directory = TemporaryDirectory()
+        self.saved = profiler.directory, profiler.interval
+        profiler.directory, profiler.interval = self.directory.name, 0.0005
+
+    def tearDown(self):
+        profiler.directory, profiler.interval = self.saved
+        self.directory.cleanup()
+
+    def test_formats(self):
+        """Are samples written as collapsed stacks and loadable pstats?"""
+
+        samples = Counter({STACK: 3, STACK[:2]: 1})
+
+        self.assertEqual(collapsed(samples).splitlines(), [
+            'wsgi_app (app.py:10);view (app.py:20);'
+            'render (jinja2/environment.py:30) 3',
+            'wsgi_app (app.py:10);view (app.py:20) 1',
+        ])
+
+        stats = pstats_data(samples, 0.01)
+        cc, nc, own, total, callers = stats[STACK[1]]
+
+        self.assertEqual((cc, nc), (4, 4))
+        self.assertAlmostEqual(own, 0.01)
+        self.assertAlmostEqual(total, 0.04)
+        self.assertEqual(set(callers), {STACK[0]})
+
+    def test_profiled_request(self):
+        """Does a token profile a (streamed) request, and only then?"""
+
+        resp = self.client.get('/users')
+        self.assertNotIn(ID_HEADER, resp.headers)
+        resp.get_data()
+        resp.close()
+
+        token = profiler.make_token()
+        resp = self.client.get('/users', headers={TOKEN_HEADER: token})
+        capture_id = resp.headers[ID_HEADER]
+        resp.get_data()
+        resp.close()
+
+        captures = profiler.captures()
+        self.assertEqual([c['id'] for c in captures], [capture_id])
+        self.assertEqual(captures[0]['endpoint'], 'list_users')
+
+        path = os.path.join(profiler.directory, captures[0]['pstats'])
+        pstats.Stats(path)
+
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 404)
+        resp = self.client.get('/users?_profile=forged')
+        self.assertNotIn(ID_HEADER, resp.headers)
+        resp.get_data()
+        resp.close()
+
+        resp = self.client.get(f'/admin/profiles?_profile={token}')
+        self.assertIn(b'list_users', resp.data)
+
+        resp = self.client.get(f"/admin/profiles/{captures[0]['folded']}"
+                               f"?_profile={token}")
+        self.assertEqual(resp.status_code, 200)
@@ -0,0 +1,135 @@
+"""Read-replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import random
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from flask import Flask, request
+
+from models import db, User, Replicas
+
+# SQLite files stand in for the primary and its replicas, in an app of their
+# own
+
+
+def make_app(directory, replicas):
+    test_app = Flask('replicas')
+    test_app.config['SECRET_KEY'] = 'test'
+    test_app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    test_app.config['SQLALCHEMY_DATABASE_URI'] = (
+        f'sqlite:///{directory}/primary.db')
+    test_app.config['SQLALCHEMY_BINDS'] = {
+        bind: f'sqlite:///{directory}/{bind}.db' for bind in replicas}
+    test_app.config['SQLALCHEMY_REPLICAS'] = replicas
+    db.init_app(test_app)
+
+    @test_app.route('/users', methods=['GET', 'POST'])
+    def usernames():
+        if request.method == 'POST' or request.args.get('add'):
+            db.session.add(User(email='new@test.com', username='new',
+                                password='HASHED_PASSWORD'))
+            db.session.commit()
+
+        return ' '.join(sorted(u.username for u in User.query))
+
+    with test_app.app_context():
+        # each database holds a user named after it, to tell them apart
+        for bind in [None, *replicas]:
+            engine = db.get_engine(test_app, bind=bind)
+            db.Model.metadata.create_all(bind=engine)
+            engine.execute(User.__table__.insert(),
+                           email=f'{bind}@test.com', username=bind or 'primary',
+                           password='HASHED_PASSWORD')
+
+    return test_app
+
+
+class ReplicaTestCase(TestCase):
+    """Test sending reads to replicas."""
+
+    def setUp(self):
+        db.session.remove()
+        self.directory = TemporaryDirectory()
+        self.app = make_app(self.directory.name, {'replica': 1})
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        with self.app.app_context():
+            for bind in [None, 'replica']:
+                db.get_engine(self.app, bind=bind).dispose()
+
+        db.session.remove()
+        self.directory.cleanup()
+
+    def test_routing(self):
+        """Do GETs read from the replica, and POSTs from the primary?"""
+
+        self.assertEqual(self.client.get('/users').data, b'replica')
+        self.assertEqual(self.client.head('/users').status_code, 200)
+
+        with self.client.session_transaction() as session:
+            self.assertNotIn('_primary_until', session)
+
+        self.assertEqual(self.client.post('/users').data, b'new primary')
+
+        with self.client.session_transaction() as session:
+            self.assertIn('_primary_until', session)
+
+    def test_read_your_writes(self):
+        """After a write, are reads from the primary, then the replica again?"""
+
+        # the same request: the write is on the primary, and so is the read
+        self.assertEqual(self.client.get('/users?add=1').data, b'new primary')
+
+        # the next request from the same browser
+        self.assertEqual(self.client.get('/users').data, b'new primary')
+
+        with self.client.session_transaction() as session:
+            session['_primary_until'] = 0
+
+        self.assertEqual(self.client.get('/users').data, b'replica')
+
+    def test_lag_guard(self):
+        """Is a replica that's too far behind (or down) skipped?"""
+
+        with patch.object(Replicas, 'measure_lag', return_value=60.0):
+            self.assertEqual(self.client.get('/users').data, b'primary')
+
+            # the lag is only measured every REPLICA_LAG_CHECK_INTERVAL
+            replicas = self.app.extensions['replicas']
+            replicas.check_interval = 0
+            Replicas.measure_lag.return_value = 0.5
+            self.assertEqual(self.client.get('/users').data, b'replica')
+
+
+class WeightedReplicaTestCase(TestCase):
+    """Test balancing reads over replicas."""
+
+    def test_weights(self):
+        """Are replicas picked in proportion to their weights?"""
+
+        db.session.remove()
+
+        with TemporaryDirectory() as directory:
+            test_app = make_app(directory, {'one': 3, 'two': 1, 'off': 0})
+            client = test_app.test_client()
+            random.seed(0)
+
+            reads = [client.get('/users').data for _ in range(400)]
+
+            with test_app.app_context():
+                for bind in [None, 'one', 'two', 'off']:
+                    db.get_engine(test_app, bind=bind).dispose()
+
+        db.session.remove()
+
+        self.assertNotIn(b'off', reads)
+        self.assertNotIn(b'primary', reads)
+        self.assertAlmostEqual(reads.count(b'one') / len(reads), 0.75,
+                               delta=0.08)
@@ -0,0 +1,83 @@
+"""Bulk seeder tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_seed.py
+
+
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from models import db, User, Message, FollowersFollowee, Timeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+from seed import seed
+
+db.create_all()
+
+USERS = """email,username,password
+a@test.com,alice,HASHED_PASSWORD
+b@test.com,bob,HASHED_PASSWORD
+"""
+
+MESSAGES = """text,timestamp,user_id
+Second,2019-03-01 10:00:00.500000,{alice}
+First,2019-03-01 10:00:00.500000,{bob}
+Third,2019-03-02 09:30:00,{alice}
+"""
+
+FOLLOWS = """followee_id,follower_id
+{bob},{alice}
+"""
+
+
+class SeedTestCase(TestCase):
+    """Test loading CSVs with seed.seed()."""
+
+    def setUp(self):
+        User.query.delete()
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        User.query.delete()
+        db.session.commit()
+
+    def write(self, directory, name, text, **ids):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(text.format(**ids))
+
+    def test_seed(self):
+        """Are users, messages and follows loaded, and timelines rebuilt?"""
+
+        with TemporaryDirectory() as directory:
+            self.write(directory, 'users.csv', USERS)
+            counts = seed(('users',), directory, keep=True, batch_size=1)
+
+            ids = {u.username: u.id for u in User.query}
+            self.write(directory, 'messages.csv', MESSAGES, **ids)
+            self.write(directory, 'follows.csv', FOLLOWS, **ids)
+
+            counts.update(seed(('messages', 'follows'), directory, keep=True,
+                               batch_size=2))
+
+        self.assertEqual(counts, {'users': 2, 'messages': 3, 'follows': 1})
+        self.assertEqual(FollowersFollowee.query.count(), 1)
+
+        texts = [m.text for m in Message.query.order_by(Message.id.desc())]
+        self.assertEqual(texts, ['Third', 'First', 'Second'])
+
+        # bob follows alice, so sees all three; alice sees her own two
+        alice = User.query.filter_by(username='alice').one()
+        self.assertEqual(Timeline.messages_for(alice).count(), 2)
+        self.assertEqual(alice.messages_count, 2)
+        self.assertEqual(alice.followers_count, 1)
+
+        # the indexes dropped for the load are back
+        indexes = {name for (name,) in db.session.execute(
+            "SELECT indexname FROM pg_indexes WHERE tablename = 'messages'")}
+        self.assertIn('ix_messages_user_id_id', indexes)
+        self.assertIn('ix_messages_text_fts', indexes)
@@ -0,0 +1,93 @@
+"""Snowflake id tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_snowflake.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+from unittest.mock import patch
+
+import snowflake
+from snowflake import (Snowflake, id_for, time_of, MAX_SEQUENCE, MAX_WORKER,
+                       SEQUENCE_BITS)
+
+
+class SnowflakeTestCase(TestCase):
+    """Test time-ordered id generation."""
+
+    def test_ids_increase(self):
+        """Are ids unique and increasing, even within a millisecond?"""
+
+        generator = Snowflake(worker=3)
+        ids = [generator.next_id() for _ in range(5000)]
+
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertLess(ids[-1], 2 ** 63)
+
+    def test_time_round_trip(self):
+        """Do ids record when they were made?"""
+
+        when = datetime(2019, 6, 1, 12, 30, 15, 250000)
+
+        self.assertEqual(time_of(id_for(when, worker=7, sequence=9)), when)
+        self.assertLess(id_for(when, worker=1023, sequence=MAX_SEQUENCE),
+                        id_for(datetime(2019, 6, 1, 12, 30, 15, 251000)))
+
+        made = time_of(Snowflake(worker=0).next_id())
+        self.assertLess(abs((datetime.utcnow() - made).total_seconds()), 5)
+
+    def test_clock_going_backwards(self):
+        """Does a clock step back keep ids increasing?"""
+
+        generator = Snowflake(worker=1)
+        now = 1600000000.0
+
+        with patch.object(snowflake, 'time', lambda: now):
+            first = generator.next_id()
+            now -= 10
+            second = generator.next_id()
+
+        self.assertGreater(second, first)
+
+    def test_worker_range(self):
+        """Are out-of-range worker ids refused?"""
+
+        with self.assertRaises(ValueError):
+            Snowflake(worker=1024).next_id()
+
+
+class WorkerLeaseTestCase(TestCase):
+    """Test leasing worker ids from the database."""
+
+    def setUp(self):
+        os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+        from app import app
+        self.app = app
+
+    def test_leases_differ(self):
+        """Do two generators on one database get different worker ids?"""
+
+        first, second = Snowflake(), Snowflake()
+        first.init_app(self.app)
+        second.init_app(self.app)
+
+        workers = [(generator.next_id() >> SEQUENCE_BITS) & MAX_WORKER
+                   for generator in (first, second)]
+
+        self.assertNotEqual(workers[0], workers[1])
+
+        # the lease lasts, rather than being taken per id
+        self.assertEqual(first._lease(), first._lease())
+
+        for generator in (first, second):
+            generator._lease_conn.close()
+
+    def test_needs_a_worker(self):
+        """Without a database to lease from, is a worker id required?"""
+
+        with self.assertRaises(RuntimeError):
+            Snowflake().next_id()
@@ -8,7 +8,8 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, FollowersFollowee, Favorite, Bcrypt
+from models import db, User, Message, FollowersFollowee, Favorite, Bcrypt, FollowState
+from passwords import password_pool, hash_rounds
 
 bcrypt = Bcrypt()
 
@@ -88,7 +89,7 @@ class UserModelTestCase(TestCase):
             email='email@gmail.com',
             password='hashed_pwd',
             image_url='image_url',
-        )s
+        )
 
         db.session.commit()
 
@@ -121,9 +122,126 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(auth_user,u)
 
+    def test_user_auth_rehash(self):
+        """Does logging in upgrade a hash made with an old cost factor?"""
+
+        u = User(
+            email="test@test.com",
+            username="testuser",
+            password=bcrypt.generate_password_hash("HASHED_PASSWORD", 4).decode('UTF-8')
+        )
+        db.session.add(u)
+        db.session.commit()
+
+        self.assertEqual(User.authenticate(u.username, "HASHED_PASSWORD"), u)
+        self.assertEqual(hash_rounds(u.password), password_pool.rounds)
+        self.assertEqual(User.authenticate(u.username, "HASHED_PASSWORD"), u)
+
         # get full test coverage! :) for likes and follows... ask joel for clarification
 
+    def test_user_counters(self):
+        """Do adjust_counts/reconcile_counts keep the counters right?"""
+
+        u = User.signup(username='username',
+            email='email@gmail.com',
+            password='hashed_pwd',
+            image_url='image_url',
+        )
+        v = User.signup(username='vsername',
+            email='vmail@gmail.com',
+            password='hashed_pwd',
+            image_url='image_url',
+        )
+        db.session.commit()
+
+        u.following.append(v)
+        u.messages.append(Message(text='hello'))
+        User.adjust_counts(u.id, following_count=1, messages_count=1)
+        User.adjust_counts(v.id, followers_count=1)
+        db.session.commit()
+
+        self.assertEqual((u.messages_count, u.following_count, u.followers_count),
+                         (1, 1, 0))
+        self.assertEqual(v.followers_count, 1)
+
+        # simulate drift, then repair it
+        User.adjust_counts(u.id, messages_count=5)
+        User.adjust_counts(v.id, likes_count=2)
+        db.session.commit()
+
+        self.assertEqual(User.reconcile_counts(), 2)
+        db.session.commit()
+
+        self.assertEqual(u.messages_count, 1)
+        self.assertEqual(v.likes_count, 0)
+        self.assertEqual(User.reconcile_counts(), 0)
 
+    def test_favorite_ids_for(self):
+        """Does Favorite.ids_for only report this user's favorites?"""
+
+        u = User.signup(username='username',
+            email='email@gmail.com',
+            password='hashed_pwd',
+            image_url='image_url',
+        )
+        v = User.signup(username='vsername',
+            email='vmail@gmail.com',
+            password='hashed_pwd',
+            image_url='image_url',
+        )
+        m1, m2, m3 = Message(text='one'), Message(text='two'), Message(text='three')
+        v.messages.extend([m1, m2, m3])
+        db.session.commit()
+
+        db.session.add_all([
+            Favorite(user_id=u.id, msg_id=m1.id),
+            Favorite(user_id=u.id, msg_id=m3.id),
+            Favorite(user_id=v.id, msg_id=m2.id),
+        ])
+        db.session.commit()
+
+        self.assertEqual(Favorite.ids_for(u, [m1.id, m2.id]), {m1.id})
+        self.assertEqual(Favorite.ids_for(v, [m1.id, m2.id, m3.id]), {m2.id})
+        self.assertEqual(Favorite.ids_for(u, []), set())
+
+    def test_follow_states(self):
+        """Does follow_states report both directions for many users at once?"""
+
+        u, v, w, x = [User.signup(username=name,
+                                  email=f'{name}@gmail.com',
+                                  password='hashed_pwd',
+                                  image_url='image_url')
+                      for name in ('u', 'v', 'w', 'x')]
+        db.session.commit()
+
+        u.following.append(v)
+        u.following.append(w)
+        w.following.append(u)
+        x.following.append(u)
+        db.session.commit()
+
+        self.assertEqual(u.follow_states([v.id, w.id, x.id]), {
+            v.id: FollowState(following=True, followed_by=False),
+            w.id: FollowState(following=True, followed_by=True),
+            x.id: FollowState(following=False, followed_by=True),
+        })
+        self.assertEqual(u.follow_states([]), {})
+
+    def test_message_ids_follow_time(self):
+        """Do messages get their own timestamps and time-ordered ids?"""
+
+        u = User.signup(username='username',
+            email='email@gmail.com',
+            password='hashed_pwd',
+            image_url='image_url',
+        )
+        db.session.commit()
 
+        for text in ('one', 'two', 'three'):
+            u.messages.append(Message(text=text))
+            db.session.commit()
 
+        messages = u.messages.order_by(Message.id).all()
 
+        self.assertEqual([m.text for m in messages], ['one', 'two', 'three'])
+        self.assertLess(messages[0].timestamp, messages[-1].timestamp)
@@ -22,7 +22,12 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app
+from app import app, CURR_USER_KEY
+from testing import QueryBudgetMixin
+from passwords import password_pool
+from availability import availability
+from search import username_index
+from cache import cache
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -37,8 +42,11 @@ db.create_all()
 
 app.config['WTF_CSRF_ENABLED'] = False
 
+# Run background jobs (fan-out etc.) in the request, so tests see them
+app.config['JOBS_EAGER'] = True
 
-class UserModelTestCase(TestCase):
+
+class UserModelTestCase(QueryBudgetMixin, TestCase):
     """Test views for messages."""
 
     def setUp(self):
@@ -51,6 +59,9 @@ class UserModelTestCase(TestCase):
 
         db.session.commit()
 
+        # the data is new, so pages cached by earlier tests are meaningless
+        cache.clear()
+
         self.client = app.test_client()
 
         self.u = User(
@@ -127,7 +138,201 @@ class UserModelTestCase(TestCase):
             self.assertEqual(CURR_USER_KEY in session,False)
 
 
-        
+
+    def test_users_pagination(self):
+        """Does /users page through users with older/newer cursors?"""
+
+        for name in ("second", "third"):
+            db.session.add(User(
+                email=f"{name}@test.com",
+                username=name,
+                password="HASHED_PASSWORD",
+            ))
+        db.session.commit()
+
+        result = self.client.get('/users?limit=2')
+        self.assertIn(b'@third', result.data)
+        self.assertIn(b'@second', result.data)
+        self.assertNotIn(b'@testuser', result.data)
+        self.assertIn(b'Older', result.data)
+
+        older = User.query.filter_by(username="second").one().id
+        result = self.client.get(f'/users?limit=2&before={older}')
+        self.assertIn(b'@testuser', result.data)
+        self.assertNotIn(b'@second', result.data)
+        self.assertIn(b'Newer', result.data)
+        self.assertNotIn(b'Older', result.data)
+
+    def test_streamed_listings(self):
+        """Are big listings streamed, batch by batch, with working pagers?"""
+
+        others = [User(email=f"other{i}@test.com",
+                       username=f"other{i}",
+                       password="HASHED_PASSWORD")
+                  for i in range(5)]
+        db.session.add_all(others)
+        self.u.followers.extend(others)
+        db.session.commit()
+        user_id = self.u.id
+
+        batch_size = app.config['STREAM_BATCH_SIZE']
+        app.config['STREAM_BATCH_SIZE'] = 2
+        try:
+            with self.client.session_transaction() as session:
+                session[CURR_USER_KEY] = user_id
+
+            for url in ('/users?limit=4', f'/users/{user_id}/followers?limit=4'):
+                # the second /users comes from the page cache
+                for _ in range(2):
+                    result = self.client.get(url)
+                    self.assertTrue(result.is_streamed)
+
+                    html = result.get_data(as_text=True)
+                    self.assertIn('@other4', html)
+                    self.assertIn('@other1', html)
+                    self.assertNotIn('@other0', html)
+                    self.assertIn('Older', html)
+        finally:
+            app.config['STREAM_BATCH_SIZE'] = batch_size
+
+    def test_users_query_budget(self):
+        """Do /users and favorites pages avoid a query per card/message?"""
+
+        others = [User(email=f"other{i}@test.com",
+                       username=f"other{i}",
+                       password="HASHED_PASSWORD")
+                  for i in range(5)]
+        db.session.add_all(others)
+        db.session.commit()
+
+        for other in others:
+            msg = Message(text=f"From {other.username}")
+            other.messages.append(msg)
+            db.session.flush()
+            db.session.add(Favorite(user_id=self.u.id, msg_id=msg.id))
+        db.session.commit()
+        user_id = self.u.id
+
+        with self.client as c:
+            with c.session_transaction() as session:
+                session["curr_user"] = user_id
+
+            with self.assertMaxQueries(3):
+                c.get('/users')
+
+            with self.assertMaxQueries(2):
+                result = c.get(f'/users/{user_id}/favorites')
+
+            self.assertIn(b'From other4', result.data)
+
+    def test_signup_taken_skips_hashing(self):
+        """Is a taken username rejected before the password is hashed?"""
+
+        availability.rebuild()
+        hashes = password_pool.work_time.count(op='hash')
+
+        result = self.client.post('/signup', data={
+            'username': 'testuser',
+            'email': 'new@test.com',
+            'password': 'password',
+        })
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn(b'Username already taken', result.data)
+        self.assertEqual(password_pool.work_time.count(op='hash'), hashes)
+
+    def test_username_available(self):
+        """Does the availability API answer for taken and free names?"""
+
+        availability.rebuild()
+
+        result = self.client.get('/api/username-available?username=testuser')
+        self.assertEqual(result.json, {'username': 'testuser', 'available': False})
+
+        result = self.client.get('/api/username-available?username=brandnew')
+        self.assertEqual(result.json, {'username': 'brandnew', 'available': True})
+
+        # taken by another worker since this process built its filter
+        db.session.add(User(email="brandnew@test.com", username="brandnew",
+                            password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        result = self.client.get('/api/username-available?username=brandnew')
+        self.assertEqual(result.json, {'username': 'brandnew', 'available': False})
+
+    def test_user_search_ranking(self):
+        """Are search results ranked exact, prefix, then substring?"""
+
+        for name in ("malice", "alice", "Al", "bob"):
+            db.session.add(User(email=f"{name}@test.com",
+                                username=name,
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        html = self.client.get('/users?q=al').data.decode()
+
+        self.assertNotIn('@bob', html)
+        self.assertLess(html.index('@Al<'), html.index('@alice<'))
+        self.assertLess(html.index('@alice<'), html.index('@malice<'))
+
+        username_index.rebuild()
+        result = self.client.get('/api/users/autocomplete?q=AL')
+        self.assertEqual([u['username'] for u in result.json], ['Al', 'alice'])
+
+        # short names rank first however many longer ones sort before them
+        for n in range(50):
+            username_index.add(10 ** 6 + n, f"ala{n:03d}")
+        username_index.add(2 * 10 ** 6, "alz")
+
+        self.assertEqual([name for _, name in username_index.prefix('al', 3)],
+                         ['Al', 'alz', 'alice'])
+
+        self.assertEqual([name for _, name in username_index.substring('ic')],
+                         ['alice', 'malice'])
+
+        username_index.trigrams = True
+        try:
+            username_index.rebuild()
+            self.assertEqual([name for _, name in username_index.substring('lic')],
+                             ['alice', 'malice'])
+            # too short for trigrams, but still a substring match
+            self.assertEqual([name for _, name in username_index.substring('li')],
+                             ['alice', 'malice'])
+        finally:
+            username_index.trigrams = False
+            username_index.rebuild()
+
+    def test_user_card_fragments(self):
+        """Are user cards cached per user, but follow buttons per viewer?"""
+
+        other = User(email="other@test.com", username="other",
+                     password="HASHED_PASSWORD")
+        db.session.add(other)
+        db.session.commit()
+        u_id, other_id = self.u.id, other.id
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u_id
+            c.post(f'/users/follow/{other_id}')
+            html = c.get('/users').data.decode()
+            self.assertIn(f'action="/users/stop-following/{other_id}"', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = other_id
+            html = c.get('/users').data.decode()
+            self.assertNotIn(f'action="/users/stop-following/{other_id}"', html)
+            self.assertIn(f'action="/users/follow/{u_id}"', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = u_id
+            resp = c.post('/users/profile', data={'username': 'testuser',
+                                                  'email': 'test@test.com',
+                                                  'bio': 'Edited bio',
+                                                  'password': 'HASHED_PASSWORD'})
+            self.assertEqual(resp.status_code, 302)
+            self.assertIn('Edited bio', c.get('/users').data.decode())
+
 
 
 
@@ -0,0 +1,50 @@
+"""Test helpers for Warbler."""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+
+@contextmanager
+def count_queries():
+    """Count SQL statements run inside the block.
+
+    Yields a list that collects each statement's SQL, so `len()` of it is
+    the query count:
+
+        with count_queries() as queries:
+            client.get('/')
+        print(len(queries))
+    """
+
+    queries = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    engine = db.get_engine()
+    event.listen(engine, 'before_cursor_execute', record)
+
+    try:
+        yield queries
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+class QueryBudgetMixin:
+    """TestCase mixin to catch N+1 regressions in routes.
+
+        with self.assertMaxQueries(4):
+            self.client.get('/')
+    """
+
+    @contextmanager
+    def assertMaxQueries(self, limit):
+        with count_queries() as queries:
+            yield queries
+
+        if len(queries) > limit:
+            self.fail(f"{len(queries)} queries run (limit {limit}):\n"
+                      + "\n".join(queries))